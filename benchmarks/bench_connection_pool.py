@@ -0,0 +1,61 @@
+"""Per-query latency of databaseIntegration with and without the connection pool.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_connection_pool [n_queries]
+"""
+import os
+import secrets
+import sys
+import tempfile
+import time
+
+from server.databaseIntegration import closeAllPools
+from server.databaseIntegration import create_connection
+from server.databaseIntegration import readDatabase
+
+QUERY = """ SELECT active_customers FROM user_helpers where phone=? """
+
+
+def createTestDatabase(db, key, nHelpers=1000):
+    conn, cursor = create_connection(db, key)
+    cursor.execute("CREATE TABLE user_helpers (phone TEXT, name TEXT, zipcode TEXT, active_customers TEXT)")
+    cursor.executemany(
+        "INSERT INTO user_helpers (phone, name, zipcode) values(?, ?, ?)",
+        [("+4670%07d" % i, "Helper %d" % i, "17070") for i in range(nHelpers)],
+    )
+    conn.commit()
+    conn.close()
+
+
+# The way every helper in databaseIntegration used to run a query
+def unpooledRead(db, key, query, params):
+    conn, cursor = create_connection(db, key)
+    cursor.execute(query, params)
+    res = cursor.fetchall()
+    conn.close()
+    return res
+
+
+def timePerQuery(readFunction, db, key, nQueries):
+    start = time.perf_counter()
+    for i in range(nQueries):
+        readFunction(db, key, QUERY, ["+4670%07d" % (i % 1000)])
+    return (time.perf_counter() - start) / nQueries * 1000
+
+
+if __name__ == "__main__":
+    nQueries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    key = secrets.token_hex(32)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = os.path.join(tmpdir, "bench.db")
+        createTestDatabase(db, key)
+
+        unpooled = timePerQuery(unpooledRead, db, key, nQueries)
+        pooled = timePerQuery(readDatabase, db, key, nQueries)
+        closeAllPools()
+
+    print(f"Queries per run: {nQueries}")
+    print(f"  fresh connection per query: {unpooled:8.3f} ms/query")
+    print(f"  pooled connection:          {pooled:8.3f} ms/query")
+    print(f"  speedup:                    {unpooled / pooled:8.1f}x")
@@ -0,0 +1,124 @@
+"""Cost of the lookups made while answering calls before and after the indexes of the schema migrations.
+
+Builds an encrypted database with the tables only (schema version 1) and n_helpers
+synthetic helpers, customers and calls, times each lookup, migrates it to the
+current schema and times them again. Run from the repository root:
+
+    python -m benchmarks.bench_schema_indexes [n_helpers] [n_lookups]
+"""
+import os
+import random
+import secrets
+import sys
+import tempfile
+import time
+
+from server.databaseIntegration import closeAllPools
+from server.databaseIntegration import create_connection
+from server.databaseIntegration import migrateDatabase
+from server.databaseIntegration import readDatabase
+from server.migrations import migrate
+from server.migrations import MIGRATIONS
+
+DISTRICTS = 290  # Swedish municipalities
+PAIRED_SHARE = 0.05  # Share of helpers with an active customer
+
+# (name, query, function of the lookup number giving its parameters)
+LOOKUPS = [
+    ("helper by phone", """ SELECT active_customers FROM user_helpers where phone=? """, lambda i: [phone(i)]),
+    (
+        "customer by phone",
+        """ SELECT active_helpers FROM user_customers where phone=? """,
+        lambda i: [phone(i)],
+    ),
+    (
+        "available helpers in district",
+        """SELECT phone, zipcode FROM user_helpers WHERE district=? AND active_customers IS NULL""",
+        lambda i: [district(i)],
+    ),
+    (
+        "helpers paired with customer",
+        """ SELECT phone FROM user_helpers WHERE active_customers=? """,
+        lambda i: [phone(i)],
+    ),
+    ("call by callid", """ SELECT hangup FROM call_variables WHERE callid=? """, lambda i: [callid(i)]),
+    (
+        "customer call analytics",
+        """ SELECT * FROM call_analytics_customer WHERE telehelp_callid=?""",
+        lambda i: [callid(i)],
+    ),
+]
+
+
+def phone(i):
+    return "+4670%07d" % i
+
+
+def district(i):
+    return "District %d" % (i % DISTRICTS)
+
+
+def callid(i):
+    return "call-%d" % i
+
+
+def createTestDatabase(db, key, nHelpers):
+    conn, cursor = create_connection(db, key)
+    migrate(conn, MIGRATIONS[:1])
+    rng = random.Random(0)
+    helpers = []
+    for i in range(nHelpers):
+        paired = phone(rng.randrange(nHelpers)) if rng.random() < PAIRED_SHARE else None
+        helpers.append((phone(i), "Helper %d" % i, "%05d" % rng.randrange(10000, 99999), district(i), paired))
+    cursor.executemany(
+        "INSERT INTO user_helpers (phone, name, zipcode, district, active_customers) values(?, ?, ?, ?, ?)",
+        helpers,
+    )
+    cursor.executemany(
+        "INSERT INTO user_customers (phone, zipcode, district) values(?, ?, ?)",
+        [(phone(i), "17070", district(i)) for i in range(nHelpers)],
+    )
+    cursor.executemany(
+        "INSERT INTO call_variables (callid) values(?)", [(callid(i),) for i in range(nHelpers)]
+    )
+    cursor.executemany(
+        "INSERT INTO call_analytics_customer (telehelp_callid) values(?)",
+        [(callid(i),) for i in range(nHelpers)],
+    )
+    conn.commit()
+    conn.close()
+
+
+# Output: {lookup name: ms per lookup}
+def timeLookups(db, key, nHelpers, nLookups):
+    rng = random.Random(1)
+    times = {}
+    for name, query, params in LOOKUPS:
+        numbers = [rng.randrange(nHelpers) for _ in range(nLookups)]
+        start = time.perf_counter()
+        for i in numbers:
+            readDatabase(db, key, query, params(i))
+        times[name] = (time.perf_counter() - start) / nLookups * 1000
+    return times
+
+
+if __name__ == "__main__":
+    nHelpers = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    nLookups = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    key = secrets.token_hex(32)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = os.path.join(tmpdir, "bench.db")
+        createTestDatabase(db, key, nHelpers)
+
+        before = timeLookups(db, key, nHelpers, nLookups)
+        start = time.perf_counter()
+        migrateDatabase(db, key)
+        migrationSeconds = time.perf_counter() - start
+        after = timeLookups(db, key, nHelpers, nLookups)
+        closeAllPools()
+
+    print(f"{nHelpers} helpers, customers and calls, {nLookups} lookups each")
+    print(f"Migrating to the indexed schema took {migrationSeconds:.2f} s")
+    print(f"  {'lookup':32} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for name, _, _ in LOOKUPS:
+        print(f"  {name:32} {before[name]:10.3f} {after[name]:10.3f} {before[name] / after[name]:7.0f}x")
@@ -0,0 +1,361 @@
+"""Load test of the phone call flow, with a local stand-in for 46elks.
+
+Simulated callers walk the path of a new customer the way 46elks drives it,
+receiveCall -> handleNumberInput -> checkZipcode -> postcodeInput -> call/N, by
+following the "next" and key press URLs of every answer. The stand-in serves
+/a1/calls and /a1/sms: volunteers called by the server answer after a ring and
+accept (connectUsers) or decline (call/N+1), and "whenhangup" is called after
+each of their calls. Reported are latency percentiles per endpoint, throughput
+and the time from receiveCall until a volunteer accepted.
+
+Start the server against a test database, pointed at the stand-in, from the
+server folder:
+
+    ELK_BASE=http://127.0.0.1:8046 BASE_URL=http://127.0.0.1:5000 PYTHONPATH=.. \\
+        gunicorn -w 4 -b :5000 server.api:app
+
+Then run from the repository root, with the DATABASE and DATABASE_KEY of the server
+if volunteers should be added for the run (they are removed again with the callers):
+
+    python -m benchmarks.load_call_flow --callers 2000 --rate 50 --seed-helpers 500
+
+Seeded volunteers and simulated callers are written to the database, never run
+this against production data.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import requests
+
+from server.databaseIntegration import closeAllPools
+from server.databaseIntegration import writeBatchToDatabase
+from server.zipcode_utils import getDistrict
+from server.zipcodeTable import loadZipCodeData
+
+ZIPDATA = os.path.join("server", "SE.txt")
+ZIPCODES = "11120,17070,41103,21119"  # Stockholm, Solna, Göteborg, Malmö
+HELPER_PHONE = "+4673%07d"
+CALLER_PHONE = "+4676%07d"
+VOLUNTEER_WORKERS = 64  # Simulated volunteers answering at the same time
+REQUEST_TIMEOUT = 30
+
+# Outcomes of a simulated call
+MATCHED = "matched"
+NO_MATCH = "called back"  # Every volunteer declined, the server called the customer back
+NO_HELPERS = "no helpers"  # No available volunteer near the zipcode
+TIMED_OUT = "timed out"
+FAILED = "failed"
+
+
+# Output: value at fraction q of sorted samples (nearest rank)
+def percentile(samples, q):
+    return samples[max(0, math.ceil(q * len(samples)) - 1)]
+
+
+# Output: route name of a URL, e.g. "call" for .../api/call/2/<callid>/<phone>/<id>
+def endpointName(url):
+    parts = urllib.parse.urlparse(url).path.strip("/").split("/")
+    return parts[1] if parts[0] == "api" and len(parts) > 1 else parts[0]
+
+
+# Input: 46elks action of a webhook answer, key presses left to make (consumed at every "ivr")
+# Output: (URL 46elks posts to next, "result" field of that post), (None, None) when the call ends there
+def nextHop(action, inputs):
+    result = None
+    while isinstance(action, dict):
+        if "ivr" in action:
+            result = inputs.pop(0) if inputs else None
+            action = action.get(result, action.get("next"))
+        elif "next" in action:
+            action = action["next"]
+        else:
+            break
+        if isinstance(action, str):
+            return action, result
+    return None, None
+
+
+class LatencyStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds = defaultdict(list)  # endpoint -> request durations
+        self._errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, error):
+        with self._lock:
+            self._seconds[endpoint].append(seconds)
+            self._errors[endpoint] += int(error)
+
+    def report(self, elapsed):
+        columns = ("requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms")
+        lines = [f"{'endpoint':24} " + " ".join(f"{column:>{len(column) + 2}}" for column in columns)]
+        with self._lock:
+            for endpoint, seconds in sorted(self._seconds.items()):
+                seconds = sorted(seconds)
+                p50, p95, p99 = (percentile(seconds, q) * 1000 for q in (0.5, 0.95, 0.99))
+                rate = len(seconds) / elapsed
+                lines.append(
+                    f"{endpoint:24} {len(seconds):10d} {self._errors[endpoint]:8d} {rate:7.1f} "
+                    f"{p50:8.1f} {p95:8.1f} {p99:8.1f}"
+                )
+        return "\n".join(lines)
+
+
+class Caller:
+    def __init__(self, phone, zipcode):
+        self.phone = phone
+        self.zipcode = zipcode
+        self.started = None
+        self.finished = None
+        self.outcome = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    # Only the first outcome counts, e.g. a volunteer accepting after the wait timed out doesn't
+    def finish(self, outcome):
+        with self._lock:
+            if self.outcome is None:
+                self.outcome = outcome
+                self.finished = time.monotonic()
+                self.done.set()
+
+
+class CallFlowLoadTest:
+    def __init__(self, target, stubPort, answerRate, ringTime, matchTimeout):
+        self.target = target.rstrip("/")
+        self.answerRate = answerRate
+        self.ringTime = ringTime
+        self.matchTimeout = matchTimeout
+        self.stats = LatencyStats()
+        self.stubCounts = defaultdict(int)  # 46elks API path -> requests from the server
+        self.callers = {}  # phone -> Caller
+        self.matches = defaultdict(int)  # volunteer phone -> callers connected to
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._volunteers = ThreadPoolExecutor(max_workers=VOLUNTEER_WORKERS, thread_name_prefix="volunteer")
+        self.stub = ThreadingHTTPServer(("127.0.0.1", stubPort), self._stubHandler())
+        self.stub.daemon_threads = True
+
+    def _session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    # Posts a webhook the way 46elks does. Redirects are followed as a GET and timed as their own endpoint.
+    # Output: the response, None if the server couldn't be reached
+    def post(self, url, fields, method="POST"):
+        start = time.perf_counter()
+        error = True
+        try:
+            response = self._session().request(
+                method, url, data=fields, timeout=REQUEST_TIMEOUT, allow_redirects=False
+            )
+            error = response.status_code >= 400
+        except requests.RequestException as err:
+            print(f"{url}: {err}")
+            return None
+        finally:
+            self.stats.record(endpointName(url), time.perf_counter() - start, error)
+        if response.is_redirect:
+            return self.post(urllib.parse.urljoin(url, response.headers["location"]), {}, method="GET")
+        return response
+
+    def _stubHandler(self):
+        loadTest = self
+
+        class ElksStub(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                fields = {key: values[0] for key, values in urllib.parse.parse_qs(body).items()}
+                with loadTest._lock:
+                    loadTest.stubCounts[self.path] += 1
+                if self.path == "/a1/calls":
+                    loadTest.placedCall(fields)
+                elif self.path != "/a1/sms":
+                    self.send_error(404)
+                    return
+                answer = json.dumps({"id": uuid.uuid4().hex, "status": "created", **fields}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+            def log_message(self, format, *args):
+                pass
+
+        return ElksStub
+
+    # The server placed a call through the stand-in, to a volunteer or back to a customer
+    def placedCall(self, fields):
+        caller = self.callers.get(fields.get("to"))
+        if caller is not None:
+            caller.finish(NO_MATCH)
+        else:
+            self._volunteers.submit(self.answerAsVolunteer, fields)
+
+    def answerAsVolunteer(self, fields):
+        try:
+            time.sleep(random.uniform(0, 2 * self.ringTime))
+            action = json.loads(fields["voice_start"])
+            form = {
+                "callid": uuid.uuid4().hex,
+                "from": fields["from"],
+                "to": fields["to"],
+                "direction": "outgoing",
+            }
+            accept = random.random() < self.answerRate
+            url, result = nextHop(action, ["1" if accept else "2"])
+            if url is not None:
+                response = self.post(url, dict(form, result=result))
+                if accept and response is not None and response.status_code == 200 and response.text:
+                    caller = self.callers.get(json.loads(response.text).get("connect"))
+                    if caller is not None:
+                        caller.finish(MATCHED)
+                        with self._lock:
+                            self.matches[fields["to"]] += 1
+            if fields.get("whenhangup"):
+                self.post(fields["whenhangup"], form)
+        except Exception as err:
+            print(f"Volunteer {fields.get('to')} failed: {err}")
+
+    def runCaller(self, caller):
+        caller.started = time.monotonic()
+        try:
+            fields = {"callid": uuid.uuid4().hex, "from": caller.phone, "direction": "incoming"}
+            inputs = ["1", caller.zipcode, "1"]  # Needs help, zipcode, confirms the city
+            url, result = self.target + "/api/receiveCall", None
+            while url is not None:
+                response = self.post(url, fields if result is None else dict(fields, result=result))
+                if response is None or response.status_code >= 400:
+                    caller.finish(FAILED)
+                    return
+                if not response.text:
+                    break  # call/0 answers empty, the server is dialing volunteers
+                url, result = nextHop(json.loads(response.text), inputs)
+                if url is None:
+                    caller.finish(NO_HELPERS)
+                    return
+            if not caller.done.wait(self.matchTimeout):
+                caller.finish(TIMED_OUT)
+        except Exception as err:
+            print(f"Caller {caller.phone} failed: {err}")
+            caller.finish(FAILED)
+
+    # Input: callers arriving at rate per second, at most concurrency of them in a call at once
+    # Output: seconds from the first call until the last caller finished
+    def run(self, callers, rate, concurrency):
+        self.callers = {caller.phone: caller for caller in callers}
+        threading.Thread(target=self.stub.serve_forever, daemon=True).start()
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="caller") as executor:
+                for i, caller in enumerate(callers):
+                    delay = start + i / rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    executor.submit(self.runCaller, caller)
+            return time.monotonic() - start
+        finally:
+            self._volunteers.shutdown(wait=True)
+            self.stub.shutdown()
+
+
+def seedHelpers(db, key, phones, zipcodes, district_dict):
+    timestr = time.strftime("%Y-%m-%d:%H-%M-%S", time.gmtime())
+    query = (
+        """ INSERT INTO user_helpers (phone, name, zipcode, district, signup_time) values(?, ?, ?, ?, ?) """
+    )
+    statements = []
+    for i, phone in enumerate(phones):
+        zipcode = zipcodes[i % len(zipcodes)]
+        statements.append(
+            (query, (phone, f"Lasttest {i}", zipcode, getDistrict(int(zipcode), district_dict), timestr))
+        )
+    writeBatchToDatabase(db, key, statements)
+
+
+def removeTestUsers(db, key, helpers, customers):
+    statements = [(""" DELETE FROM user_helpers WHERE phone=? """, (phone,)) for phone in helpers]
+    statements += [(""" DELETE FROM user_customers WHERE phone=? """, (phone,)) for phone in customers]
+    writeBatchToDatabase(db, key, statements)
+
+
+def printReport(loadTest, callers, elapsed):
+    print(loadTest.stats.report(elapsed))
+    print()
+    outcomes = defaultdict(int)
+    for caller in callers:
+        outcomes[caller.outcome] += 1
+    print(f"{len(callers)} callers in {elapsed:.1f} s ({len(callers) / elapsed:.1f} calls/s): ", end="")
+    print(", ".join(f"{count} {outcome}" for outcome, count in sorted(outcomes.items())))
+    matched = sorted(caller.finished - caller.started for caller in callers if caller.outcome == MATCHED)
+    if matched:
+        p50, p95, p99 = (percentile(matched, q) for q in (0.5, 0.95, 0.99))
+        print(f"Time to match: p50 {p50:.2f} s, p95 {p95:.2f} s, p99 {p99:.2f} s")
+    doubleBooked = sum(1 for n in loadTest.matches.values() if n > 1)
+    if doubleBooked:
+        print(f"{doubleBooked} volunteers were connected to more than one caller")
+    print(
+        "Requests to the 46elks stand-in: "
+        + ", ".join(f"{path} {n}" for path, n in loadTest.stubCounts.items())
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated callers walking the IVR against a running server")
+    parser.add_argument("--target", default="http://127.0.0.1:5000", help="Server under test")
+    parser.add_argument("--stub-port", type=int, default=8046, help="Port of the 46elks stand-in (ELK_BASE)")
+    parser.add_argument("--callers", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=20.0, help="New callers per second")
+    parser.add_argument("--concurrency", type=int, default=500, help="Callers in a call at the same time")
+    parser.add_argument("--answer-rate", type=float, default=0.5, help="Share of volunteer calls accepted")
+    parser.add_argument("--ring-time", type=float, default=1.0, help="Mean seconds before a volunteer answers")
+    parser.add_argument(
+        "--match-timeout", type=float, default=120.0, help="Seconds a caller waits for a match"
+    )
+    parser.add_argument(
+        "--zipcodes", default=ZIPCODES, help="Comma separated zipcodes of callers and volunteers"
+    )
+    parser.add_argument(
+        "--seed-helpers", type=int, default=0, help="Volunteers added to the database for the run"
+    )
+    parser.add_argument("--database", default=os.getenv("DATABASE"))
+    parser.add_argument("--key", default=os.getenv("DATABASE_KEY"))
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep seeded volunteers and callers in the database"
+    )
+    args = parser.parse_args()
+
+    zipcodes = args.zipcodes.split(",")
+    # Numbers start at a random offset, so those of earlier runs that were kept are unlikely to be drawn again
+    offset = random.randrange(10 ** 7 - args.callers)
+    callers = [Caller(CALLER_PHONE % (offset + i), random.choice(zipcodes)) for i in range(args.callers)]
+    helpers = []
+    if args.seed_helpers:
+        _, DISTRICT_DICT, _ = loadZipCodeData(ZIPDATA)
+        offset = random.randrange(10 ** 7 - args.seed_helpers)
+        helpers = [HELPER_PHONE % (offset + i) for i in range(args.seed_helpers)]
+        seedHelpers(args.database, args.key, helpers, zipcodes, DISTRICT_DICT)
+
+    loadTest = CallFlowLoadTest(
+        args.target, args.stub_port, args.answer_rate, args.ring_time, args.match_timeout
+    )
+    try:
+        elapsed = loadTest.run(callers, args.rate, args.concurrency)
+        printReport(loadTest, callers, elapsed)
+    finally:
+        if args.database and not args.keep:
+            removeTestUsers(args.database, args.key, helpers, [caller.phone for caller in callers])
+        closeAllPools()
@@ -0,0 +1,152 @@
+"""Stress test of the storage layer under concurrent webhooks of several gunicorn workers.
+
+Starts --workers processes with --threads threads each. Every thread plays calls
+back to back, running the database functions the webhooks of a call use:
+createNewCallHistory, readAvailableHelpers, writeActiveCustomer/writeActiveHelper
+on a match, readActiveCustomer and clearCustomerHelperPairing at hangup. Reported
+are latency percentiles per function and the errors raised, e.g. "database is
+locked". Run from the repository root:
+
+    python -m benchmarks.stress_database --workers 4 --threads 16 --seconds 10
+"""
+import argparse
+import contextlib
+import multiprocessing
+import os
+import random
+import secrets
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from collections import defaultdict
+
+from benchmarks.load_call_flow import percentile
+from server.databaseIntegration import clearCustomerHelperPairing
+from server.databaseIntegration import closeAllPools
+from server.databaseIntegration import create_connection
+from server.databaseIntegration import createNewCallHistory
+from server.databaseIntegration import migrateDatabase
+from server.databaseIntegration import readActiveCustomer
+from server.databaseIntegration import readAvailableHelpers
+from server.databaseIntegration import writeActiveCustomer
+from server.databaseIntegration import writeActiveHelper
+
+DISTRICTS = ["Stockholm", "Göteborg", "Malmö", "Uppsala"]
+
+
+def createTestDatabase(db, key, nHelpers, nCustomers):
+    migrateDatabase(db, key)
+    closeAllPools()
+    conn, cursor = create_connection(db, key)
+    cursor.executemany(
+        "INSERT INTO user_helpers (phone, name, zipcode, district) values(?, ?, ?, ?)",
+        [("+4673%07d" % i, "Helper %d" % i, "17070", DISTRICTS[i % len(DISTRICTS)]) for i in range(nHelpers)],
+    )
+    cursor.executemany(
+        "INSERT INTO user_customers (phone, zipcode, district) values(?, ?, ?)",
+        [("+4676%07d" % i, "17070", DISTRICTS[i % len(DISTRICTS)]) for i in range(nCustomers)],
+    )
+    conn.commit()
+    conn.close()
+
+
+# One simulated call, the duration of every database function it ran is added to samples
+def playCall(db, key, rng, nCustomers, samples):
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        result = function(db, key, *args)
+        samples[name].append(time.perf_counter() - start)
+        return result
+
+    customer = "+4676%07d" % rng.randrange(nCustomers)
+    district = DISTRICTS[int(customer[-4:]) % len(DISTRICTS)]
+    timed("createNewCallHistory", createNewCallHistory, str(uuid.uuid1()))
+    available = timed("readAvailableHelpers", readAvailableHelpers, district)
+    if not available:
+        return
+    helper = rng.choice(available)[0]
+    timed("writeActiveCustomer", writeActiveCustomer, helper, customer)
+    timed("writeActiveHelper", writeActiveHelper, customer, helper)
+    timed("readActiveCustomer", readActiveCustomer, helper)
+    timed("clearCustomerHelperPairing", clearCustomerHelperPairing, helper)
+
+
+# Runs in a worker process, puts ({function: durations}, {error: count}) on results
+def runWorker(db, key, threads, seconds, nCustomers, results):
+    samples = defaultdict(list)
+    errors = Counter()
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def play(seed):
+        rng = random.Random(seed)
+        threadSamples = defaultdict(list)
+        threadErrors = Counter()
+        while time.monotonic() < deadline:
+            try:
+                playCall(db, key, rng, nCustomers, threadSamples)
+            except Exception as err:
+                threadErrors[f"{type(err).__name__}: {err}"] += 1
+        with lock:
+            for name, durations in threadSamples.items():
+                samples[name].extend(durations)
+            errors.update(threadErrors)
+
+    # The database functions print every row they read
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        workers = [threading.Thread(target=play, args=(secrets.randbits(32),)) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    results.put((dict(samples), dict(errors)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent webhook load on the database")
+    parser.add_argument("--workers", type=int, default=4, help="Processes, as gunicorn workers")
+    parser.add_argument("--threads", type=int, default=16, help="Concurrent calls per process")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--helpers", type=int, default=2000)
+    parser.add_argument("--customers", type=int, default=2000)
+    args = parser.parse_args()
+
+    key = secrets.token_hex(32)
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = os.path.join(tmpdir, "stress.db")
+        createTestDatabase(db, key, args.helpers, args.customers)
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=runWorker, args=(db, key, args.threads, args.seconds, args.customers, results)
+            )
+            for _ in range(args.workers)
+        ]
+        for process in processes:
+            process.start()
+        samples = defaultdict(list)
+        errors = Counter()
+        for _ in processes:
+            workerSamples, workerErrors = results.get()
+            for name, durations in workerSamples.items():
+                samples[name].extend(durations)
+            errors.update(workerErrors)
+        for process in processes:
+            process.join()
+
+    print(f"{args.workers} workers x {args.threads} threads for {args.seconds:.0f} s")
+    columns = ("calls", "per s", "p50 ms", "p95 ms", "p99 ms", "max ms")
+    print(f"{'function':28} " + " ".join(f"{column:>{len(column) + 2}}" for column in columns))
+    for name, durations in samples.items():
+        durations.sort()
+        p50, p95, p99 = (percentile(durations, q) * 1000 for q in (0.5, 0.95, 0.99))
+        print(
+            f"{name:28} {len(durations):7d} {len(durations) / args.seconds:7.1f} "
+            f"{p50:8.2f} {p95:8.2f} {p99:8.2f} {durations[-1] * 1000:8.1f}"
+        )
+    print(f"{sum(errors.values())} errors")
+    for error, count in errors.most_common():
+        print(f"  {count:6d} {error}")
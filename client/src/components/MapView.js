@@ -1,64 +1,103 @@
 import React from "react";
+import L from "leaflet";
 import { Map as LeafletMap, TileLayer, Marker, Popup } from "react-leaflet";
-import MarkerClusterGroup from "react-leaflet-markercluster";
 
+const TILE_SIZE = 256;
+
+// Volunteers are clustered by the server per map tile, so only the tiles in view are fetched
 class MapView extends React.Component {
   constructor(props) {
     super(props);
     this.state = {
-      mapData: { count: 0, locations: [] },
+      total: 0,
+      clusters: [],
     };
+    this.mapRef = React.createRef();
+    this.loadClusters = this.loadClusters.bind(this);
   }
 
   componentDidMount() {
-    fetch("/getVolunteerLocations")
-      .then((res) => {
-        if (res.ok) {
-          return res.json();
+    this.loadClusters();
+  }
+
+  visibleTiles(map) {
+    const zoom = Math.round(map.getZoom());
+    const bounds = map.getPixelBounds();
+    const last = Math.pow(2, zoom) - 1;
+    const tile = (v) => Math.min(Math.max(Math.floor(v / TILE_SIZE), 0), last);
+    const tiles = [];
+    for (let x = tile(bounds.min.x); x <= tile(bounds.max.x); x++) {
+      for (let y = tile(bounds.min.y); y <= tile(bounds.max.y); y++) {
+        tiles.push(`${zoom}/${x}/${y}`);
+      }
+    }
+    return tiles;
+  }
+
+  loadClusters() {
+    if (!this.mapRef.current) {
+      return;
+    }
+    const tiles = this.visibleTiles(this.mapRef.current.leafletElement);
+    this.latestTiles = tiles;
+    Promise.all(
+      tiles.map((tile) =>
+        fetch(`/getVolunteerClusters/${tile}`).then((res) => {
+          if (res.ok) {
+            return res.json();
+          }
+          return Promise.reject("No response from server");
+        })
+      )
+    )
+      .then((data) => {
+        // Ignore answers for a view the user has already left
+        if (tiles !== this.latestTiles) {
+          return;
         }
-        this.setState({ mapData: { count: 0, locations: [] } });
-        return Promise.reject("No response from server");
+        this.setState({
+          total: data.length ? data[0].total : 0,
+          clusters: [].concat(...data.map((tile) => tile.clusters)),
+        });
       })
-      .then((data) => {
-        //Might have to do with how i'm not passing props but i hav to do this atm
-        //The markers do not show if they get displayed before the map
-        setTimeout(() => this.setState({ mapData: data }), 500);
-      });
+      .catch(() => this.setState({ clusters: [] }));
   }
 
   markerText(loc) {
-    if (loc.count > 1) {
-      return `${loc.count} volontärer i ${loc.city} (${loc.zipcode})`;
+    const volunteers = loc.count > 1 ? `${loc.count} volontärer` : `${loc.count} volontär`;
+    if (loc.zipcode) {
+      return `${volunteers} i ${loc.city} (${loc.zipcode})`;
     }
-    return `${loc.count} volontär i ${loc.city} (${loc.zipcode})`;
+    return `${volunteers} i området`;
   }
 
-  render() {
-    const { mapData } = this.state;
-    const markers = mapData.locations.map((d, i) => {
-      return (
-        // We need to set spiderfyOnMaxZoom to false so that markers in the same spot don't spider
-        <MarkerClusterGroup
-          key={i}
-          singleMarkerMode={true}
-          spiderfyOnMaxZoom={false}
-        >
-          {d.data.map((e, j) => {
-            return (
-              <Marker key={j} position={e.coordinates}>
-                <Popup>{this.markerText(e)}</Popup>
-              </Marker>
-            );
-          })}
-        </MarkerClusterGroup>
-      );
+  markerIcon(loc) {
+    const size = loc.count < 10 ? "small" : loc.count < 100 ? "medium" : "large";
+    return L.divIcon({
+      html: `<div><span>${loc.count}</span></div>`,
+      className: `volunteer-cluster volunteer-cluster-${size}`,
+      iconSize: L.point(40, 40),
     });
+  }
+
+  render() {
+    const { total, clusters } = this.state;
+    const markers = clusters.map((c) => (
+      <Marker
+        key={c.coordinates.join(",")}
+        position={c.coordinates}
+        icon={this.markerIcon(c)}
+      >
+        <Popup>{this.markerText(c)}</Popup>
+      </Marker>
+    ));
 
     return (
       <div className="mapHolder">
-        <h2>Våra {mapData.total} st volontärer finns i hela landet</h2>
+        <h2>Våra {total} st volontärer finns i hela landet</h2>
         <div id="mapid" className="leaflet-container">
           <LeafletMap
+            ref={this.mapRef}
             center={[59.8, 14.9]}
             zoom={5}
             maxZoom={19}
@@ -69,6 +108,7 @@ class MapView extends React.Component {
             dragging={true}
             animate={true}
             easeLinearity={0.35}
+            onMoveend={this.loadClusters}
           >
             <TileLayer url="https://{s}.tile.osm.org/{z}/{x}/{y}.png" />
             {markers}
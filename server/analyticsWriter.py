@@ -0,0 +1,115 @@
+import atexit
+import threading
+
+FLUSH_INTERVAL = 2.0  # Seconds between flushes of queued analytics
+FLUSH_SIZE = 100  # Number of queued calls that triggers a flush right away
+MAX_ATTEMPTS = 3  # Failed writes in a row before the queued rows are written one by one, see flush
+
+
+# Input: table name, call id, {column: value}
+# Output: (query, params) inserting the row or updating the given columns if the call already has one
+def upsertStatement(table, telehelp_callid, values):
+    columns = list(values)
+    columnStr = ",".join(["telehelp_callid"] + columns)
+    valuesStr = ",".join("?" * (len(columns) + 1))
+    updateStr = ",".join(f"{column}=excluded.{column}" for column in columns)
+    query = f""" INSERT INTO {table} ({columnStr}) values({valuesStr})
+                    ON CONFLICT(telehelp_callid) DO UPDATE SET {updateStr} """
+    return query, [telehelp_callid] + [values[column] for column in columns]
+
+
+class AnalyticsWriter:
+    """Queues call analytics and writes them in batches off the request path.
+
+    Updates are merged in memory per (table, telehelp_callid), so the several writes
+    made during one call usually end up as a single upsert. Queued rows are written
+    in one transaction every FLUSH_INTERVAL seconds, as soon as FLUSH_SIZE calls are
+    queued, and at interpreter exit. A batch that keeps failing is written row by row
+    so a single bad row is dropped instead of holding back all the others.
+    """
+
+    def __init__(
+        self, writeBatch, flushInterval=FLUSH_INTERVAL, flushSize=FLUSH_SIZE, maxAttempts=MAX_ATTEMPTS
+    ):
+        self.writeBatch = writeBatch  # Function executing a list of (query, params) in one transaction
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.maxAttempts = maxAttempts
+        self._pending = {}  # (table, telehelp_callid) -> {column: value}
+        self._failures = 0  # Failed flushes in a row
+        self._condition = threading.Condition()
+        self._flushLock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="AnalyticsWriter", daemon=True)
+        self._thread.start()
+
+    def record(self, table, telehelp_callid, values):
+        with self._condition:
+            self._pending.setdefault((table, telehelp_callid), {}).update(values)
+            if len(self._pending) >= self.flushSize:
+                self._condition.notify()
+
+    def _run(self):
+        failed = False
+        while True:
+            with self._condition:
+                if not self._closed and (failed or len(self._pending) < self.flushSize):
+                    self._condition.wait(self.flushInterval)
+                if self._closed:
+                    return
+            failed = not self.flush()
+
+    # Output: False if writing failed, the rows are then queued again. After maxAttempts failed flushes in a
+    #         row the rows are written one at a time and those that still fail are dropped.
+    def flush(self):
+        with self._flushLock:
+            with self._condition:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return True
+            statements = [
+                upsertStatement(table, callid, values) for (table, callid), values in pending.items()
+            ]
+            try:
+                self.writeBatch(statements)
+            except Exception as err:
+                self._failures += 1
+                if self._failures < self.maxAttempts:
+                    print(f"Failed to write {len(statements)} analytics rows, retrying later: {err}")
+                    with self._condition:
+                        # Anything recorded since the swap is newer and wins
+                        for rowKey, values in pending.items():
+                            self._pending[rowKey] = {**values, **self._pending.get(rowKey, {})}
+                    return False
+                print(f"Failed again, writing the {len(statements)} analytics rows one by one: {err}")
+                self._writeEach(pending)
+            self._failures = 0
+            return True
+
+    def _writeEach(self, pending):
+        for (table, callid), values in pending.items():
+            try:
+                self.writeBatch([upsertStatement(table, callid, values)])
+            except Exception as err:
+                print(f"Dropping analytics of call {callid} in {table} {values}: {err}")
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+
+
+_writers = []
+
+
+@atexit.register
+def closeAllAnalyticsWriters():
+    while _writers:
+        _writers.pop().close()
+
+
+def registerAnalyticsWriter(writer):
+    _writers.append(writer)
+    return writer
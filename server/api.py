@@ -1,3 +1,4 @@
+import atexit
 import json
 import logging
 import os
@@ -5,51 +6,79 @@ import random
 import secrets
 import socket
 import string
-import threading
 import time
 import urllib.parse
 import uuid
-from collections import Counter
-from collections import defaultdict
 from pprint import pprint
 
-import pandas as pd
-import requests
 from flask import abort
 from flask import Flask
+from flask import g
 from flask import redirect
 from flask import request
 from flask import session
 from flask import url_for
 from flask_session import Session
 
+from .callState import CALL
+from .callState import createCallStateStore
+from .callState import EXHAUSTED
+from .callState import HUNG_UP
+from .checkMedia import checkAllURLs
 from .checkMedia import checkPayload
+from .checkMedia import knownMediaUrls
+from .databaseIntegration import addQueryListener
 from .databaseIntegration import clearCustomerHelperPairing
 from .databaseIntegration import createNewCallHistory
 from .databaseIntegration import deleteFromDatabase
-from .databaseIntegration import fetchData
+from .databaseIntegration import explainQuery
 from .databaseIntegration import fetchHelper
+from .databaseIntegration import getJobScheduler
+from .databaseIntegration import getVolunteerCounts
+from .databaseIntegration import migrateDatabase
 from .databaseIntegration import readActiveCustomer
 from .databaseIntegration import readActiveHelper
-from .databaseIntegration import readCallHistory
+from .databaseIntegration import readHelperCountsByDistrict
 from .databaseIntegration import readNameByNumber
 from .databaseIntegration import readNewConnectionInfo
 from .databaseIntegration import readZipcodeFromDatabase
 from .databaseIntegration import saveCustomerToDatabase
 from .databaseIntegration import saveHelperToDatabase
+from .databaseIntegration import unitOfWork
 from .databaseIntegration import userExists
 from .databaseIntegration import writeActiveCustomer
 from .databaseIntegration import writeActiveHelper
 from .databaseIntegration import writeCallHistory
 from .databaseIntegration import writeCustomerAnalytics
 from .databaseIntegration import writeHelperAnalytics
+from .elksClient import addRequestListener
+from .elksClient import ElksClient
+from .lazyImport import LazyModule
+from .metrics import Gauge
+from .metrics import Histogram
+from .metrics import queryName
+from .metrics import REGISTRY
+from .promptComposer import cityPromptSegments
+from .promptComposer import PromptComposer
+from .promptComposer import returningCustomerSegments
+from .queryLog import QueryLog
+from .scheduler import registerJob
+from .scheduler import RetryJob
 from .schemas import REGISTRATION_SCHEMA
 from .schemas import VERIFICATION_SCHEMA
-from .text2speech_utils import generateNameSoundByte
+from .text2speech_utils import getSpeechQueue
+from .text2speech_utils import namePath
+from .text2speech_utils import speechAvailable
+from .tracing import getTracer
+from .tracing import setTraceId
+from .volunteerLocations import MAX_ZOOM
+from .volunteerLocations import VolunteerLocations
 from .zipcode_utils import getCity
 from .zipcode_utils import getDistanceApart
 from .zipcode_utils import getDistrict
-from .zipcode_utils import readZipCodeData
+from .zipcodeTable import loadZipCodeData
+
+requests = LazyModule("requests")
 
 app = Flask(__name__, static_folder="../client/build", static_url_path="/")
 
@@ -93,23 +122,118 @@ checkEnv(DATABASE_KEY, "DATABASE_KEY")
 checkEnv(SECRET_KEY, "SECRET_KEY")
 checkEnv(HOOK_URL, "HOOK_URL")
 
+# Creates the tables and indexes, or adds those missing since the database was made
+migrateDatabase(DATABASE, DATABASE_KEY)
+
 ZIPDATA = "SE.txt"
 MEDIA_URL = "https://files.telehelp.se/sv"
-ELK_BASE = "https://api.46elks.com"
 
 VERIFICATION_EXPIRY_TIME = 5 * 60  # 5 minutes
 
-LOCATION_DICT, DISTRICT_DICT, CITY_DICT = readZipCodeData(ZIPDATA)
+# Outbound calls and SMS are sent in the background so webhooks can answer 46elks right away
+ELKS = ElksClient(API_USERNAME, API_PASSWORD)
+
+LOCATION_DICT, DISTRICT_DICT, CITY_DICT = loadZipCodeData(ZIPDATA)
+
+# Candidate lists, cursors and hangup flags of the dial chains. call_variables is only written to
+# as an audit trail when CALL_STATE_AUDIT is set.
+CALL_STATE = createCallStateStore()
+CALL_STATE_AUDIT = os.getenv("CALL_STATE_AUDIT") is not None
+
+# Prompts made of several sound bytes are joined into one file each, played in one step by 46elks
+PROMPTS = PromptComposer(MEDIA_URL)
+
+# Volunteer counts for the map, rendered once per change to user_helpers
+VOLUNTEER_LOCATIONS = VolunteerLocations(
+    getVolunteerCounts(DATABASE, DATABASE_KEY), LOCATION_DICT, DISTRICT_DICT, CITY_DICT
+)
+
+# Delayed actions such as the follow-up SMS, stored in the database so they survive restarts
+SCHEDULER = getJobScheduler(DATABASE, DATABASE_KEY)
+ASK_IF_HELPING_DELAY = 60  # Seconds after a match before the volunteer is asked to report back
+
+# Served at /metrics
+REQUEST_SECONDS = Histogram(
+    "telehelp_request_seconds", "Time spent answering HTTP requests", ["route", "method", "status"]
+)
+QUERY_SECONDS = Histogram(
+    "telehelp_db_query_seconds", "Time spent running database statements, by access path", ["query"]
+)
+addQueryListener(lambda query, params, seconds: QUERY_SECONDS.observe(seconds, queryName(query)))
+
+# Prints slow statements and full table scans, see queryLog
+SLOW_QUERY_LOG = QueryLog(explain=lambda query, params: explainQuery(DATABASE, DATABASE_KEY, query, params))
+addQueryListener(SLOW_QUERY_LOG.record)
+atexit.register(SLOW_QUERY_LOG.close)
+
+
+def collectHelperCounts():
+    counts = {}
+    for district, helpers, available in readHelperCountsByDistrict(DATABASE, DATABASE_KEY):
+        counts[(district, "available")] = available
+        counts[(district, "paired")] = helpers - available
+    return counts
+
+
+Gauge(
+    "telehelp_helpers",
+    "Registered volunteers per district, available or paired with a customer",
+    ["district", "status"],
+    collect=collectHelperCounts,
+)
+
+# Spans of every webhook of a call, see tracing. None unless TRACE_FILE or OTLP_ENDPOINT is set.
+TRACER = getTracer()
+if TRACER is not None:
+    addQueryListener(TRACER.recordQuery)
+    addRequestListener(TRACER.recordElksRequest)
+
+# Check every IVR and city prompt once in the background, later payload checks are then served from the cache
+if os.getenv("CHECK_MEDIA_AT_STARTUP") is not None:
+    checkAllURLs(knownMediaUrls(MEDIA_URL, CITY_DICT.values()), log=log, wait_for_result=False)
 
 print("Site phone number: " + ELK_NUMBER)
 
 
+def auditCallState(callId, columnName, data):
+    if CALL_STATE_AUDIT:
+        writeCallHistory(DATABASE, DATABASE_KEY, callId, columnName, data)
+
+
 def canonicalize_number(phone_number):
     if phone_number[0] == "0":
         phone_number = "+46" + phone_number[1:]
     return phone_number
 
 
+@app.before_request
+def startRequestTimer():
+    g.requestStart = time.perf_counter()
+    if TRACER is not None and request.endpoint is not None:
+        telehelpCallId = (request.view_args or {}).get("telehelpCallId")
+        attributes = {"elks.callid": request.form.get("callid")}
+        g.span = TRACER.startSpan(request.endpoint, telehelpCallId, attributes)
+
+
+@app.after_request
+def recordRequestTime(response):
+    if "requestStart" in g:
+        # The route pattern rather than the path, which holds call ids and phone numbers
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - g.requestStart, route, request.method, response.status_code
+        )
+    if "span" in g:
+        span, token = g.pop("span")
+        TRACER.endSpan(span, token, **{"http.status_code": response.status_code})
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return app.response_class(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.route("/")
 def index():
     return app.send_static_file("index.html")
@@ -123,7 +247,9 @@ def receiveCall():
     callId = request.form.get("callid")
     startTime = time.strftime("%Y-%m-%d:%H-%M-%S", time.gmtime())
     telehelpCallId = str(uuid.uuid1())
-    createNewCallHistory(DATABASE, DATABASE_KEY, callId)
+    setTraceId(telehelpCallId)
+    if CALL_STATE_AUDIT:
+        createNewCallHistory(DATABASE, DATABASE_KEY, callId)
 
     from_sender = request.form.get("from")
     print(from_sender)
@@ -197,25 +323,31 @@ def receiveCall():
         else:
             nameEncoded = urllib.parse.quote(name)  # åäö etc not handled well as URL -> crash
 
-            # Make sure name already exists (generate if somehow missing, for example early volunteers)
-            if not os.path.isfile("/media/name/" + nameEncoded + ".mp3"):
-                generateNameSoundByte(name)
-
-            payload = {
-                "play": MEDIA_URL + "/ivr/behover_hjalp.mp3",
-                "next": {
-                    "play": MEDIA_URL + "/name/" + nameEncoded + ".mp3",
-                    "next": {
-                        "ivr": MEDIA_URL + "/ivr/pratade_sist.mp3",
-                        "digits": 1,
-                        "1": BASE_URL + "/api/handleReturningCustomer/%s" % telehelpCallId,
-                        "2": BASE_URL + "/api/handleReturningCustomer/%s" % telehelpCallId,
-                        "3": BASE_URL + "/api/handleReturningCustomer/%s" % telehelpCallId,
-                        "4": BASE_URL + "/api/support",
-                        "next": BASE_URL + "/api/receiveCall",
-                    },
-                },
+            # Leave the name out while a missing name (for example of early volunteers) is being synthesized
+            if os.path.isfile(namePath(name)):
+                namePrompts = [MEDIA_URL + "/name/" + nameEncoded + ".mp3"]
+                segments = returningCustomerSegments(name)
+            else:
+                namePrompts = []
+                segments = returningCustomerSegments()
+                if speechAvailable():
+                    getSpeechQueue().submit(name, namePath(name))
+
+            question = {
+                "digits": 1,
+                "1": BASE_URL + "/api/handleReturningCustomer/%s" % telehelpCallId,
+                "2": BASE_URL + "/api/handleReturningCustomer/%s" % telehelpCallId,
+                "3": BASE_URL + "/api/handleReturningCustomer/%s" % telehelpCallId,
+                "4": BASE_URL + "/api/support",
+                "next": BASE_URL + "/api/receiveCall",
             }
+            composite = PROMPTS.url(segments)
+            if composite is not None:
+                payload = {"ivr": composite, **question}
+            else:
+                payload = {"ivr": MEDIA_URL + "/ivr/pratade_sist.mp3", **question}
+                for prompt in reversed([MEDIA_URL + "/ivr/behover_hjalp.mp3", *namePrompts]):
+                    payload = {"play": prompt, "next": payload}
             checkPayload(payload, MEDIA_URL, log=log)
             return json.dumps(payload)
 
@@ -437,7 +569,7 @@ def postcodeInput(zipcode, telehelpCallId):
             closestHelpers.remove(helperPhone)
         writeActiveCustomer(DATABASE, DATABASE_KEY, helperPhone, None)
 
-    writeCallHistory(DATABASE, DATABASE_KEY, callId, "closest_helpers", json.dumps(closestHelpers))
+    auditCallState(callId, "closest_helpers", json.dumps(closestHelpers))
 
     if closestHelpers is None:
         writeCustomerAnalytics(
@@ -448,7 +580,8 @@ def postcodeInput(zipcode, telehelpCallId):
         checkPayload(payload, MEDIA_URL, log=log)
         return json.dumps(payload)
     else:
-        writeCallHistory(DATABASE, DATABASE_KEY, callId, "hangup", "False")
+        CALL_STATE.startCall(callId, closestHelpers)
+        auditCallState(callId, "hangup", "False")
         payload = {
             "play": MEDIA_URL + "/ivr/ringer_tillbaka.mp3",
             "skippable": "true",
@@ -465,8 +598,8 @@ def postcodeInput(zipcode, telehelpCallId):
 def call(helperIndex, customerCallId, customerPhone, telehelpCallId):
     # NOTE: When making changes here, also update /callSupport :)
 
-    stopCalling = readCallHistory(DATABASE, DATABASE_KEY, customerCallId, "hangup")
-    if stopCalling == "True":
+    status, helperPhone = CALL_STATE.claimHelper(customerCallId, helperIndex)
+    if status == HUNG_UP:
         endTime = time.strftime("%Y-%m-%d:%H-%M-%S", time.gmtime())
         writeCustomerAnalytics(
             DATABASE,
@@ -476,67 +609,62 @@ def call(helperIndex, customerCallId, customerPhone, telehelpCallId):
             (endTime, str(helperIndex), telehelpCallId),
         )
         return ""
-    else:
-        print("helperIndex:", helperIndex)
-
-        print("Customer callId: ", customerCallId)
-
-        closestHelpers = json.loads(readCallHistory(DATABASE, DATABASE_KEY, customerCallId, "closest_helpers"))
-        print("closest helpers: ", closestHelpers)
-
-        auth = (API_USERNAME, API_PASSWORD)
+    elif status == EXHAUSTED:
+        auditCallState(customerCallId, "hangup", "True")
+        writeCustomerAnalytics(
+            DATABASE,
+            DATABASE_KEY,
+            telehelpCallId,
+            ["n_helpers_contacted"],
+            (str(helperIndex), telehelpCallId),
+        )
+        return redirect(
+            url_for("callBackToCustomer", customerPhone=customerPhone, telehelpCallId=telehelpCallId)
+        )
+    elif status != CALL:
+        # Another hop already moved past this helper ("next" and "whenhangup" both lead here),
+        # or the call has expired
+        print(f"Not calling helper {helperIndex} for {customerCallId}: {status}")
+        return ""
 
-        if helperIndex >= len(closestHelpers):
-            writeCallHistory(DATABASE, DATABASE_KEY, customerCallId, "hangup", "True")
-            writeCustomerAnalytics(
-                DATABASE,
-                DATABASE_KEY,
-                telehelpCallId,
-                ["n_helpers_contacted"],
-                (str(helperIndex), telehelpCallId),
-            )
-            return redirect(
-                url_for("callBackToCustomer", customerPhone=customerPhone, telehelpCallId=telehelpCallId)
-            )
+    print("helperIndex:", helperIndex)
+    print("Customer callId: ", customerCallId)
 
-        print(closestHelpers[helperIndex])
-        print(ELK_NUMBER)
+    print(ELK_NUMBER)
 
-        payload = {
-            "ivr": MEDIA_URL + "/ivr/hjalte.mp3",
-            "timeout": "30",
-            "1": BASE_URL + "/api/connectUsers/%s/%s/%s" % (customerPhone, customerCallId, telehelpCallId),
-            "2": BASE_URL
-            + "/api/call/%s/%s/%s/%s" % (str(helperIndex + 1), customerCallId, customerPhone, telehelpCallId),
-            "next": BASE_URL
-            + "/api/call/%s/%s/%s/%s" % (str(helperIndex + 1), customerCallId, customerPhone, telehelpCallId),
-        }
+    payload = {
+        "ivr": MEDIA_URL + "/ivr/hjalte.mp3",
+        "timeout": "30",
+        "1": BASE_URL + "/api/connectUsers/%s/%s/%s" % (customerPhone, customerCallId, telehelpCallId),
+        "2": BASE_URL
+        + "/api/call/%s/%s/%s/%s" % (str(helperIndex + 1), customerCallId, customerPhone, telehelpCallId),
+        "next": BASE_URL
+        + "/api/call/%s/%s/%s/%s" % (str(helperIndex + 1), customerCallId, customerPhone, telehelpCallId),
+    }
 
-        checkPayload(payload, MEDIA_URL, log=log)
+    checkPayload(payload, MEDIA_URL, log=log)
 
-        print("Calling: ", closestHelpers[helperIndex])
-        fields = {
-            "from": ELK_NUMBER,
-            "to": closestHelpers[helperIndex],
-            "voice_start": json.dumps(payload),
-            "whenhangup": BASE_URL
-            + "/api/call/%s/%s/%s/%s" % (str(helperIndex + 1), customerCallId, customerPhone, telehelpCallId),
-        }
+    print("Calling: ", helperPhone)
+    fields = {
+        "from": ELK_NUMBER,
+        "to": helperPhone,
+        "voice_start": json.dumps(payload),
+        "whenhangup": BASE_URL
+        + "/api/call/%s/%s/%s/%s" % (str(helperIndex + 1), customerCallId, customerPhone, telehelpCallId),
+    }
 
-        response = requests.post(ELK_BASE + "/a1/calls", data=fields, auth=auth)
-        print(response.text)
-        return ""
+    ELKS.placeCall(fields)
+    return ""
 
 
 @app.route("/api/callBackToCustomer/<string:customerPhone>/<string:telehelpCallId>", methods=["POST", "GET"])
 def callBackToCustomer(customerPhone, telehelpCallId):
     print("No one found")
-    auth = (API_USERNAME, API_PASSWORD)
     payload = {"play": MEDIA_URL + "/ivr/ingen_hittad.mp3"}
 
     fields = {"from": ELK_NUMBER, "to": customerPhone, "voice_start": json.dumps(payload)}
 
-    requests.post(ELK_BASE + "/a1/calls", data=fields, auth=auth)
+    ELKS.placeCall(fields)
     endTime = time.strftime("%Y-%m-%d:%H-%M-%S", time.gmtime())
     writeCustomerAnalytics(
         DATABASE,
@@ -586,18 +714,22 @@ def checkZipcode(telehelpCallId):
     print("city: ", city)
     print("cityEnc: ", cityEncoded)
 
-    payload = {
-        "play": MEDIA_URL + "/ivr/du_befinner.mp3",
-        "next": {
-            "play": MEDIA_URL + "/city/" + cityEncoded + ".mp3",
+    question = {
+        "1": BASE_URL + f"/api/postcodeInput/{zipcode}/{telehelpCallId}",
+        "2": BASE_URL + "/api/handleNumberInput/%s" % telehelpCallId,
+        "next": BASE_URL + "/api/handleNumberInput/%s" % telehelpCallId,
+    }
+    composite = PROMPTS.url(cityPromptSegments(city))
+    if composite is not None:
+        payload = {"ivr": composite, **question}
+    else:
+        payload = {
+            "play": MEDIA_URL + "/ivr/du_befinner.mp3",
             "next": {
-                "ivr": MEDIA_URL + "/ivr/stammer_det.mp3",
-                "1": BASE_URL + f"/api/postcodeInput/{zipcode}/{telehelpCallId}",
-                "2": BASE_URL + "/api/handleNumberInput/%s" % telehelpCallId,
-                "next": BASE_URL + "/api/handleNumberInput/%s" % telehelpCallId,
+                "play": MEDIA_URL + "/city/" + cityEncoded + ".mp3",
+                "next": {"ivr": MEDIA_URL + "/ivr/stammer_det.mp3", **question},
             },
-        },
-    }
+        }
     checkPayload(payload, MEDIA_URL, log=log)
     return json.dumps(payload)
 
@@ -614,9 +746,12 @@ def connectUsers(customerPhone, customerCallId, telehelpCallId):
     # TODO: check current active customer/helper and move to previous
     writeCustomerAnalytics(DATABASE, DATABASE_KEY, telehelpCallId, ["match_found"], ("True", telehelpCallId))
     # writeCustomerAnalytics(DATABASE, DATABASE_KEY, telehelpCallId, match_found="True")
-    writeActiveCustomer(DATABASE, DATABASE_KEY, helperPhone, customerPhone)
-    writeActiveHelper(DATABASE, DATABASE_KEY, customerPhone, helperPhone)
-    writeCallHistory(DATABASE, DATABASE_KEY, customerCallId, "hangup", "True")
+    # Both sides of the pairing are written in one transaction, or neither is
+    with unitOfWork(DATABASE, DATABASE_KEY):
+        writeActiveCustomer(DATABASE, DATABASE_KEY, helperPhone, customerPhone)
+        writeActiveHelper(DATABASE, DATABASE_KEY, customerPhone, helperPhone)
+        auditCallState(customerCallId, "hangup", "True")
+    CALL_STATE.hangup(customerCallId)
     print("Connecting users")
     print("customer:", customerPhone)
 
@@ -630,23 +765,29 @@ def connectUsers(customerPhone, customerCallId, telehelpCallId):
 
     # Send a delayed SMS asking for a response on whether assignment accepted
     print("Preparing to send SMS to connected volunteer.")
-    smsThread = threading.Thread(target=sendAskIfHelpingSms, args=(helperPhone,))
-    smsThread.start()
+    SCHEDULER.schedule("askIfHelpingSms", helperPhone, delay=ASK_IF_HELPING_DELAY)
 
     return json.dumps(payload)
 
 
+@registerJob("askIfHelpingSms")
 def sendAskIfHelpingSms(volunteerNumber):
-    time.sleep(60)
-
     msg = "Förhoppningsvis kan du hjälpa personen du precis pratade med. \
 Ring till Telehelp på 0766861551 för att nå personen igen vid behov. \
 Svara TILLGÄNGLIG om du inte kunde hjälpa till eller är klar med uppgiften, så gör \
 vi dig tillgänglig för nya uppdrag. Observera att varken du eller den \
 du hjälpt kommer kunna nå varandra igen om du gör detta. Tack för din insats!"
-    auth = (API_USERNAME, API_PASSWORD)
     fields = {"from": ELK_NUMBER, "to": volunteerNumber, "message": msg}
-    requests.post(ELK_BASE + "/a1/sms", auth=auth, data=fields)
+    try:
+        response = ELKS.sendSms(fields, wait=True)
+    except requests.ConnectionError as err:
+        # The request never reached 46elks, so the SMS can't have been sent
+        raise RetryJob(err)
+    if response.status_code == 429:
+        raise RetryJob("rate limited by 46elks")
+    if response.status_code >= 400:
+        print(f"Failed to send confirmation SMS to volunteer {volunteerNumber}: {response.text}")
+        return
 
     print("Sent confirmation SMS to volunteer: " + volunteerNumber)
 
@@ -683,9 +824,8 @@ def register():
             return {"type": "failure", "message": "User already exists"}
 
         code = "".join(secrets.choice(string.digits) for _ in range(6))
-        auth = (API_USERNAME, API_PASSWORD)
         fields = {"from": "Telehelp", "to": phone_number, "message": code}
-        requests.post(ELK_BASE + "/a1/sms", auth=auth, data=fields)
+        ELKS.sendSms(fields)
         session[phone_number] = {
             "zipCode": validated["zipCode"],
             "name": validated["helperName"],
@@ -724,10 +864,9 @@ def verify():
             saveHelperToDatabase(DATABASE, DATABASE_KEY, name, phone_number, zipcode, city, timestr)
 
             #  TODO: Remove soundbyte if user quits?
-            urlEscapedName = urllib.parse.quote(name)
-            mediaPath = os.path.join("/", "media", f"{urlEscapedName}.mp3")
-            if not os.path.isfile(mediaPath) and os.getenv("GOOGLE_APPLICATION_CREDENTIALS") is not None:
-                generateNameSoundByte(name)
+            # Synthesized in the background, skipped if the name already has a sound byte
+            if speechAvailable():
+                getSpeechQueue().submit(name, namePath(name))
 
             return {"type": "success"}
     return {"type": "failure"}
@@ -735,28 +874,25 @@ def verify():
 
 @app.route("/getVolunteerLocations", methods=["GET"])
 def getVolunteerLocations():
-    query = "SELECT zipcode FROM user_helpers"
-    volunteer_zipcodes_df = fetchData(DATABASE, DATABASE_KEY, query, params=None)["zipcode"]
-
-    district_data = defaultdict(list)
-    c = Counter(volunteer_zipcodes_df)
-
-    for zipCode, count in c.most_common():
-        z = int(zipCode)  # Should change this to use string if we have the time
-        district = DISTRICT_DICT.get(z)
-
-        entry = {
-            "coordinates": LOCATION_DICT.get(z),
-            "city": CITY_DICT.get(z),
-            "zipcode": zipCode,
-            "count": count,
-        }
-        district_data[district].append(entry)
-
-    return {
-        "total": sum(c.values()),
-        "locations": [{"district": key, "data": val} for key, val in district_data.items()],
-    }
+    etag, body = VOLUNTEER_LOCATIONS.current()
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True  # Revalidate with the ETag, answered with 304 if unchanged
+    return response.make_conditional(request)
+
+
+# Volunteers of one slippy map tile, grouped into a handful of clusters
+@app.route("/getVolunteerClusters/<int:zoom>/<int:x>/<int:y>", methods=["GET"])
+def getVolunteerClusters(zoom, x, y):
+    if zoom > MAX_ZOOM or x >= 2 ** zoom or y >= 2 ** zoom:
+        abort(404)
+    etag, body = VOLUNTEER_LOCATIONS.tile(zoom, x, y)
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 #################### TELEHELP SUPPORT FUNCTIONS ###########################
@@ -771,8 +907,9 @@ def support():
     # J, T, DEr
     supportTeam = ["+46737600282", "+46707812741"]
     random.shuffle(supportTeam)  # Randomize order to spread load
-    writeCallHistory(DATABASE, DATABASE_KEY, callId, "closest_helpers", json.dumps(supportTeam))
-    writeCallHistory(DATABASE, DATABASE_KEY, callId, "hangup", "False")
+    CALL_STATE.startCall(callId, supportTeam)
+    auditCallState(callId, "closest_helpers", json.dumps(supportTeam))
+    auditCallState(callId, "hangup", "False")
     payload = {
         "play": MEDIA_URL + "/ivr/ringer_tillbaka_support.mp3",
         "skippable": "true",
@@ -783,60 +920,48 @@ def support():
 
 @app.route("/api/callSupport/<int:helperIndex>/<string:supportCallId>/<string:supportPhone>", methods=["POST"])
 def callSupport(helperIndex, supportCallId, supportPhone):
-    stopCalling = readCallHistory(DATABASE, DATABASE_KEY, supportCallId, "hangup")
-    if stopCalling == "True":
+    status, supportMemberPhone = CALL_STATE.claimHelper(supportCallId, helperIndex)
+    if status == EXHAUSTED:
+        auditCallState(supportCallId, "hangup", "True")
+        return redirect(url_for("callBackToSupportCustomer", supportPhone=supportPhone))
+    elif status != CALL:
         return ""
-    else:
-        print("supportTeamIndex:", helperIndex)
-
-        print("Support customer callId: ", supportCallId)
-
-        supportTeamList = json.loads(readCallHistory(DATABASE, DATABASE_KEY, supportCallId, "closest_helpers"))
-        print("closest helpers: ", supportTeamList)
 
-        auth = (API_USERNAME, API_PASSWORD)
+    print("supportTeamIndex:", helperIndex)
+    print("Support customer callId: ", supportCallId)
 
-        if helperIndex >= len(supportTeamList):
-            writeCallHistory(DATABASE, DATABASE_KEY, supportCallId, "hangup", "True")
-            return redirect(url_for("callBackToSupportCustomer", supportPhone=supportPhone))
+    print(ELK_NUMBER)
 
-        print(supportTeamList[helperIndex])
-        print(ELK_NUMBER)
-
-        # TODO: Handle if call is not picked up
-        payload = {
-            "ivr": MEDIA_URL + "/ivr/hjalte_support.mp3",
-            "timeout": "30",
-            "1": BASE_URL + "/api/connectUsersSupport/%s/%s" % (supportPhone, supportCallId),
-            "2": BASE_URL + "/api/callSupport/%s/%s/%s" % (str(helperIndex + 1), supportCallId, supportPhone),
-            "next": BASE_URL
-            + "/api/callSupport/%s/%s/%s" % (str(helperIndex + 1), supportCallId, supportPhone),
-        }
-
-        print("Calling: ", supportTeamList[helperIndex])
-        fields = {
-            "from": ELK_NUMBER,
-            "to": supportTeamList[helperIndex],
-            "voice_start": json.dumps(payload),
-            "whenhangup": BASE_URL
-            + "/api/callSupport/%s/%s/%s" % (str(helperIndex + 1), supportCallId, supportPhone),
-        }
+    # TODO: Handle if call is not picked up
+    payload = {
+        "ivr": MEDIA_URL + "/ivr/hjalte_support.mp3",
+        "timeout": "30",
+        "1": BASE_URL + "/api/connectUsersSupport/%s/%s" % (supportPhone, supportCallId),
+        "2": BASE_URL + "/api/callSupport/%s/%s/%s" % (str(helperIndex + 1), supportCallId, supportPhone),
+        "next": BASE_URL + "/api/callSupport/%s/%s/%s" % (str(helperIndex + 1), supportCallId, supportPhone),
+    }
 
-        response = requests.post(ELK_BASE + "/a1/calls", data=fields, auth=auth)
+    print("Calling: ", supportMemberPhone)
+    fields = {
+        "from": ELK_NUMBER,
+        "to": supportMemberPhone,
+        "voice_start": json.dumps(payload),
+        "whenhangup": BASE_URL
+        + "/api/callSupport/%s/%s/%s" % (str(helperIndex + 1), supportCallId, supportPhone),
+    }
 
-        print(response.text)
-        return ""
+    ELKS.placeCall(fields)
+    return ""
 
 
 @app.route("/api/callBackToSupportCustomer/<string:supportPhone>", methods=["POST", "GET"])
 def callBackToSupportCustomer(supportPhone):
     print("No support team person found")
-    auth = (API_USERNAME, API_PASSWORD)
     payload = {"play": MEDIA_URL + "/ivr/ingen_hittad_support.mp3"}
 
     fields = {"from": ELK_NUMBER, "to": supportPhone, "voice_start": json.dumps(payload)}
 
-    requests.post(ELK_BASE + "/a1/calls", data=fields, auth=auth)
+    ELKS.placeCall(fields)
     return ""
 
 
@@ -845,7 +970,8 @@ def connectUsersSupport(customerPhone, customerCallId):
     helperPhone = request.form.get("to")
     print("support from: ", helperPhone)
 
-    writeCallHistory(DATABASE, DATABASE_KEY, customerCallId, "hangup", "True")
+    CALL_STATE.hangup(customerCallId)
+    auditCallState(customerCallId, "hangup", "True")
     print("Connecting users")
     print("customer:", customerPhone)
     payload = {"connect": customerPhone, "callerid": ELK_NUMBER, "timeout": "15"}
@@ -0,0 +1,201 @@
+"""Concurrent, rate limited SMS broadcasts that can be resumed after a crash.
+
+Messages are sent by a few threads at once while a token bucket keeps the overall
+rate within the 46elks quota (BROADCAST_RATE messages per second, bursts of up to
+BROADCAST_BURST). Every number is written to a checkpoint file before and after
+its request, so a broadcast resumed from its checkpoint skips everyone who was
+reached. Numbers whose request was cut off (crash, timeout, 5xx) may or may not
+have received the message; they are skipped as well rather than risk a double
+send. Only numbers known not to have been sent to are tried again.
+
+Every broadcast starts with a checkpoint of its own and is only resumed when its
+checkpoint is given explicitly. A checkpoint belongs to one message and is renamed
+to <checkpoint>.done once everyone has been sent to.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .lazyImport import LazyModule
+from .rateLimit import TokenBucket
+
+requests = LazyModule("requests")
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 10))  # Messages per second, keep within the account quota
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", 10))  # Messages that may be sent at once after a pause
+BROADCAST_WORKERS = 8  # Requests in flight at the same time
+REPORT_INTERVAL = 10.0  # Seconds between progress reports
+RATE_LIMITED_RETRIES = 3  # Attempts after 46elks answers 429 Too Many Requests
+SENDER = "Telehelp"
+
+PHONE_PATTERN = re.compile(r"^\+46[0-9]{9}$")  # Swedish +46ddddddddd mobile phone number format
+
+# Checkpoint statuses
+MESSAGE = "message"  # First line, digest of the message the checkpoint belongs to
+SENDING = "sending"  # Request started
+SENT = "sent"
+FAILED = "failed"  # Known not to have been sent, tried again on resume
+UNKNOWN = "unknown"  # May have been sent, not tried again
+
+
+class BroadcastCheckpoint:
+    """Append-only file of "<status>\\t<number>" lines, after a "message\\t<digest>" line."""
+
+    def __init__(self, path, message):
+        self.path = path
+        self.done = set()  # Numbers not to send to again
+        digest = messageDigest(message)
+        isNew = not os.path.isfile(path) or os.path.getsize(path) == 0
+        if not isNew:
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    status, _, number = line.rstrip("\n").partition("\t")
+                    if status == MESSAGE:
+                        if number != digest:
+                            raise ValueError(f"{path} is the checkpoint of a broadcast of another message")
+                    elif status == FAILED:
+                        self.done.discard(number)
+                    else:
+                        self.done.add(number)
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        if isNew:
+            self.mark(digest, MESSAGE)
+
+    def mark(self, number, status):
+        with self._lock:
+            self._file.write(f"{status}\t{number}\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    # Closes the checkpoint of a broadcast that reached everyone, renamed so it is kept but can't be resumed
+    # Output: the new path
+    def finish(self):
+        self.close()
+        finished = self.path + ".done"
+        os.replace(self.path, finished)
+        return finished
+
+
+def messageDigest(message):
+    return hashlib.sha1(message.encode("utf-8")).hexdigest()
+
+
+# Output: checkpoint file of a new broadcast of message, one that no earlier broadcast has used
+def newCheckpointPath(message):
+    prefix = f"broadcast-{time.strftime('%Y%m%d-%H%M%S')}-{messageDigest(message)[:12]}"
+    path, n = f"{prefix}.checkpoint", 1
+    while os.path.exists(path) or os.path.exists(path + ".done"):
+        n += 1
+        path = f"{prefix}-{n}.checkpoint"
+    return path
+
+
+class BroadcastStats:
+    def __init__(self):
+        self.counts = {SENT: 0, FAILED: 0, UNKNOWN: 0, "invalid": 0, "resumed": 0}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def report(self, total=None):
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            counts = dict(self.counts)
+        rate = counts[SENT] / elapsed if elapsed > 0 else 0.0
+        progress = f"{sum(counts.values())}/{total}" if total is not None else f"{sum(counts.values())}"
+        return (
+            f"{progress} handled in {elapsed:.0f} s ({rate:.1f} msg/s): {counts[SENT]} sent, "
+            f"{counts[FAILED]} failed, {counts[UNKNOWN]} unknown, {counts['invalid']} invalid, "
+            f"{counts['resumed']} already done"
+        )
+
+
+class SmsBroadcast:
+    def __init__(
+        self,
+        elks,
+        message,
+        checkpoint,
+        rate=BROADCAST_RATE,
+        burst=BROADCAST_BURST,
+        workers=BROADCAST_WORKERS,
+        reportInterval=REPORT_INTERVAL,
+        sender=SENDER,
+    ):
+        self.elks = elks
+        self.message = message
+        self.checkpoint = checkpoint
+        self.bucket = TokenBucket(rate, burst)
+        self.workers = workers
+        self.reportInterval = reportInterval
+        self.sender = sender
+        self.stats = BroadcastStats()
+
+    def _send(self, number):
+        self.checkpoint.mark(number, SENDING)
+        fields = {"from": self.sender, "to": number, "message": self.message}
+        for attempt in range(RATE_LIMITED_RETRIES + 1):
+            self.bucket.acquire()
+            try:
+                response = self.elks.sendSms(fields, wait=True)
+            except requests.ConnectionError as err:
+                # Never reached 46elks
+                print(f"Failed to send to {number}: {err}")
+                return FAILED
+            except requests.RequestException as err:
+                print(f"Unknown whether {number} was sent to: {err}")
+                return UNKNOWN
+            if response.status_code == 429 and attempt < RATE_LIMITED_RETRIES:
+                time.sleep(2 ** attempt)
+                continue
+            if response.status_code < 400:
+                return SENT
+            print(f"Failed to send to {number}: {response.status_code} {response.text}")
+            return UNKNOWN if response.status_code >= 500 else FAILED
+
+    def _sendAndRecord(self, number):
+        try:
+            outcome = self._send(number)
+        except Exception as err:
+            print(f"Unknown whether {number} was sent to: {err}")
+            outcome = UNKNOWN
+        self.checkpoint.mark(number, outcome)
+        self.stats.add(outcome)
+
+    def _reportUntil(self, finished, total):
+        while not finished.wait(self.reportInterval):
+            print(self.stats.report(total))
+
+    # Input: iterable of phone numbers, may be a generator. Numbers are pulled as workers become free.
+    # Output: BroadcastStats of the run
+    def run(self, numbers, total=None):
+        finished = threading.Event()
+        reporter = threading.Thread(target=self._reportUntil, args=(finished, total), daemon=True)
+        reporter.start()
+        inFlight = threading.BoundedSemaphore(self.workers * 2)  # Don't read ahead of the senders
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="broadcast") as executor:
+            for number in numbers:
+                number = str(number)
+                if not PHONE_PATTERN.match(number):
+                    print(f"Skipping {number}: does not match expected +46ddddddddd format")
+                    self.stats.add("invalid")
+                elif number in self.checkpoint.done:
+                    self.stats.add("resumed")
+                else:
+                    self.checkpoint.done.add(number)  # The same number twice in the input gets one message
+                    inFlight.acquire()
+                    future = executor.submit(self._sendAndRecord, number)
+                    future.add_done_callback(lambda _: inFlight.release())
+        finished.set()
+        reporter.join()
+        print(self.stats.report(total))
+        return self.stats
@@ -0,0 +1,162 @@
+"""Per-call state of the helper and support dial chains.
+
+While a customer waits to be called back, every hop of /api/call/<helperIndex>/...
+needs the call's candidate list, how far down the list the chain has come
+(the cursor) and whether the call has been answered or given up (hangup).
+This state lives in a store with a TTL instead of the call_variables table:
+
+- InMemoryCallStateStore, for a single process (development, tests)
+- RedisCallStateStore, shared between gunicorn workers. Redis is already
+  required by Flask-Session.
+
+All operations that read and then modify the state are atomic.
+"""
+import json
+import os
+import threading
+import time
+
+from .lazyImport import LazyModule
+
+redis = LazyModule("redis")
+
+CALL_STATE_TTL = 60 * 60  # Seconds a call's state is kept after it was last started
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Outcomes of claimHelper
+CALL = "call"  # Go ahead and call the returned helper
+HUNG_UP = "hung_up"  # The call has been answered or given up, stop calling
+EXHAUSTED = "exhausted"  # No helpers left, the call is now marked as hung up
+DUPLICATE = "duplicate"  # This index has already been claimed, e.g. by both "next" and "whenhangup"
+MISSING = "missing"  # No state for the call, it was never started or has expired
+
+
+class InMemoryCallStateStore:
+    def __init__(self, ttl=CALL_STATE_TTL):
+        self.ttl = ttl
+        self._calls = {}  # callid -> {"helpers": [...], "cursor": int, "hangup": bool, "expires": float}
+        self._lock = threading.Lock()
+        self._nextSweep = time.monotonic() + ttl
+
+    def _get(self, callid):
+        now = time.monotonic()
+        if now > self._nextSweep:
+            self._calls = {k: v for k, v in self._calls.items() if v["expires"] > now}
+            self._nextSweep = now + self.ttl
+        state = self._calls.get(callid)
+        if state is not None and state["expires"] <= now:
+            del self._calls[callid]
+            return None
+        return state
+
+    def startCall(self, callid, helpers):
+        with self._lock:
+            self._get(callid)
+            expires = time.monotonic() + self.ttl
+            self._calls[callid] = {"helpers": list(helpers), "cursor": 0, "hangup": False, "expires": expires}
+
+    def getHelpers(self, callid):
+        with self._lock:
+            state = self._get(callid)
+            return None if state is None else list(state["helpers"])
+
+    def isHungUp(self, callid):
+        with self._lock:
+            state = self._get(callid)
+            return state is None or state["hangup"]
+
+    # Marks the call as hung up
+    # Output: whether it already was (or has no state)
+    def hangup(self, callid):
+        with self._lock:
+            state = self._get(callid)
+            if state is None:
+                return True
+            wasHungUp, state["hangup"] = state["hangup"], True
+            return wasHungUp
+
+    # Input: index in the candidate list the dial chain wants to call next
+    # Output: (one of CALL, HUNG_UP, EXHAUSTED, DUPLICATE, MISSING, helper phone if CALL else None)
+    def claimHelper(self, callid, index):
+        with self._lock:
+            state = self._get(callid)
+            if state is None:
+                return MISSING, None
+            if state["hangup"]:
+                return HUNG_UP, None
+            if index < state["cursor"]:
+                return DUPLICATE, None
+            if index >= len(state["helpers"]):
+                state["hangup"] = True
+                return EXHAUSTED, None
+            state["cursor"] = index + 1
+            return CALL, state["helpers"][index]
+
+
+# Same decisions as InMemoryCallStateStore.claimHelper, run inside Redis so that concurrent hops can't race
+_CLAIM_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'helpers', 'cursor', 'hangup')
+if not state[1] then return {'missing', false} end
+if state[3] == '1' then return {'hung_up', false} end
+local index = tonumber(ARGV[1])
+if index < tonumber(state[2]) then return {'duplicate', false} end
+local helpers = cjson.decode(state[1])
+if index >= #helpers then
+    redis.call('HSET', KEYS[1], 'hangup', '1')
+    return {'exhausted', false}
+end
+redis.call('HSET', KEYS[1], 'cursor', index + 1)
+return {'call', helpers[index + 1]}
+"""
+
+_HANGUP_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 1 end
+local previous = redis.call('HGET', KEYS[1], 'hangup')
+redis.call('HSET', KEYS[1], 'hangup', '1')
+if previous == '1' then return 1 end
+return 0
+"""
+
+
+class RedisCallStateStore:
+    def __init__(self, client=None, ttl=CALL_STATE_TTL, prefix="callstate:"):
+        self.client = client if client is not None else redis.Redis.from_url(REDIS_URL)
+        self.ttl = ttl
+        self.prefix = prefix
+        self._claim = self.client.register_script(_CLAIM_SCRIPT)
+        self._hangup = self.client.register_script(_HANGUP_SCRIPT)
+
+    def _key(self, callid):
+        return self.prefix + callid
+
+    def startCall(self, callid, helpers):
+        key = self._key(callid)
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping={"helpers": json.dumps(list(helpers)), "cursor": 0, "hangup": "0"})
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def getHelpers(self, callid):
+        helpers = self.client.hget(self._key(callid), "helpers")
+        return None if helpers is None else json.loads(helpers)
+
+    def isHungUp(self, callid):
+        return self.client.hget(self._key(callid), "hangup") in (None, b"1")
+
+    def hangup(self, callid):
+        return bool(self._hangup(keys=[self._key(callid)]))
+
+    def claimHelper(self, callid, index):
+        status, phone = self._claim(keys=[self._key(callid)], args=[index])
+        return status.decode(), phone.decode() if phone else None
+
+
+# Input: "memory" or "redis", defaults to the CALL_STATE_BACKEND environment variable (redis if unset)
+def createCallStateStore(backend=None):
+    backend = backend or os.getenv("CALL_STATE_BACKEND", "redis")
+    if backend == "memory":
+        return InMemoryCallStateStore()
+    elif backend == "redis":
+        return RedisCallStateStore()
+    raise ValueError(f"Unknown call state backend: {backend}")
@@ -1,29 +1,112 @@
 import json
 import os
 import re
+import threading
+import time
+import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from .text2speech_utils import text_input
+
+URL_CACHE_TTL = 10 * 60  # Seconds a checked URL's status is trusted before it is checked again
+CHECK_TIMEOUT = 5  # Seconds before a media URL check is given up
+CHECK_WORKERS = 4
+
+_statusCache = {}  # url -> (status code or None if unreachable, time checked)
+_pending = {}  # url -> future of a check in progress
+_cacheLock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=CHECK_WORKERS, thread_name_prefix="checkMedia")
+
+
+def _warn(message, log=None):
+    print(f"Warning {message}")
+    if log is not None:
+        log.warning(message)
 
 
 def checkURL(url, log=None):
     try:
-        code = urllib.request.urlopen(url).getcode()
+        request = urllib.request.Request(url, method="HEAD")
+        code = urllib.request.urlopen(request, timeout=CHECK_TIMEOUT).getcode()
         # print("Path found")
-        return code
     except urllib.error.HTTPError as e:
-        print(f"Warning can't find path: {url}. Status {e.code} {e.reason}")
-        if log is not None:
-            log.warning(f"Can't find path: {url}. Status {e.code} {e.reason}")
-        return e.code
+        _warn(f"Can't find path: {url}. Status {e.code} {e.reason}", log)
+        code = e.code
+    except (urllib.error.URLError, OSError) as e:
+        _warn(f"Can't reach path: {url}. {e}", log)
+        code = None
+    with _cacheLock:
+        _statusCache[url] = (code, time.monotonic())
+    return code
+
+
+# Output: last known status of the url, or None if it has not been checked within URL_CACHE_TTL
+def cachedStatus(url):
+    entry = _statusCache.get(url)
+    if entry is None or time.monotonic() - entry[1] > URL_CACHE_TTL:
+        return None
+    return entry
+
+
+def _finishCheck(url, log):
+    try:
+        return checkURL(url, log=log)
+    finally:
+        with _cacheLock:
+            _pending.pop(url, None)
+
+
+# Checks the url off the request path. Known bad urls are warned about right away, unknown or expired
+# ones are queued for a background check that warns once it has an answer.
+# Output: future of the check, None if the cached status was used
+def checkURLAsync(url, log=None):
+    entry = cachedStatus(url)
+    if entry is not None:
+        code = entry[0]
+        if code is None or code >= 400:
+            _warn(f"Can't find path: {url}. Status {code} (cached)", log)
+        return None
+    with _cacheLock:
+        future = _pending.get(url)
+        if future is None:
+            future = _pending[url] = _executor.submit(_finishCheck, url, log)
+    return future
 
 
+# Checks every media url (containing key_word) in the payload without blocking the response
 def checkPayload(payload, key_word, log=None):
     for key in payload.keys():
         if isinstance(payload[key], str):
             # print(payload[key])
             if key_word in payload[key]:
-                checkURL(payload[key], log=log)
+                checkURLAsync(payload[key], log=log)
         elif isinstance(payload[key], dict):
-            checkPayload(payload[key], key_word)
+            checkPayload(payload[key], key_word, log=log)
+
+
+# Input: base media url and the cities that have prompts (e.g. the values of the city dictionary)
+# Output: urls of all text_input IVR prompts and city prompts
+def knownMediaUrls(media_url, cities):
+    urls = [f"{media_url}/ivr/{key}.mp3" for key in text_input]
+    urls += [f"{media_url}/city/{urllib.parse.quote(city)}.mp3" for city in sorted(set(cities))]
+    return urls
+
+
+# Checks all urls concurrently, e.g. every known prompt once at startup, and fills the status cache
+# Output: {url: status} of the urls that could not be found (None if unreachable), when waiting for the result
+def checkAllURLs(urls, log=None, wait_for_result=True):
+    futures = [checkURLAsync(url, log=log) for url in urls]
+    if not wait_for_result:
+        return None
+    wait([future for future in futures if future is not None])
+    failed = {}
+    for url in urls:
+        code = _statusCache[url][0]
+        if code is None or code >= 400:
+            failed[url] = code
+    return failed
 
 
 if __name__ == "__main__":
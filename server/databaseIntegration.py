@@ -1,9 +1,27 @@
+import atexit
 import os
+import queue
 import random
+import threading
+import time
+from contextlib import contextmanager
 
-import pandas as pd
 from pysqlcipher3 import dbapi2 as sqlite3
 
+from .analyticsWriter import AnalyticsWriter
+from .analyticsWriter import registerAnalyticsWriter
+from .databaseWriter import beginUnitOfWork
+from .databaseWriter import currentUnitOfWork
+from .databaseWriter import DatabaseWriter
+from .databaseWriter import registerDatabaseWriter
+from .helperIndex import existingHelperIndex
+from .helperIndex import getHelperIndex
+from .lazyImport import LazyModule
+from .migrations import migrate
+from .scheduler import JobScheduler
+from .scheduler import registerScheduler
+from .scheduler import SqliteJobStore
+from .volunteerLocations import SqliteVolunteerCounts
 from .zipcode_utils import getDistanceApart
 from .zipcode_utils import getDistrict
 from .zipcode_utils import readZipCodeData
@@ -11,62 +29,284 @@ from .zipcode_utils import readZipCodeData
 # from dotenv import load_dotenv
 # load_dotenv()
 
+pd = LazyModule("pandas")
 
-def create_connection(db_file, key):
+POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 8))  # Idle connections kept open per database
+POOL_MAX_IDLE = 30  # Seconds a connection may sit idle before it is health checked on checkout
+CHUNK_SIZE = 1000  # Rows fetched per query by iterateDatabase
+# In WAL mode only checkpoints sync to disk: a power cut may lose the last commits but never corrupts the file
+SYNCHRONOUS = "NORMAL"
+JOURNAL_SIZE_LIMIT = 64 * 2 ** 20  # Bytes the WAL file is truncated to after a checkpoint
+BUSY_TIMEOUT_MS = 10000  # Time a statement waits for a lock held by another process
+
+
+def create_connection(db_file, key, check_same_thread=True):
     """create a database connection to the SQLite database
         specified by the db_file
     :param db_file: database file
+    :param check_same_thread: set to False for connections shared between threads (see ConnectionPool)
     :return: Connection object or None
     """
     conn = None
-    conn = sqlite3.connect(db_file)
+    conn = sqlite3.connect(db_file, check_same_thread=check_same_thread)
     cursor = conn.cursor()
     cursor.execute("PRAGMA key = \"x'" + key + "'\"")
 
     return conn, cursor
 
 
+# Readers don't wait for the writer and vice versa, see databaseWriter
+def configureConnection(conn):
+    # Persistent in the database file, the first connection switches it over
+    conn.execute("PRAGMA journal_mode=WAL").fetchall()
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+    conn.execute(f"PRAGMA journal_size_limit={JOURNAL_SIZE_LIMIT}")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+
+
+# Output: keyed and configured connection that may be used from any thread, one at a time
+def openConnection(db_file, key):
+    conn, cursor = create_connection(db_file, key, check_same_thread=False)
+    cursor.close()
+    configureConnection(conn)
+    return conn
+
+
+class ConnectionPool:
+    """Keeps keyed connections to one database open between queries.
+
+    Running PRAGMA key (and the key derivation it triggers) is the expensive part of
+    opening a SQLCipher connection, so every connection is keyed once and then reused.
+    A connection is only ever used by one thread at a time; idle connections are
+    health checked before they are handed out again.
+    """
+
+    def __init__(self, db_file, key, size=POOL_SIZE, maxIdle=POOL_MAX_IDLE):
+        self.db_file = db_file
+        self.key = key
+        self.maxIdle = maxIdle
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._closed = False
+
+    def _connect(self):
+        return openConnection(self.db_file, self.key)
+
+    def _isHealthy(self, conn):
+        try:
+            # Touches the database file, which also verifies that the key is still valid
+            conn.execute("SELECT count(*) FROM sqlite_master").fetchall()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _acquire(self):
+        while True:
+            try:
+                conn, lastUsed = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - lastUsed < self.maxIdle or self._isHealthy(conn):
+                return conn
+            conn.close()
+
+    def _release(self, conn):
+        if self._closed:
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            # The connection may be mid-transaction or broken, don't hand it out again
+            conn.close()
+            raise
+        else:
+            if conn.in_transaction:
+                conn.rollback()
+            self._release(conn)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+
+def getPool(db, key):
+    with _poolsLock:
+        pool = _pools.get((db, key))
+        if pool is None:
+            pool = _pools[(db, key)] = ConnectionPool(db, key)
+        return pool
+
+
+@atexit.register
+def closeAllPools():
+    with _poolsLock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+# Brings the database to the current schema, see migrations
+# Output: schema version of the database
+def migrateDatabase(db, key):
+    with getPool(db, key).connection() as conn:
+        return migrate(conn)
+
+
+_databaseWriters = {}
+_databaseWritersLock = threading.Lock()
+
+
+# Output: the process' writer thread of the database, see databaseWriter
+def getDatabaseWriter(db, key):
+    with _databaseWritersLock:
+        writer = _databaseWriters.get((db, key))
+        if writer is None:
+            writer = DatabaseWriter(lambda: openConnection(db, key))
+            _databaseWriters[(db, key)] = registerDatabaseWriter(writer)
+        return writer
+
+
+_queryListeners = []
+
+
+# Input: function called as listener(query, params, seconds) after every statement run by the functions below,
+#        including fetching its rows, and as listener("COMMIT", (), seconds) after every commit. Writes are
+#        reported once committed, in the thread that asked for them.
+def addQueryListener(listener):
+    _queryListeners.append(listener)
+
+
+def _notifyQueryListeners(query, params, seconds):
+    for listener in _queryListeners:
+        try:
+            listener(query, params or (), seconds)
+        except Exception as err:
+            print(f"Query listener failed: {err}")
+
+
+@contextmanager
+def timedQuery(query, params=None):
+    if not _queryListeners:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _notifyQueryListeners(query, params, time.perf_counter() - start)
+
+
 def fetchData(db, key, query, params=None):
-    conn, cursor = create_connection(db, key)
-    if params is None:
-        execute = cursor.execute(query)
-    else:
-        execute = cursor.execute(query, params)
-    data = cursor.fetchall()
-    cols = [column[0] for column in execute.description]
+    with getPool(db, key).connection() as conn:
+        cursor = conn.cursor()
+        with timedQuery(query, params):
+            if params is None:
+                execute = cursor.execute(query)
+            else:
+                execute = cursor.execute(query, params)
+            data = cursor.fetchall()
+        cols = [column[0] for column in execute.description]
     data = pd.DataFrame(data=data, columns=cols)
-    conn.close()
     return data
 
 
 def writeToDatabase(db, key, query, params):
     # try:
-    print("Connecting")
-    conn, cursor = create_connection(db, key)
-    cursor.execute(query, params)
-    conn.commit()
-    conn.close()
+    writeBatchToDatabase(db, key, [(query, params)])
     return "Success"
     # except Exception as err:
     # 	print(err)
     # 	return 'Failure'
 
 
+# Executes all (query, params) statements in one transaction, committed by the database's writer thread
+# together with the writes of other requests. Inside a unit of work they are only queued.
+def writeBatchToDatabase(db, key, statements):
+    unit = currentUnitOfWork((db, key))
+    if unit is not None:
+        unit.add(statements)
+        return "Success"
+    for query, params, seconds in getDatabaseWriter(db, key).write(statements):
+        _notifyQueryListeners(query, params, seconds)
+    return "Success"
+
+
+# Writes made through the functions of this module inside the block are queued and committed in one
+# transaction when it ends, or dropped if it raises:
+#
+#     with unitOfWork(DATABASE, DATABASE_KEY):
+#         writeActiveCustomer(DATABASE, DATABASE_KEY, helperPhone, customerPhone)
+#         writeActiveHelper(DATABASE, DATABASE_KEY, customerPhone, helperPhone)
+#
+# Reads inside the block don't see its queued writes. Blocks inside it join it.
+def unitOfWork(db, key):
+    return beginUnitOfWork((db, key), lambda statements: writeBatchToDatabase(db, key, statements))
+
+
+# Runs function once the writes made so far are committed, at the end of the unit of work if in one
+def _afterCommit(db, key, function):
+    unit = currentUnitOfWork((db, key))
+    if unit is None:
+        function()
+    else:
+        unit.afterCommit(function)
+
+
+# Input: open connection, query selecting rowid first with "rowid > ?" as its first parameter and ending in
+#        "ORDER BY rowid LIMIT ?", the other parameters
+# Output: generator of the rows without the rowid. Reads one chunk per query, so memory use and the length
+#         of each read don't depend on the number of rows.
+def iterateDatabase(conn, query, params=(), chunkSize=CHUNK_SIZE):
+    lastRowid = -(2 ** 63)
+    while True:
+        chunkParams = (lastRowid, *params, chunkSize)
+        with timedQuery(query, chunkParams):
+            rows = conn.execute(query, chunkParams).fetchall()
+        for row in rows:
+            yield row[1:]
+        if len(rows) < chunkSize:
+            return
+        lastRowid = rows[-1][0]
+
+
 def readDatabase(db, key, query, params=None):
     # try:
-    conn, cursor = create_connection(db, key)
-    if params is None:
-        cursor.execute(query)
-    else:
-        cursor.execute(query, params)
-    res = cursor.fetchall()
-    conn.close()
+    with getPool(db, key).connection() as conn:
+        cursor = conn.cursor()
+        with timedQuery(query, params):
+            if params is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(query, params)
+            res = cursor.fetchall()
     return res
     # except Exception as err:
     # 	print(Exception, err)
     # 	return 'Failure'
 
 
+# Output: rows of the EXPLAIN QUERY PLAN of query, the last column describing each step
+def explainQuery(db, key, query, params=None):
+    return readDatabase(db, key, "EXPLAIN QUERY PLAN " + query, params)
+
+
 def readZipcodeFromDatabase(db, key, phone, userType):
     if userType == "customer":
         query = """ SELECT zipcode FROM user_customers where phone=? """
@@ -87,21 +327,28 @@ def saveHelperToDatabase(db, key, name, phone, zipcode, district, timestr):
                                     values(?, ?, ?, ?, ?) """
     params = (phone, name, zipcode, district, timestr)
     flag = writeToDatabase(db, key, query, params)
+    index = existingHelperIndex(db)
+    if index is not None:
+        _afterCommit(db, key, lambda: index.add(phone, zipcode, district))
     print(flag)
     return flag
 
 
 def clearCustomerHelperPairing(db, key, helperPhone):
-    customerPhone = readActiveCustomer(db, key, helperPhone)
-    if customerPhone is not None:
-        writeActiveCustomer(db, key, helperPhone, None)
-    writeActiveHelper(db, key, customerPhone, None)
+    with unitOfWork(db, key):
+        customerPhone = readActiveCustomer(db, key, helperPhone)
+        if customerPhone is not None:
+            writeActiveCustomer(db, key, helperPhone, None)
+            writeActiveHelper(db, key, customerPhone, None)
 
 
 def writeActiveCustomer(db, key, helperPhone, customerPhone):
     query = """ UPDATE user_helpers set active_customers=? where phone=? """
     params = (customerPhone, helperPhone)
     flag = writeToDatabase(db, key, query, params)
+    index = existingHelperIndex(db)
+    if index is not None:
+        _afterCommit(db, key, lambda: index.setActiveCustomer(helperPhone, customerPhone))
     return flag
 
 
@@ -191,8 +438,15 @@ def deleteFromDatabase(db, key, phone, userType):
         return
     userParams = [phone]
     linkParams = [phone]
-    flag1 = writeToDatabase(db, key, userQuery, userParams)
-    flag2 = writeToDatabase(db, key, linkQuery, linkParams)
+    with unitOfWork(db, key):
+        flag1 = writeToDatabase(db, key, userQuery, userParams)
+        flag2 = writeToDatabase(db, key, linkQuery, linkParams)
+        index = existingHelperIndex(db)
+        if index is not None:
+            if userType == "helper":
+                _afterCommit(db, key, lambda: index.remove(phone))
+            else:
+                _afterCommit(db, key, lambda: index.releaseCustomer(phone))
     return flag1, flag2
 
 
@@ -224,45 +478,54 @@ The output list is limited to maxDist km and maxQueue numbers.
 """
 
 
+def readHelperLocations(db, key):
+    query = """SELECT phone, zipcode, district, active_customers FROM user_helpers"""
+    return readDatabase(db, key, query)
+
+
+def readAvailableHelpers(db, key, district):
+    query = """SELECT phone, zipcode FROM user_helpers WHERE district=? AND active_customers IS NULL"""
+    return readDatabase(db, key, query, [district])
+
+
+# Output: list of (district, number of helpers, number of helpers without an active customer)
+def readHelperCountsByDistrict(db, key):
+    query = """SELECT district, COUNT(*), COUNT(*) - COUNT(active_customers) FROM user_helpers
+               GROUP BY district"""
+    return readDatabase(db, key, query)
+
+
 def fetchHelper(db, key, district, zipcode, location_dict):
-    query = """SELECT * FROM user_helpers where district=?"""
-    params = [district]
-    helperData = fetchData(db, key, query, params)
-    distances = []
-    phoneNumbers = []
-    if helperData.empty:
-        print("No helpers registered in area")
+    maxDist = 20.0
+    maxQueue = 10
+
+    # The only database round trip: unpaired helpers in the district. The index supplies the geometry
+    # and learns about helpers registered by other workers since it was built.
+    available = readAvailableHelpers(db, key, district)
+    if not available:
+        print("No unassigned helpers available in area")
         return None
-    for i in range(len(helperData)):
-        phoneNumbers.append(helperData.loc[i, "phone"])
-        # In the case that multiple helpers live in the same postal code, add noise to randomize calling order
-        noisyDistance = (
-            getDistanceApart(zipcode, helperData.loc[i, "zipcode"], location_dict) + random.random()
-        )
-        distances.append(noisyDistance)
-    zipped = list(zip(phoneNumbers, distances))
-    zipped.sort(key=lambda t: t[1])
+    index = getHelperIndex(db, lambda: readHelperLocations(db, key), location_dict)
+    for number, helperZipcode in available:
+        if number not in index:
+            index.add(number, helperZipcode, district)
+
+    # The noise below only adds distance, so searching maxDist finds every helper that can pass the cut-off.
+    # In the case that multiple helpers live in the same postal code, it randomizes calling order.
+    nearby = index.nearest(zipcode, maxDist, district=district, available={number for number, _ in available})
+    candidates = [(number, distance + random.random()) for number, distance in nearby]
+    candidates.sort(key=lambda t: t[1])
 
     # Filter out numbers that are less than maxDist km from caller, and call up to maxQueue numbers
-    maxDist = 20.0
-    maxQueue = 10
-    sortedNumbersFinal = []
-    sortedDistancesFinal = []
-
-    for number, distance in zipped:
-        if (distance <= maxDist) and (readActiveCustomer(db, key, number) is None):
-            sortedNumbersFinal.append(number)
-            sortedDistancesFinal.append(distance)
-
-    sortedDistancesFinal = sortedDistancesFinal[:maxQueue]
-    sortedNumbersFinal = sortedNumbersFinal[:maxQueue]
-    print(list(sortedDistancesFinal))
-    print(list(sortedNumbersFinal))
+    closest = [(number, distance) for number, distance in candidates if distance <= maxDist][:maxQueue]
+    sortedNumbersFinal = [number for number, _ in closest]
+    print([distance for _, distance in closest])
+    print(sortedNumbersFinal)
     if len(sortedNumbersFinal) == 0:
         print("No unassigned helpers available in area")
         return None
 
-    return list(sortedNumbersFinal)
+    return sortedNumbersFinal
 
 
 def readCallHistory(db, key, callid, columnName):
@@ -303,56 +566,57 @@ def createNewCallHistory(db, key, callid):
         writeToDatabase(db, key, query, params)
 
 
-def writeCustomerAnalytics(db, key, telehelp_callid, columns, params):
+_analyticsWriters = {}
+_analyticsWritersLock = threading.Lock()
 
-    if not callExists(db, key, telehelp_callid, "call_analytics_customer"):
-        columnStr = "(" + ",".join(columns) + ")"
-        valuesStr = "values(" + "?," * (len(columns) - 1) + "?)"
 
-        query = """ INSERT INTO call_analytics_customer %s %s """ % (columnStr, valuesStr)
+def getAnalyticsWriter(db, key):
+    with _analyticsWritersLock:
+        writer = _analyticsWriters.get((db, key))
+        if writer is None:
+            # The upserts rely on the unique telehelp_callid indexes made by migrateDatabase
+            writer = AnalyticsWriter(lambda statements: writeBatchToDatabase(db, key, statements))
+            _analyticsWriters[(db, key)] = registerAnalyticsWriter(writer)
+        return writer
 
-        print(query)
-        print(params)
 
-    else:
-        columnStr = ""
-        for i in range(len(columns) - 1):
-            columnStr += columns[i] + "=?,"
-        columnStr += columns[-1] + "=?"
-        query = """ UPDATE call_analytics_customer SET %s
-                        where telehelp_callid=?""" % (
-            columnStr
-        )
-        print(query)
-        print(params)
+# Queues analytics for the call, written in the background by an AnalyticsWriter.
+# params holds the values of columns, optionally followed by telehelp_callid (as for an UPDATE).
+def writeAnalytics(db, key, tableName, telehelp_callid, columns, params):
+    values = dict(zip(columns, params))
+    values.pop("telehelp_callid", None)
+    if values:
+        getAnalyticsWriter(db, key).record(tableName, telehelp_callid, values)
 
-    writeToDatabase(db, key, query, params)
+
+def writeCustomerAnalytics(db, key, telehelp_callid, columns, params):
+    writeAnalytics(db, key, "call_analytics_customer", telehelp_callid, columns, params)
 
 
 def writeHelperAnalytics(db, key, telehelp_callid, columns, params):
+    writeAnalytics(db, key, "call_analytics_helper", telehelp_callid, columns, params)
 
-    if not callExists(db, key, telehelp_callid, "call_analytics_helper"):
-        columnStr = "(" + ",".join(columns) + ")"
-        valuesStr = "values(" + "?," * (len(columns) - 1) + "?)"
 
-        query = """ INSERT INTO call_analytics_helper %s %s """ % (columnStr, valuesStr)
+_jobSchedulers = {}
+_jobSchedulersLock = threading.Lock()
 
-        print(query)
-        print(params)
 
-    else:
-        columnStr = ""
-        for i in range(len(columns) - 1):
-            columnStr += columns[i] + "=?,"
-        columnStr += columns[-1] + "=?"
-        query = """ UPDATE call_analytics_helper SET %s
-                        where telehelp_callid=?""" % (
-            columnStr
-        )
-        print(query)
-        print(params)
+# Output: the scheduler running delayed jobs stored in the database's scheduled_jobs table
+def getJobScheduler(db, key):
+    with _jobSchedulersLock:
+        scheduler = _jobSchedulers.get((db, key))
+        if scheduler is None:
+            store = SqliteJobStore(
+                lambda: getPool(db, key).connection(),
+                lambda statements: writeBatchToDatabase(db, key, statements),
+            )
+            scheduler = _jobSchedulers[(db, key)] = registerScheduler(JobScheduler(store))
+        return scheduler
 
-    writeToDatabase(db, key, query, params)
+
+# Output: the database's per-zipcode helper counts, see volunteerLocations
+def getVolunteerCounts(db, key):
+    return SqliteVolunteerCounts(lambda: getPool(db, key).connection())
 
 
 if __name__ == "__main__":
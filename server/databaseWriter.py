@@ -0,0 +1,222 @@
+"""One writer thread per database and process, committing queued writes in groups.
+
+SQLite has a single write lock per database. Every request committing on a
+connection of its own makes concurrent webhooks queue for that lock, and each
+commit pays for a sync to disk. Instead, requests hand their statements to the
+DatabaseWriter of the database and wait until they are committed. The writer
+thread takes everything queued since its last commit and writes it in one
+transaction, each request in a savepoint of its own: a request whose statement
+fails is rolled back alone and gets the error, the others commit together.
+
+With the database in WAL mode readers are not blocked by the writer, and the
+writer checkpoints the WAL itself, between groups and at most every
+CHECKPOINT_INTERVAL seconds, instead of in the middle of a commit.
+
+A request making several writes that belong together, such as pairing a
+volunteer with a customer, makes them in a unit of work: they are queued while
+the request runs and written in one transaction at its end, or not at all.
+"""
+import atexit
+import contextvars
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+MAX_GROUP = 256  # Requests committed in one transaction at most
+CHECKPOINT_INTERVAL = 1.0  # Seconds between checkpoints of the WAL while there are writes
+
+
+class DatabaseWriter:
+    def __init__(self, connect, maxGroup=MAX_GROUP, checkpointInterval=CHECKPOINT_INTERVAL):
+        self.connect = connect  # Function returning a new connection, only used by the writer
+        self.maxGroup = maxGroup
+        self.checkpointInterval = checkpointInterval
+        self.commits = 0
+        self.checkpoints = 0
+        self._queue = []  # (statements, future) waiting to be written
+        self._condition = threading.Condition()
+        self._writeLock = threading.Lock()
+        self._conn = None
+        self._uncheckpointed = False
+        self._checkpointedAt = time.monotonic()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="DatabaseWriter", daemon=True)
+        self._thread.start()
+
+    # Input: list of (query, params) written in one transaction
+    # Output: list of (query, params, seconds) of the statements and the commit, once committed.
+    #         Raises the error of a failing statement, none of the statements are then written.
+    def write(self, statements):
+        request = (list(statements), Future())
+        with self._condition:
+            closed = self._closed
+            if not closed:
+                self._queue.append(request)
+                self._condition.notify()
+        if closed:
+            # E.g. the final flush of an AnalyticsWriter at exit, written by the caller
+            self._writeGroup([request])
+        return request[1].result()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._queue and not self._closed:
+                    self._condition.wait(self.checkpointInterval if self._uncheckpointed else None)
+                group = self._queue[: self.maxGroup]
+                del self._queue[: self.maxGroup]
+                if not group and self._closed:
+                    return
+            if group:
+                self._writeGroup(group)
+            if self._uncheckpointed and time.monotonic() - self._checkpointedAt >= self.checkpointInterval:
+                self._checkpoint()
+
+    def _connection(self):
+        if self._conn is None:
+            conn = self.connect()
+            conn.isolation_level = None  # Transactions are managed here
+            conn.execute("PRAGMA wal_autocheckpoint=0")  # See _checkpoint
+            self._conn = conn
+        return self._conn
+
+    def _discardConnection(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _writeGroup(self, group):
+        with self._writeLock:
+            try:
+                conn = self._connection()
+                conn.execute("BEGIN IMMEDIATE")
+                results = [self._writeRequest(conn, statements) for statements, _ in group]
+                start = time.perf_counter()
+                conn.execute("COMMIT")
+                commitSeconds = time.perf_counter() - start
+            except Exception as err:
+                # The transaction failed as a whole, e.g. the database stayed locked by another process
+                print(f"Failed to write {len(group)} queued requests: {err}")
+                self._discardConnection()
+                for _, future in group:
+                    future.set_exception(err)
+                return
+            self.commits += 1
+            self._uncheckpointed = True
+        for (_, future), result in zip(group, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result + [("COMMIT", (), commitSeconds)])
+
+    # Output: list of (query, params, seconds), or the error of the statement that failed
+    def _writeRequest(self, conn, statements):
+        conn.execute("SAVEPOINT request")
+        timings = []
+        try:
+            for query, params in statements:
+                start = time.perf_counter()
+                conn.execute(query, params)
+                timings.append((query, params, time.perf_counter() - start))
+        except Exception as err:
+            conn.execute("ROLLBACK TO request")
+            conn.execute("RELEASE request")
+            return err
+        conn.execute("RELEASE request")
+        return timings
+
+    # Copies committed pages from the WAL into the database file. Passive, so readers and writers of other
+    # processes are never waited for; pages still in use are copied by a later checkpoint.
+    def _checkpoint(self):
+        with self._writeLock:
+            try:
+                self._connection().execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+            except Exception as err:
+                print(f"Failed to checkpoint the database: {err}")
+                self._discardConnection()
+            self.checkpoints += 1
+            self._uncheckpointed = False
+            self._checkpointedAt = time.monotonic()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        with self._writeLock:
+            self._discardConnection()
+
+
+class UnitOfWork:
+    def __init__(self, database, write):
+        self.database = database  # Identifies the database, writes to others are not part of the unit
+        self.write = write  # Function writing a list of (query, params) in one transaction
+        self.statements = []
+        self.done = False
+        self._afterCommit = []
+
+    def add(self, statements):
+        self.statements.extend(statements)
+
+    # Input: function run once the unit is committed, e.g. updating an in-memory copy of the rows
+    def afterCommit(self, function):
+        self._afterCommit.append(function)
+
+    def commit(self):
+        self.done = True
+        if self.statements:
+            self.write(self.statements)
+        for function in self._afterCommit:
+            try:
+                function()
+            except Exception as err:
+                print(f"Failed to run {function} after commit: {err}")
+
+
+_currentUnit = contextvars.ContextVar("unitOfWork", default=None)
+
+
+# Output: the unit of work of database open in this context, None if there is none
+def currentUnitOfWork(database):
+    unit = _currentUnit.get()
+    if unit is None or unit.done or unit.database != database:
+        return None
+    return unit
+
+
+# Context manager of a unit of work, committed when the block ends and dropped if it raises. A block
+# inside a unit of work of the same database joins it.
+@contextmanager
+def beginUnitOfWork(database, write):
+    unit = currentUnitOfWork(database)
+    if unit is not None:
+        yield unit
+        return
+    unit = UnitOfWork(database, write)
+    token = _currentUnit.set(unit)
+    try:
+        yield unit
+    except BaseException:
+        unit.done = True  # Nothing was written yet
+        raise
+    finally:
+        _currentUnit.reset(token)
+    unit.commit()
+
+
+_writers = []
+
+
+@atexit.register
+def closeAllDatabaseWriters():
+    while _writers:
+        _writers.pop().close()
+
+
+def registerDatabaseWriter(writer):
+    _writers.append(writer)
+    return writer
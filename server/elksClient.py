@@ -0,0 +1,141 @@
+"""Shared client for the 46elks API.
+
+One requests.Session per client, opened on the first request so importing the
+server doesn't import requests, keeps TLS connections to api.46elks.com alive
+between calls, every request has a timeout, and postAsync hands the request to a
+small thread pool so a webhook can answer 46elks without waiting for it.
+Latency and errors are counted per endpoint in ElksClient.metrics, and all
+requests are timed in the telehelp_elks_request_seconds histogram.
+"""
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .lazyImport import LazyModule
+from .metrics import Histogram
+
+requests = LazyModule("requests")
+requests_adapters = LazyModule("requests.adapters")
+
+ELK_BASE = os.getenv("ELK_BASE", "https://api.46elks.com")
+REQUEST_TIMEOUT = (3.05, 15)  # Seconds to connect, seconds to wait for the response
+POOL_SIZE = 10  # Connections kept alive
+DISPATCH_WORKERS = 4  # Threads sending postAsync requests
+
+_requestListeners = []
+
+
+# Input: function called as listener(path, seconds, error) after every request, on the thread that sent it
+def addRequestListener(listener):
+    _requestListeners.append(listener)
+
+
+def _notifyRequestListeners(path, seconds, error):
+    for listener in _requestListeners:
+        try:
+            listener(path, seconds, error)
+        except Exception as err:
+            print(f"Request listener failed: {err}")
+
+
+REQUEST_SECONDS = Histogram(
+    "telehelp_elks_request_seconds", "Duration of requests to the 46elks API", ["path", "outcome"]
+)
+
+
+class ElksMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}  # path -> {"requests", "errors", "seconds", "max_seconds"}
+
+    def record(self, path, seconds, error):
+        with self._lock:
+            stats = self._endpoints.setdefault(
+                path, {"requests": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+            stats["requests"] += 1
+            stats["errors"] += int(error)
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {path: dict(stats) for path, stats in self._endpoints.items()}
+
+
+class ElksClient:
+    def __init__(
+        self,
+        username,
+        password,
+        base=ELK_BASE,
+        timeout=REQUEST_TIMEOUT,
+        poolSize=POOL_SIZE,
+        dispatchWorkers=DISPATCH_WORKERS,
+    ):
+        self.base = base.rstrip("/")
+        self.timeout = timeout
+        self.metrics = ElksMetrics()
+        self._auth = (username, password)
+        self._poolSize = poolSize
+        self._session = None
+        self._sessionLock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=dispatchWorkers, thread_name_prefix="elks")
+
+    def _getSession(self):
+        with self._sessionLock:
+            if self._session is None:
+                session = requests.Session()
+                session.auth = self._auth
+                adapter = requests_adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self._poolSize)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    # Input: API path such as "/a1/calls", form fields
+    # Output: the response. Raises on connection errors and timeouts, HTTP errors are counted but returned.
+    def post(self, path, data):
+        start = time.perf_counter()
+        error = True
+        try:
+            response = self._getSession().post(self.base + path, data=data, timeout=self.timeout)
+            error = response.status_code >= 400
+            return response
+        finally:
+            seconds = time.perf_counter() - start
+            self.metrics.record(path, seconds, error)
+            REQUEST_SECONDS.observe(seconds, path, "error" if error else "ok")
+            _notifyRequestListeners(path, seconds, error)
+
+    # Sends the request in the background, in a copy of the caller's context (see tracing)
+    # Output: future of the response, failures are printed and the future then holds None
+    def postAsync(self, path, data):
+        return self._executor.submit(contextvars.copy_context().run, self._postLogged, path, data)
+
+    def _postLogged(self, path, data):
+        try:
+            response = self.post(path, data)
+        except requests.RequestException as err:
+            print(f"46elks request to {path} failed: {err}")
+            return None
+        if response.status_code >= 400:
+            print(f"46elks request to {path} failed: {response.status_code} {response.text}")
+        else:
+            print(response.text)
+        return response
+
+    def placeCall(self, fields, wait=False):
+        return self.post("/a1/calls", fields) if wait else self.postAsync("/a1/calls", fields)
+
+    def sendSms(self, fields, wait=False):
+        return self.post("/a1/sms", fields) if wait else self.postAsync("/a1/sms", fields)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._sessionLock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
@@ -0,0 +1,153 @@
+import math
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from .zipcode_utils import EARTH_RADIUS_KM
+from .zipcode_utils import sphericalDistances
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+CELL_SIZE_DEG = 0.2  # Grid cell side, roughly 22 km north-south
+INDEX_MAX_AGE = 5 * 60  # Rebuild from the database every 5 minutes to pick up changes made by other workers
+
+
+class HelperIndex:
+    """In-memory grid of helper locations for nearest-helper lookups.
+
+    Helpers are bucketed into CELL_SIZE_DEG x CELL_SIZE_DEG cells by the coordinates of
+    their zipcode, so a radius query only has to look at the few cells around the
+    caller instead of every helper in the district. Helpers with a zipcode missing
+    from location_dict are left out, they have no position to search by.
+    """
+
+    def __init__(self, location_dict):
+        self.location_dict = location_dict
+        self.builtAt = time.monotonic()
+        self._helpers = {}  # phone -> (lat, lon, district, active customer)
+        self._cells = defaultdict(set)  # (row, col) -> phones
+        self._lock = threading.RLock()
+
+    def _coords(self, zipcode):
+        try:
+            lat, lon = self.location_dict[int(zipcode)]
+        except (KeyError, ValueError):
+            return None
+        return float(lat), float(lon)
+
+    @staticmethod
+    def _cell(lat, lon):
+        return int(math.floor(lat / CELL_SIZE_DEG)), int(math.floor(lon / CELL_SIZE_DEG))
+
+    def __len__(self):
+        return len(self._helpers)
+
+    def __contains__(self, phone):
+        return phone in self._helpers
+
+    def add(self, phone, zipcode, district, activeCustomer=None):
+        coords = self._coords(zipcode)
+        with self._lock:
+            self.remove(phone)
+            if coords is None:
+                return
+            self._helpers[phone] = (coords[0], coords[1], district, activeCustomer)
+            self._cells[self._cell(*coords)].add(phone)
+
+    def remove(self, phone):
+        with self._lock:
+            entry = self._helpers.pop(phone, None)
+            if entry is not None:
+                cell = self._cell(entry[0], entry[1])
+                self._cells[cell].discard(phone)
+                if not self._cells[cell]:
+                    del self._cells[cell]
+
+    def setActiveCustomer(self, phone, customerPhone):
+        with self._lock:
+            entry = self._helpers.get(phone)
+            if entry is not None:
+                self._helpers[phone] = entry[:3] + (customerPhone,)
+
+    def releaseCustomer(self, customerPhone):
+        # Mirrors "UPDATE user_helpers set active_customers=null where active_customers=?"
+        with self._lock:
+            for phone, entry in self._helpers.items():
+                if entry[3] == customerPhone:
+                    self._helpers[phone] = entry[:3] + (None,)
+
+    # Input: origin zipcode, search radius in km, optional district to restrict the search to and optional
+    #        set of phones known to be available (overrides the pairings tracked by the index)
+    # Output: list of (phone, distance in km) for available helpers sorted by distance, at most k long.
+    #         Empty if the origin zipcode is unknown.
+    def nearest(self, zipcode, maxDist, k=None, district=None, available=None):
+        origin = self._coords(zipcode)
+        if origin is None:
+            return []
+        lat, lon = origin
+        dLat = maxDist / KM_PER_DEGREE
+        # Longitude degrees shrink towards the poles, size the window for its northern edge
+        dLon = dLat / max(math.cos(math.radians(min(abs(lat) + dLat, 89.0))), 1e-6)
+        rowMin, colMin = self._cell(lat - dLat, lon - dLon)
+        rowMax, colMax = self._cell(lat + dLat, lon + dLon)
+
+        phones, coords = [], []
+        with self._lock:
+            for row in range(rowMin, rowMax + 1):
+                for col in range(colMin, colMax + 1):
+                    for phone in self._cells.get((row, col), ()):
+                        hLat, hLon, hDistrict, activeCustomer = self._helpers[phone]
+                        if district is not None and hDistrict != district:
+                            continue
+                        isAvailable = activeCustomer is None if available is None else phone in available
+                        if not isAvailable:
+                            continue
+                        phones.append(phone)
+                        coords.append((hLat, hLon))
+        if not phones:
+            return []
+
+        coords = np.array(coords)
+        distances = sphericalDistances(lat, lon, coords[:, 0], coords[:, 1])
+        order = np.argsort(distances, kind="stable")
+        order = order[distances[order] <= maxDist][:k]
+        return [(phones[i], float(distances[i])) for i in order]
+
+
+_indexes = {}
+_rebuilding = set()  # Databases whose index is being rebuilt
+_indexesLock = threading.Lock()
+
+
+def buildHelperIndex(rows, location_dict):
+    index = HelperIndex(location_dict)
+    for phone, zipcode, district, activeCustomer in rows:
+        index.add(phone, zipcode, district, activeCustomer)
+    return index
+
+
+# Input: database name, function returning (phone, zipcode, district, active_customers) rows, zipcode locations
+# Output: the database's helper index, (re)built from loadRows if missing or older than INDEX_MAX_AGE.
+#         The rebuild runs outside the lock, meanwhile other callers keep using the old index. Updates made to
+#         the old index during the rebuild may be missing from the new one, as are changes by other workers
+#         until the next rebuild; callers pass the available helpers read from the database.
+def getHelperIndex(db, loadRows, location_dict):
+    with _indexesLock:
+        index = _indexes.get(db)
+        if index is not None and (time.monotonic() - index.builtAt <= INDEX_MAX_AGE or db in _rebuilding):
+            return index
+        _rebuilding.add(db)
+    try:
+        index = buildHelperIndex(loadRows(), location_dict)
+    finally:
+        with _indexesLock:
+            _rebuilding.discard(db)
+    with _indexesLock:
+        _indexes[db] = index
+    return index
+
+
+# Output: the database's helper index if it has been built, otherwise None (nothing to keep up to date)
+def existingHelperIndex(db):
+    return _indexes.get(db)
@@ -0,0 +1,31 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access.
+
+    Used for heavy dependencies that only a few code paths need, so they don't
+    add to the startup time of every worker:
+
+        pd = LazyModule("pandas")
+        pd.DataFrame(...)  # pandas is imported here
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
@@ -0,0 +1,202 @@
+"""Counters, gauges and histograms exposed in the Prometheus text format.
+
+Metrics are created once at module level and registered in REGISTRY, whose
+render() output is served at /metrics. Every metric has its own lock, so
+recording a value from a request thread costs a dictionary lookup and a few
+additions. Each process keeps its own values: with several gunicorn workers a
+scrape is answered by one of them and shows that worker's requests only.
+"""
+import bisect
+import functools
+import math
+import re
+import threading
+
+# Seconds, from a cached lookup to a slow 46elks request
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _formatLabels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._names = set()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._names:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._names.add(metric.name)
+            self._metrics.append(metric)
+        return metric
+
+    # Output: all metrics in the Prometheus text exposition format (version 0.0.4)
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelNames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelNames):
+            raise ValueError(f"{self.name} takes labels {self.labelNames}, got {labels}")
+        return tuple(str(label) for label in labels)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_formatLabels(self.labelNames, key)} {_formatValue(v)}" for key, v in values]
+
+
+class Gauge(_Metric):
+    """Gauge set by the code it measures, or read from collect() at every scrape.
+
+    collect() returns {label values tuple: value}, for numbers that are cheaper to
+    look up when asked for than to keep up to date, such as rows in the database.
+    """
+
+    type = "gauge"
+
+    def __init__(self, *args, collect=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._collect = collect
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self._collect is not None:
+            try:
+                values = {self._key(labels): value for labels, value in self._collect().items()}
+            except Exception as err:
+                print(f"Failed to collect {self.name}: {err}")
+                return []
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [
+            f"{self.name}{_formatLabels(self.labelNames, key)} {_formatValue(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets=LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [count per bucket (last one +Inf), sum]
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    # Output: (number of observations, sum of observations)
+    def totals(self, *labels):
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return (sum(counts[0]), counts[1]) if counts is not None else (0, 0.0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = _formatLabels(self.labelNames, key, f'le="{_formatValue(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _formatLabels(self.labelNames, key)
+            lines.append(f"{self.name}_sum{labels} {_formatValue(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+_TABLE = re.compile(r"\b(?:from|into|update|table)\s+(\w+)", re.IGNORECASE)
+_WHERE = re.compile(r"\bwhere\b(.*)", re.IGNORECASE | re.DOTALL)
+_CONDITION = re.compile(r"(\w+)\s*(?:=|>|<|\bis\b|\bin\b|\blike\b)", re.IGNORECASE)
+
+
+# Output: short label for the access path of an SQL statement, such as "select user_helpers where phone".
+#         Statements reading or writing the same table by the same columns share a label.
+@functools.lru_cache(maxsize=1024)
+def queryName(query):
+    words = query.split()
+    if not words:
+        return "empty"
+    name = words[0].lower()
+    table = _TABLE.search(query)
+    if table is not None:
+        name += " " + table.group(1)
+    where = _WHERE.search(query)
+    if where is not None:
+        columns = []
+        for column in _CONDITION.findall(where.group(1)):
+            if column.lower() not in columns and column.lower() not in ("and", "or", "not"):
+                columns.append(column.lower())
+        name += " where " + ",".join(columns)
+    return name
@@ -0,0 +1,277 @@
+"""Versioned schema of the telehelp database.
+
+MIGRATIONS lists the schema changes in the order they were made. A database
+records how many of them it has in PRAGMA user_version, and migrate() applies the
+missing ones, each in one transaction together with the version bump. Run at
+every startup, so a new database gets the whole schema and an existing one only
+what was added since. Workers starting at the same time take turns on the write
+lock and find the work done.
+
+A migration never deletes data. Where the rows of an existing database stand in
+the way, e.g. a phone number registered twice before it was made unique, it
+stops with a DuplicateRowsError naming them, and the server does not start until
+they are merged by the operator, after taking a backup:
+
+    python -m server.migrations --merge-duplicates
+
+Never change a migration that has shipped, append a new one instead.
+"""
+import argparse
+import os
+
+
+# Columns that must become unique, in the order they are made so
+UNIQUE_COLUMNS = [
+    ("user_helpers", "phone"),
+    ("user_customers", "phone"),
+    ("call_variables", "callid"),
+    ("call_analytics_customer", "telehelp_callid"),
+    ("call_analytics_helper", "telehelp_callid"),
+]
+
+
+class DuplicateRowsError(Exception):
+    """Raised by migrate when rows have to be merged before a column can be made unique."""
+
+
+# Output: list of (table, column, number of values, number of rows) of the values held by more than one row
+def findDuplicates(conn, uniqueColumns=UNIQUE_COLUMNS):
+    duplicates = []
+    for table, column in uniqueColumns:
+        values, rows = conn.execute(
+            f""" SELECT count(*), coalesce(sum(n), 0) FROM
+                    (SELECT count(*) AS n FROM {table} WHERE {column} IS NOT NULL
+                        GROUP BY {column} HAVING n > 1) """
+        ).fetchone()
+        if values:
+            duplicates.append((table, column, values, rows))
+    return duplicates
+
+
+# Step of a migration stopping it while there are duplicates in the columns about to be made unique
+def _requireUnique(conn):
+    duplicates = findDuplicates(conn)
+    if duplicates:
+        found = ", ".join(
+            f"{rows} rows sharing {values} values of {table}.{column}"
+            for table, column, values, rows in duplicates
+        )
+        raise DuplicateRowsError(
+            f"Found {found}. Back up the database and run python -m server.migrations --merge-duplicates"
+        )
+
+
+# Merges every group of rows sharing a value of column into its first row: each column gets the value of the
+# last row that has one, so writes that raced into separate rows all end up in the kept row.
+# Output: number of rows removed
+def mergeDuplicates(conn, table, column):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    values = conn.execute(
+        f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL GROUP BY {column} HAVING count(*) > 1"
+    ).fetchall()
+    removed = 0
+    for (value,) in values:
+        rows = conn.execute(
+            f"SELECT rowid, {','.join(columns)} FROM {table} WHERE {column}=? ORDER BY rowid", (value,)
+        ).fetchall()
+        merged = list(rows[0][1:])
+        for row in rows[1:]:
+            merged = [new if new is not None else old for old, new in zip(merged, row[1:])]
+        updateStr = ",".join(f"{name}=?" for name in columns)
+        conn.execute(f"UPDATE {table} SET {updateStr} WHERE rowid=?", (*merged, rows[0][0]))
+        conn.executemany(f"DELETE FROM {table} WHERE rowid=?", [(row[0],) for row in rows[1:]])
+        removed += len(rows) - 1
+    return removed
+
+
+# (description, steps), a step being a statement or a function of the connection. Databases made before
+# versioning already have the tables of the first migration.
+MIGRATIONS = [
+    (
+        "create tables",
+        [
+            """ CREATE TABLE IF NOT EXISTS user_helpers (
+                    phone TEXT,
+                    name TEXT,
+                    zipcode TEXT,
+                    district TEXT,
+                    signup_time TEXT,
+                    active_customers TEXT) """,
+            """ CREATE TABLE IF NOT EXISTS user_customers (
+                    phone TEXT,
+                    zipcode TEXT,
+                    district TEXT,
+                    signup_time TEXT,
+                    active_helpers TEXT) """,
+            """ CREATE TABLE IF NOT EXISTS call_variables (
+                    callid TEXT,
+                    hangup TEXT,
+                    closest_helpers TEXT) """,
+            """ CREATE TABLE IF NOT EXISTS call_analytics_customer (
+                    telehelp_callid TEXT,
+                    elks_callid TEXT,
+                    call_start_time TEXT,
+                    call_end_time TEXT,
+                    new_customer TEXT,
+                    used_prev_helper TEXT,
+                    deregistered TEXT,
+                    n_helpers_contacted TEXT,
+                    match_found TEXT) """,
+            """ CREATE TABLE IF NOT EXISTS call_analytics_helper (
+                    telehelp_callid TEXT,
+                    elks_callid TEXT,
+                    call_start_time TEXT,
+                    call_end_time TEXT,
+                    contacted_prev_customer TEXT,
+                    deregistered TEXT) """,
+        ],
+    ),
+    (
+        "index the lookups made while answering calls",
+        [
+            # Users and calls are looked up by phone and call id, which concurrent requests could duplicate
+            _requireUnique,
+            "CREATE UNIQUE INDEX IF NOT EXISTS user_helpers_phone ON user_helpers (phone)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS user_customers_phone ON user_customers (phone)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS call_variables_callid ON call_variables (callid)",
+            # Upserts of the AnalyticsWriter need telehelp_callid to be unique
+            """ CREATE UNIQUE INDEX IF NOT EXISTS call_analytics_customer_telehelp_callid
+                    ON call_analytics_customer (telehelp_callid) """,
+            """ CREATE UNIQUE INDEX IF NOT EXISTS call_analytics_helper_telehelp_callid
+                    ON call_analytics_helper (telehelp_callid) """,
+            # Covers readAvailableHelpers and the per-district counts without reading the table
+            """ CREATE INDEX IF NOT EXISTS user_helpers_district
+                    ON user_helpers (district, active_customers, phone, zipcode) """,
+            # Pairings are cleared by the phone of the other party, only paired users are indexed
+            """ CREATE INDEX IF NOT EXISTS user_helpers_active_customers
+                    ON user_helpers (active_customers) WHERE active_customers IS NOT NULL """,
+            """ CREATE INDEX IF NOT EXISTS user_customers_active_helpers
+                    ON user_customers (active_helpers) WHERE active_helpers IS NOT NULL """,
+        ],
+    ),
+    (
+        "store delayed jobs, see scheduler",
+        [
+            """ CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    run_at REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT) """,
+            "CREATE INDEX IF NOT EXISTS scheduled_jobs_due ON scheduled_jobs (status, run_at)",
+        ],
+    ),
+    (
+        "count helpers per zipcode for the volunteer map, see volunteerLocations",
+        [
+            """ CREATE TABLE IF NOT EXISTS helper_zipcode_counts (
+                    zipcode TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL) """,
+            """ CREATE TABLE IF NOT EXISTS helper_counts_version (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    version INTEGER NOT NULL) """,
+            # Counts existing helpers, unless the tables were already filled before this migration
+            """ INSERT INTO helper_zipcode_counts (zipcode, count)
+                    SELECT zipcode, count(*) FROM user_helpers
+                    WHERE zipcode IS NOT NULL AND NOT EXISTS (SELECT 1 FROM helper_counts_version)
+                    GROUP BY zipcode """,
+            "INSERT OR IGNORE INTO helper_counts_version (id, version) values(0, 1)",
+            # Every change to user_helpers updates the counts and bumps the version in the same transaction
+            """ CREATE TRIGGER IF NOT EXISTS helper_counts_insert AFTER INSERT ON user_helpers
+                BEGIN
+                    INSERT INTO helper_zipcode_counts (zipcode, count)
+                        SELECT NEW.zipcode, 1 WHERE NEW.zipcode IS NOT NULL
+                        ON CONFLICT(zipcode) DO UPDATE SET count = count + 1;
+                    UPDATE helper_counts_version SET version = version + 1;
+                END """,
+            """ CREATE TRIGGER IF NOT EXISTS helper_counts_delete AFTER DELETE ON user_helpers
+                BEGIN
+                    UPDATE helper_zipcode_counts SET count = count - 1 WHERE zipcode = OLD.zipcode;
+                    DELETE FROM helper_zipcode_counts WHERE zipcode = OLD.zipcode AND count <= 0;
+                    UPDATE helper_counts_version SET version = version + 1;
+                END """,
+            """ CREATE TRIGGER IF NOT EXISTS helper_counts_update AFTER UPDATE OF zipcode ON user_helpers
+                WHEN OLD.zipcode IS NOT NEW.zipcode
+                BEGIN
+                    UPDATE helper_zipcode_counts SET count = count - 1 WHERE zipcode = OLD.zipcode;
+                    DELETE FROM helper_zipcode_counts WHERE zipcode = OLD.zipcode AND count <= 0;
+                    INSERT INTO helper_zipcode_counts (zipcode, count)
+                        SELECT NEW.zipcode, 1 WHERE NEW.zipcode IS NOT NULL
+                        ON CONFLICT(zipcode) DO UPDATE SET count = count + 1;
+                    UPDATE helper_counts_version SET version = version + 1;
+                END """,
+        ],
+    ),
+    (
+        "claim scheduled jobs in one statement, see scheduler",
+        ["ALTER TABLE scheduled_jobs ADD COLUMN claim TEXT"],
+    ),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schemaVersion(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+# Input: open connection, the migrations to apply (all by default)
+# Output: schema version of the database afterwards
+def migrate(conn, migrations=MIGRATIONS):
+    if schemaVersion(conn) >= len(migrations):
+        return schemaVersion(conn)
+    # Transactions are managed here, the driver must not commit before DDL statements as older ones do
+    isolationLevel, conn.isolation_level = conn.isolation_level, None
+    try:
+        for version, (description, steps) in enumerate(migrations, start=1):
+            # The version is read again under the write lock, another worker may have migrated in between
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if schemaVersion(conn) < version:
+                    print(f"Migrating database to schema version {version}: {description}")
+                    for step in steps:
+                        if callable(step):
+                            step(conn)
+                        else:
+                            conn.execute(step)
+                    conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.isolation_level = isolationLevel
+    return schemaVersion(conn)
+
+
+if __name__ == "__main__":
+    from .databaseIntegration import openConnection
+
+    parser = argparse.ArgumentParser(description="Rows standing in the way of the schema migrations")
+    parser.add_argument("--database", default=os.getenv("DATABASE"))
+    parser.add_argument("--key", default=os.getenv("DATABASE_KEY"))
+    parser.add_argument(
+        "--merge-duplicates", action="store_true", help="Merge them, take a backup of the database first"
+    )
+    args = parser.parse_args()
+
+    conn = openConnection(args.database, args.key)
+    migrate(conn, MIGRATIONS[:1])  # Tables the server would have created
+    duplicates = findDuplicates(conn)
+    for table, column, values, rows in duplicates:
+        print(f"{table}: {rows} rows share {values} values of {column}")
+    if not duplicates:
+        print("No duplicates")
+    elif args.merge_duplicates:
+        conn.isolation_level = None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table, column, _, _ in duplicates:
+                print(f"{table}: removed {mergeDuplicates(conn, table, column)} merged rows")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    conn.close()
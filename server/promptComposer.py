@@ -0,0 +1,157 @@
+"""Composite prompts: several MP3 sound bytes joined into one file.
+
+A prompt such as "Du befinner dig i" + <city> + "Stämmer det?" used to be three
+play steps, i.e. three media fetches by 46elks with audible gaps in between.
+MP3 is a sequence of self-contained frames, so the sound bytes (all synthesized
+with the same voice and encoding) can be joined by concatenating their frames
+after stripping the ID3 tags.
+
+Composites are written to media/sv/composite under a hash of their segments'
+paths, sizes and modification times, so a regenerated segment leads to a new
+composite. They are built in the background: until a composite exists, the caller
+gets None and plays the segments one by one as before.
+
+All city prompts can be built ahead of time from the server folder with
+
+    PYTHONPATH=.. python -m server.promptComposer
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MEDIA_DIR = os.path.join("media", "sv")
+COMPOSITE_DIR = "composite"
+ID3V1_SIZE = 128
+BITRATES_MPEG1 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)  # kbit/s of Layer III
+BITRATES_MPEG2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+# Output: the MPEG audio frames of an MP3 file, without ID3v2 header and ID3v1 trailer
+def stripTags(data):
+    if data[:3] == b"ID3" and len(data) >= 10:
+        # The tag size is a 28 bit "syncsafe" integer, 7 bits per byte
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        data = data[10 + size + footer :]
+    if len(data) >= ID3V1_SIZE and data[-ID3V1_SIZE:][:3] == b"TAG":
+        data = data[:-ID3V1_SIZE]
+    return data
+
+
+# Output: length in bytes of the Layer III frame starting at data[0], None if data doesn't start with one
+def frameLength(data):
+    if len(data) < 4 or data[0] != 0xFF or data[1] & 0xE0 != 0xE0 or (data[1] >> 1) & 0x3 != 0x1:
+        return None
+    version = (data[1] >> 3) & 0x3  # 3: MPEG 1, 2: MPEG 2, 0: MPEG 2.5
+    bitrates = BITRATES_MPEG1 if version == 3 else BITRATES_MPEG2
+    bitrate = bitrates[data[2] >> 4] if data[2] >> 4 < len(bitrates) else 0
+    sampleRateIdx = (data[2] >> 2) & 0x3
+    if version == 1 or bitrate == 0 or sampleRateIdx == 3:
+        return None
+    sampleRate = SAMPLE_RATES[version][sampleRateIdx]
+    padding = (data[2] >> 1) & 0x1
+    return (144 if version == 3 else 72) * bitrate * 1000 // sampleRate + padding
+
+
+# Encoders may start a file with a Xing/Info frame holding the number of frames of that file. In the middle
+# of a composite it would be played as silence, or make players stop after the first segment.
+def dropInfoFrame(data):
+    length = frameLength(data)
+    if length is not None and (b"Xing" in data[:length] or b"Info" in data[:length]):
+        return data[length:]
+    return data
+
+
+def concatenateMp3(segments):
+    return b"".join(dropInfoFrame(stripTags(segment)) for segment in segments)
+
+
+class PromptComposer:
+    def __init__(self, mediaUrl, mediaDir=MEDIA_DIR, workers=1):
+        self.mediaUrl = mediaUrl
+        self.mediaDir = mediaDir
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="composer")
+        self._inFlight = {}  # composite name -> future
+        self._lock = threading.Lock()
+
+    # Input: segment paths relative to mediaDir, e.g. ["ivr/du_befinner.mp3", "city/Solna.mp3"]
+    # Output: composite file name, or None if a segment is missing
+    def compositeName(self, segments):
+        signature = hashlib.sha1()
+        for segment in segments:
+            try:
+                stat = os.stat(os.path.join(self.mediaDir, segment))
+            except OSError:
+                return None
+            signature.update(f"{segment}\n{stat.st_size}\n{stat.st_mtime_ns}\n".encode("utf-8"))
+        return signature.hexdigest()[:20] + ".mp3"
+
+    def compositePath(self, name):
+        return os.path.join(self.mediaDir, COMPOSITE_DIR, name)
+
+    # Output: URL of the composite of segments if it has been built, otherwise None. A missing composite is
+    #         queued to be built unless one of its segments is missing.
+    def url(self, segments):
+        name = self.compositeName(segments)
+        if name is None:
+            return None
+        if os.path.isfile(self.compositePath(name)):
+            return f"{self.mediaUrl}/{COMPOSITE_DIR}/{name}"
+        self.submit(segments, name)
+        return None
+
+    def submit(self, segments, name=None):
+        name = name or self.compositeName(segments)
+        with self._lock:
+            future = self._inFlight.get(name)
+            if future is None:
+                future = self._inFlight[name] = self._executor.submit(self._compose, segments, name)
+            return future
+
+    def _compose(self, segments, name):
+        try:
+            data = []
+            for segment in segments:
+                with open(os.path.join(self.mediaDir, segment), "rb") as file:
+                    data.append(file.read())
+            path = self.compositePath(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as out:
+                out.write(concatenateMp3(data))
+            os.replace(tmp_path, path)
+            return path
+        except OSError as err:
+            print(f"Failed to compose {segments}: {err}")
+            raise
+        finally:
+            with self._lock:
+                self._inFlight.pop(name, None)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+# Segments of the prompts, relative to MEDIA_DIR
+def cityPromptSegments(city):
+    return ["ivr/du_befinner.mp3", f"city/{city}.mp3", "ivr/stammer_det.mp3"]
+
+
+# Without a name, e.g. before it has been synthesized, the name is left out
+def returningCustomerSegments(name=None):
+    namePrompts = [f"name/{name}.mp3"] if name is not None else []
+    return ["ivr/behover_hjalp.mp3", *namePrompts, "ivr/pratade_sist.mp3"]
+
+
+if __name__ == "__main__":
+    from .zipcode_utils import getListOfCities
+
+    composer = PromptComposer(mediaUrl=None)
+    segmentLists = [cityPromptSegments(city) for city in sorted(getListOfCities("SE.txt"))]
+    # Cities without a sound byte are left out
+    futures = [composer.submit(segments) for segments in segmentLists if composer.compositeName(segments)]
+    built = sum(1 for future in futures if future.exception() is None)
+    composer.close()
+    print(f"Built {built} of {len(futures)} city prompts in {os.path.join(MEDIA_DIR, COMPOSITE_DIR)}")
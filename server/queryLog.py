@@ -0,0 +1,183 @@
+"""Slow-query log and query plans of the statements run by databaseIntegration.
+
+QueryLog is a query listener (see databaseIntegration.addQueryListener). It
+counts and times every distinct statement, prints those slower than
+SLOW_QUERY_MS with phone numbers in their parameters redacted, and captures the
+EXPLAIN QUERY PLAN of each statement the first time it is seen, warning about
+plans that scan a whole table. With QUERY_LOG set, slow statements, plans and
+per-statement totals (every STATS_INTERVAL seconds) are appended to that file as
+JSON lines, from every worker. The hottest statements are listed with
+
+    python -m server.queryLog <query log> [--top 20] [--sort total]
+"""
+import argparse
+import functools
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+QUERY_LOG = os.getenv("QUERY_LOG")
+STATS_INTERVAL = 60.0  # Seconds between writing statement totals to QUERY_LOG
+
+PHONE_PATTERN = re.compile(r"\+?\d{7,}")
+EXPLAINED = ("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")
+# "SCAN user_helpers" (SCAN TABLE in older SQLite) reads every row or index entry, SEARCH only those asked for
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(?!CONSTANT ROW)(\w+)")
+
+
+# Output: statement with its whitespace collapsed, the key statements are counted by
+@functools.lru_cache(maxsize=1024)
+def normalizeQuery(query):
+    return " ".join(query.split())
+
+
+def redact(value):
+    if isinstance(value, str):
+        return PHONE_PATTERN.sub("<phone>", value)
+    return value
+
+
+# Output: the table names of the full table scans of a query plan, rows as returned by EXPLAIN QUERY PLAN
+def fullScans(plan):
+    scans = []
+    for row in plan:
+        match = FULL_SCAN.match(str(row[-1]))
+        if match is not None:
+            scans.append(match.group(1))
+    return scans
+
+
+class QueryLog:
+    def __init__(self, explain=None, slowMs=SLOW_QUERY_MS, path=QUERY_LOG, statsInterval=STATS_INTERVAL):
+        self.explain = explain  # function(query, params) -> rows of EXPLAIN QUERY PLAN query
+        self.slowMs = slowMs
+        self.path = path
+        self.plans = {}  # normalized query -> plan rows, None until captured
+        self._stats = defaultdict(lambda: [0, 0.0, 0.0])  # normalized query -> [count, seconds, max seconds]
+        self._lock = threading.Lock()
+        self._fileLock = threading.Lock()
+        self._explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+        self._closed = threading.Event()
+        if path is not None:
+            threading.Thread(target=self._writeStatsEvery, args=(statsInterval,), daemon=True).start()
+
+    # Query listener
+    def record(self, query, params, seconds):
+        if query.lstrip()[:7].upper() == "EXPLAIN":
+            return  # Run by the log itself
+        normalized = normalizeQuery(query)
+        with self._lock:
+            stats = self._stats[normalized]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            firstSight = normalized not in self.plans
+            if firstSight:
+                self.plans[normalized] = None
+        if firstSight and self.explain is not None and normalized.split(" ", 1)[0].upper() in EXPLAINED:
+            self._explainer.submit(self._capturePlan, query, normalized, params)
+        if seconds * 1000 >= self.slowMs:
+            redacted = [redact(param) for param in params]
+            print(f"Slow query ({seconds * 1000:.1f} ms): {normalized} {redacted}")
+            ms = round(seconds * 1000, 3)
+            self._write({"type": "slow", "query": normalized, "params": redacted, "ms": ms})
+
+    def _capturePlan(self, query, normalized, params):
+        try:
+            plan = [tuple(row) for row in self.explain(query, params)]
+        except Exception as err:
+            print(f"Failed to explain {normalized}: {err}")
+            return
+        self.plans[normalized] = plan
+        scans = fullScans(plan)
+        if scans:
+            print(f"Full table scan of {', '.join(scans)}: {normalized}")
+        steps = [str(row[-1]) for row in plan]
+        self._write({"type": "plan", "query": normalized, "plan": steps, "scans": scans})
+
+    # Output: {normalized query: (count, total seconds, max seconds)} since the last call
+    def takeStats(self):
+        with self._lock:
+            stats = {query: tuple(values) for query, values in self._stats.items()}
+            self._stats.clear()
+        return stats
+
+    def writeStats(self):
+        stats = self.takeStats()
+        for query, (count, seconds, maxSeconds) in stats.items():
+            entry = {"type": "stats", "query": query, "count": count, "seconds": seconds, "max": maxSeconds}
+            self._write(entry)
+
+    def _writeStatsEvery(self, interval):
+        while not self._closed.wait(interval):
+            self.writeStats()
+
+    def _write(self, entry):
+        if self.path is None:
+            return
+        entry["time"] = time.time()
+        entry["pid"] = os.getpid()
+        with self._fileLock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self._closed.set()
+        self._explainer.shutdown(wait=True)
+        self.writeStats()
+
+
+# Input: path of a QUERY_LOG file
+# Output: list of {"query", "count", "seconds", "max", "slow", "plan", "scans"}, one per statement
+def hotQueries(path):
+    queries = defaultdict(
+        lambda: {"count": 0, "seconds": 0.0, "max": 0.0, "slow": 0, "plan": None, "scans": []}
+    )
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            entry = json.loads(line)
+            query = queries[entry["query"]]
+            if entry["type"] == "stats":
+                query["count"] += entry["count"]
+                query["seconds"] += entry["seconds"]
+                query["max"] = max(query["max"], entry["max"])
+            elif entry["type"] == "slow":
+                query["slow"] += 1
+            elif entry["type"] == "plan":
+                query["plan"], query["scans"] = entry["plan"], entry["scans"]
+    return [dict(values, query=query) for query, values in queries.items()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Statements of a query log by time spent in them")
+    parser.add_argument("file", help="Query log (QUERY_LOG)")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--sort", choices=("total", "count", "max", "mean", "slow"), default="total")
+    args = parser.parse_args()
+
+    def mean(query):
+        return query["seconds"] / query["count"] if query["count"] else 0.0
+
+    sortKeys = {
+        "total": lambda query: query["seconds"],
+        "count": lambda query: query["count"],
+        "max": lambda query: query["max"],
+        "mean": mean,
+        "slow": lambda query: query["slow"],
+    }
+    queries = sorted(hotQueries(args.file), key=sortKeys[args.sort], reverse=True)[: args.top]
+    for query in queries:
+        print(
+            f"{query['seconds']:9.2f} s total {query['count']:9d} runs {mean(query) * 1000:8.2f} ms mean "
+            f"{query['max'] * 1000:8.1f} ms max {query['slow']:6d} slow"
+        )
+        print(f"    {query['query']}")
+        for step in query["plan"] or []:
+            print(f"        {step}")
+        if query["scans"]:
+            print(f"        Full table scan of {', '.join(query['scans'])}: missing index?")
@@ -0,0 +1,241 @@
+"""Durable delayed jobs, e.g. the follow-up SMS sent a minute after a match.
+
+Jobs are stored in the scheduled_jobs table, created by the schema migrations, so
+they survive a worker restart and can be picked up by any worker sharing the
+database. Each worker keeps a heap of the run times of jobs it scheduled itself,
+so these run on time, and polls the table every POLL_INTERVAL seconds for jobs
+scheduled elsewhere or before a restart.
+
+Delivery is at most once: a job is claimed (pending -> running) in the database
+before its handler runs, by one UPDATE marking it with a token of the claim, and a
+job whose worker dies mid-run is left as running rather than run again. Handlers raise RetryJob when they know the action did not
+happen (e.g. 46elks could not be reached); the job is then retried with backoff.
+
+Handlers are registered by name:
+
+    @registerJob("askIfHelpingSms")
+    def sendAskIfHelpingSms(volunteerNumber):
+        ...
+
+    scheduler.schedule("askIfHelpingSms", helperPhone, delay=60)
+"""
+import atexit
+import heapq
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_WORKERS = 2  # Jobs run at the same time per worker process
+POLL_INTERVAL = 5.0  # Seconds between checks for jobs scheduled by other processes
+MAX_ATTEMPTS = 5  # Runs of a job raising RetryJob before it is marked as failed
+RETRY_DELAY = 30.0  # Seconds before the first retry, doubled for every further attempt
+
+# Job statuses in scheduled_jobs. Jobs that ran successfully are deleted.
+PENDING = "pending"
+RUNNING = "running"
+FAILED = "failed"
+
+
+class RetryJob(Exception):
+    """Raised by a handler when the job did not take effect and is safe to run again."""
+
+
+_handlers = {}
+
+
+def registerJob(name):
+    def decorator(func):
+        _handlers[name] = func
+        return func
+
+    return decorator
+
+
+class SqliteJobStore:
+    """scheduled_jobs table of a SQLite (or SQLCipher) database.
+
+    connect is a function returning a context manager yielding a connection, such as
+    ConnectionPool.connection, used for reads. write is a function writing a list of
+    (query, params) in one transaction, such as databaseIntegration.writeBatchToDatabase,
+    so jobs are committed together with the other writes of the process.
+    """
+
+    def __init__(self, connect, write):
+        self.connect = connect
+        self.write = write
+
+    def add(self, name, args, runAt):
+        self.write(
+            [
+                (
+                    "INSERT INTO scheduled_jobs (name, args, run_at, status) values(?,?,?,?)",
+                    (name, json.dumps(args), runAt, PENDING),
+                )
+            ]
+        )
+
+    def _read(self, query, params):
+        with self.connect() as conn:
+            return conn.execute(query, params).fetchall()
+
+    # Marks up to limit due jobs as running
+    # Output: list of (id, name, args, attempts) of the jobs this call claimed
+    def claimDue(self, now, limit):
+        due = "SELECT id FROM scheduled_jobs WHERE status=? AND run_at<=? ORDER BY run_at LIMIT ?"
+        # Most polls find nothing, and only reading doesn't queue behind the writes of the process
+        if not self._read(due, (PENDING, now, 1)):
+            return []
+        # Another process may claim the same jobs, only one UPDATE can match each of them
+        claim = uuid.uuid4().hex
+        self.write(
+            [
+                (
+                    f"""UPDATE scheduled_jobs SET status=?, attempts=attempts+1, claim=?
+                        WHERE status=? AND id IN ({due})""",
+                    (RUNNING, claim, PENDING, PENDING, now, limit),
+                )
+            ]
+        )
+        rows = self._read(
+            "SELECT id, name, args, attempts FROM scheduled_jobs WHERE claim=? ORDER BY run_at", (claim,)
+        )
+        return [(jobId, name, json.loads(args), attempts) for jobId, name, args, attempts in rows]
+
+    def complete(self, jobId):
+        self.write([("DELETE FROM scheduled_jobs WHERE id=?", (jobId,))])
+
+    def retry(self, jobId, runAt, error):
+        self.write(
+            [
+                (
+                    "UPDATE scheduled_jobs SET status=?, run_at=?, last_error=? WHERE id=?",
+                    (PENDING, runAt, error, jobId),
+                )
+            ]
+        )
+
+    def fail(self, jobId, error):
+        self.write([("UPDATE scheduled_jobs SET status=?, last_error=? WHERE id=?", (FAILED, error, jobId))])
+
+
+class JobScheduler:
+    def __init__(
+        self,
+        store,
+        workers=JOB_WORKERS,
+        pollInterval=POLL_INTERVAL,
+        maxAttempts=MAX_ATTEMPTS,
+        retryDelay=RETRY_DELAY,
+    ):
+        self.store = store
+        self.workers = workers
+        self.pollInterval = pollInterval
+        self.maxAttempts = maxAttempts
+        self.retryDelay = retryDelay
+        self._heap = []  # Run times of jobs scheduled by this process
+        self._running = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="jobs")
+        self._thread = threading.Thread(target=self._run, name="JobScheduler", daemon=True)
+        self._thread.start()
+
+    # Input: name of a registered job, its (JSON serializable) arguments, seconds to wait before running it.
+    #        Inside a unit of work (see databaseWriter) the job is stored when the unit is committed.
+    def schedule(self, name, *args, delay=0):
+        runAt = time.time() + delay
+        self.store.add(name, list(args), runAt)
+        with self._condition:
+            heapq.heappush(self._heap, runAt)
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                timeout = self.pollInterval
+                if self._heap:
+                    timeout = min(timeout, self._heap[0] - time.time())
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                now = time.time()
+                while self._heap and self._heap[0] <= now:
+                    heapq.heappop(self._heap)
+            try:
+                self.runDue()
+            except Exception as err:
+                print(f"Failed to check for scheduled jobs: {err}")
+                with self._condition:
+                    self._condition.wait(self.pollInterval)
+
+    # Claims as many due jobs as there are idle workers and starts them. Called by the scheduler thread only,
+    # so the number of idle workers can only grow while the jobs are claimed. schedule() is not held up by it.
+    def runDue(self):
+        with self._condition:
+            free = self.workers - self._running
+        if free <= 0:
+            return
+        jobs = self.store.claimDue(time.time(), free)
+        with self._condition:
+            self._running += len(jobs)
+        for job in jobs:
+            self._executor.submit(self._execute, *job)
+
+    def _execute(self, jobId, name, args, attempts):
+        try:
+            handler = _handlers.get(name)
+            if handler is None:
+                print(f"No handler registered for job {name}, giving up on job {jobId}")
+                self.store.fail(jobId, "no handler")
+                return
+            try:
+                handler(*args)
+            except RetryJob as err:
+                if attempts >= self.maxAttempts:
+                    print(f"Job {name} ({jobId}) failed after {attempts} attempts: {err}")
+                    self.store.fail(jobId, str(err))
+                    return
+                runAt = time.time() + self.retryDelay * 2 ** (attempts - 1)
+                print(f"Job {name} ({jobId}) failed, retrying in {runAt - time.time():.0f} s: {err}")
+                self.store.retry(jobId, runAt, str(err))
+                with self._condition:
+                    heapq.heappush(self._heap, runAt)
+                return
+            except Exception as err:
+                print(f"Job {name} ({jobId}) failed: {err}")
+                self.store.fail(jobId, repr(err))
+                return
+            self.store.complete(jobId)
+        except Exception as err:
+            print(f"Failed to update job {name} ({jobId}): {err}")
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify()
+
+    # Stops looking for jobs and waits for the running ones. Pending jobs stay in the store.
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+
+_schedulers = []
+
+
+@atexit.register
+def closeAllSchedulers():
+    while _schedulers:
+        _schedulers.pop().close()
+
+
+def registerScheduler(scheduler):
+    _schedulers.append(scheduler)
+    return scheduler
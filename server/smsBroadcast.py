@@ -1,12 +1,16 @@
 import os
-import re
 import sys
-import time
 
-import requests
 from dotenv import load_dotenv
 
-from .databaseIntegration import readDatabase
+from .broadcast import BroadcastCheckpoint
+from .broadcast import FAILED
+from .broadcast import newCheckpointPath
+from .broadcast import SmsBroadcast
+from .databaseIntegration import CHUNK_SIZE
+from .databaseIntegration import getPool
+from .databaseIntegration import iterateDatabase
+from .elksClient import ElksClient
 
 load_dotenv()
 
@@ -19,60 +23,142 @@ DATABASE = os.getenv("DATABASE")
 DATABASE_KEY = os.getenv("DATABASE_KEY")
 
 
-def sendSmsBroadcastToLostUsers():
-
-    message = sys.argv[1]
-    print(f"Message: {message}")
-
-    query = """SELECT phone FROM user_helpers"""
-    targetNumbersTuples = readDatabase(DATABASE, DATABASE_KEY, query, params=None)
-
-    skipNumbers = [x[0] for x in targetNumbersTuples]
-
-    fileNumbers = []
-
-    with open("lost_numbers.txt", "r", encoding="utf-8") as file:
-        for line in file:
-            fileNumbers.append(line.strip())
-
-    existingNumbers = set(skipNumbers)
-    lostNumbers = set(fileNumbers)
-
-    targetNumbers = lostNumbers - existingNumbers
-
-    alreadyBackNumbers = lostNumbers - targetNumbers
-
-    print(f"These {len(alreadyBackNumbers)} users have already signed up again:")
-    for num in alreadyBackNumbers:
-        print(f" - {num}")
-
-    print(f"The SMS broadcast will reach the remaining {len(targetNumbers)} users:")
-    for num in targetNumbers:
-        print(f" - {num}")
-
+# Removes "<option> <value>" from args
+# Output: the value, None if the option is not given
+def popOption(args, option):
+    if option not in args:
+        return None
+    i = args.index(option)
+    value = args[i + 1]
+    del args[i : i + 2]
+    return value
+
+
+# Removes "--sample N" from args
+# Output: number of target numbers to print in the preview, 0 if not given
+def popSampleSize(args):
+    return int(popOption(args, "--sample") or 0)
+
+
+# Input: checkpoint file given with --resume, None if not given. Opened before the broadcast is confirmed.
+# Output: BroadcastCheckpoint of the broadcast to resume, None to start a new one
+def openCheckpoint(path, message):
+    if path is None:
+        print("Starting a new broadcast, to continue an interrupted one use --resume <checkpoint>")
+        return None
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No broadcast checkpoint {path}")
+    checkpoint = BroadcastCheckpoint(path, message)
+    print(f"Resuming broadcast from {path}, {len(checkpoint.done)} users already handled")
+    return checkpoint
+
+
+# Input: open connection, table and SQL condition selecting the targets, its parameters, number of random
+#        targets to print in the preview
+# Output: (number of targets, generator of their phone numbers). The numbers are read in chunks of chunkSize,
+#         in rowid order, as the broadcast sends to them.
+def previewTargets(conn, table, condition, params, sampleSize, chunkSize=CHUNK_SIZE):
+    count = conn.execute(f"SELECT count(*) FROM {table} WHERE {condition}", params).fetchone()[0]
+    print(f"The SMS broadcast will reach {count} users")
+    if sampleSize > 0:
+        print(f"Random sample of {sampleSize}:")
+        sampleQuery = f"SELECT phone FROM {table} WHERE {condition} ORDER BY random() LIMIT ?"
+        for (num,) in conn.execute(sampleQuery, (*params, sampleSize)):
+            print(f" - {num}")
+    numbers = iterateDatabase(
+        conn,
+        f"SELECT rowid, phone FROM {table} WHERE rowid > ? AND {condition} ORDER BY rowid LIMIT ?",
+        params,
+        chunkSize,
+    )
+    return count, (num for (num,) in numbers)
+
+
+# Output: (SQL condition, params) selecting subgroup targetSubgroup of numSubgroups of the helpers in district
+def subgroupCondition(district, numSubgroups, targetSubgroup):
+    condition = "rowid%?==?"
+    params = (numSubgroups, targetSubgroup)
+    if district != "all":
+        condition += " AND district==?"
+        params += (district,)
+    return condition, params
+
+
+# Streams numbers, e.g. the lines of lost_numbers.txt, into the temp table lost_numbers and compares it to
+# user_helpers in SQL. Drop it with dropLostNumbers when done.
+# Output: number of them that are registered as helpers again, and left out of the table
+def loadLostNumbers(conn, numbers):
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS lost_numbers (phone TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.lost_numbers")
+    conn.executemany(
+        "INSERT OR IGNORE INTO temp.lost_numbers (phone) values(?)",
+        ((number.strip(),) for number in numbers if number.strip()),
+    )
+    alreadyBack = conn.execute(
+        "DELETE FROM temp.lost_numbers WHERE phone IN (SELECT phone FROM user_helpers)"
+    ).rowcount
+    conn.commit()
+    return alreadyBack
+
+
+def dropLostNumbers(conn):
+    conn.execute("DROP TABLE IF EXISTS temp.lost_numbers")
+
+
+def confirmAndBroadcast(message, numbers, total, checkpoint=None):
     confirmation = input("Continue? [y|n] ").lower()
     if confirmation == "y":
-        performSmsBroadcast(message, targetNumbers)
+        performSmsBroadcast(message, numbers, total=total, checkpoint=checkpoint)
     else:
         print("User aborted broadcast.")
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+# Sends the message to numbers in lost_numbers.txt that are no longer registered as helpers.
+# Usage: sendSmsBroadcastToLostUsers <message> [--sample N] [--resume <checkpoint>]
+def sendSmsBroadcastToLostUsers():
+    args = sys.argv[1:]
+    sampleSize = popSampleSize(args)
+    resumePath = popOption(args, "--resume")
+    message = args[0]
+    print(f"Message: {message}")
+    checkpoint = openCheckpoint(resumePath, message)
+
+    with getPool(DATABASE, DATABASE_KEY).connection() as conn:
+        try:
+            with open("lost_numbers.txt", "r", encoding="utf-8") as file:
+                alreadyBack = loadLostNumbers(conn, file)
+            print(f"{alreadyBack} users have already signed up again")
+            count, numbers = previewTargets(conn, "temp.lost_numbers", "1", (), sampleSize)
+            confirmAndBroadcast(message, numbers, count, checkpoint)
+        finally:
+            dropLostNumbers(conn)
 
 
 def sendSmsBroadcast():
-    numArgs = len(sys.argv)  # TODO: Use argparse if complexity increased in future.
+    args = list(sys.argv)
+    sampleSize = popSampleSize(args)
+    resumePath = popOption(args, "--resume")
+    numArgs = len(args)  # TODO: Use argparse if complexity increased in future.
     if numArgs < 4:  # Print help message if not enough arguments
         helpStr = "This script sends an SMS broadcast to a numerically specified \
 subgroup of registered volunteers in a provided district, according to this formula:\n\tsubgroup = user ID % numSubgroups\n\
-\nUsage: \n\tpython sendSmsBroadcast.py <message> <district> <numSubgroups> <targetSubgroup> [<test phone numbers>]\n\
+\nUsage: \n\tpython sendSmsBroadcast.py <message> <district> <numSubgroups> <targetSubgroup> [<test phone numbers>] [--sample N] \
+[--resume <checkpoint>]\n\
 \nNote that you will need to confirm the broadcast manually before sending begins.\
 \nNote that the <message> and <district> can be surrounded by single quotes to escape spaces.\
 \nThe <district> can be specified as 'all' to broadcast to all districts at once.\
-\nTo include formatted newlines in the <message>, use $'LINE1\\nLINE2'."
+\nTo include formatted newlines in the <message>, use $'LINE1\\nLINE2'.\
+\nWith --sample N, N random target numbers are printed before confirming.\
+\nEvery broadcast saves its progress to a checkpoint file, printed when it starts. To continue an interrupted\
+ broadcast, run the same command with --resume <checkpoint>."
         print(helpStr)
     else:
-        message = sys.argv[1]
-        district = sys.argv[2]
-        numSubgroups = int(sys.argv[3])
-        targetSubgroup = int(sys.argv[4])
+        message = args[1]
+        district = args[2]
+        numSubgroups = int(args[3])
+        targetSubgroup = int(args[4])
         print(f"Message: {message}")
         print(f"Target district: {district}")
         print(f"Number of subgroups: {numSubgroups}")
@@ -83,48 +169,39 @@ subgroup of registered volunteers in a provided district, according to this form
                 "ERROR: The target subgroup has to be less than the number of subgroups to split the userbase into."
             )
             return
+        checkpoint = openCheckpoint(resumePath, message)
 
         if numArgs > 5:  # Manually specified numbers, "trial run"
-            targetNumbers = sys.argv[5:]
+            targetNumbers = args[5:]
             print(f"Using manually specified targetNumbers: {targetNumbers}")
-        else:
-            if district == "all":
-                query = """SELECT phone FROM user_helpers WHERE rowid%?==?"""
-                query_params = (numSubgroups, targetSubgroup)
-            else:
-                query = """SELECT phone FROM user_helpers WHERE rowid%?==? AND district==?"""
-                query_params = (numSubgroups, targetSubgroup, district)
-            targetNumbersTuples = readDatabase(DATABASE, DATABASE_KEY, query, params=query_params)
-            targetNumbers = [x[0] for x in targetNumbersTuples]
-            print(f"The SMS broadcast will reach the following {len(targetNumbers)} users:")
-            for num in targetNumbers:
-                print(f" - {num}")
-
-        confirmation = input("Continue? [y|n] ").lower()
-        if confirmation == "y":
-            performSmsBroadcast(message, targetNumbers)
-        else:
-            print("User aborted broadcast.")
-
-
-def performSmsBroadcast(msg, numbers):
-    totalNumbers = len(numbers)
-    for numberIndex, number in enumerate(numbers):
-        pattern = r"^\+46[0-9]{9}$"  # Pattern to match Swedish +46ddddddddd mobile phone number format (especially for manual input)
-        if re.match(pattern, str(number)):
-
-            requests.post(
-                "https://api.46elks.com/a1/sms",
-                auth=(API_USERNAME, API_PASSWORD),
-                data={"from": "Telehelp", "to": number, "message": msg},
-            )
+            confirmAndBroadcast(message, targetNumbers, len(targetNumbers), checkpoint)
+            return
 
-            print(f"Sent message to user {numberIndex+1}/{totalNumbers}: {number}")
-            time.sleep(0.5)  # Limit rate in case manual abort is necessary
-        else:
-            print(
-                f"Skipping msg to user {numberIndex+1}/{totalNumbers}: {number} - does not match expected +46ddddddddd format..."
-            )
+        condition, params = subgroupCondition(district, numSubgroups, targetSubgroup)
+        with getPool(DATABASE, DATABASE_KEY).connection() as conn:
+            count, numbers = previewTargets(conn, "user_helpers", condition, params, sampleSize)
+            confirmAndBroadcast(message, numbers, count, checkpoint)
+
+
+# Sends msg to numbers under the BROADCAST_RATE limit. Progress is saved to the checkpoint, a new one unless
+# given: the broadcast can be resumed from it with --resume without sending to anyone twice.
+def performSmsBroadcast(msg, numbers, total=None, checkpoint=None):
+    elks = ElksClient(API_USERNAME, API_PASSWORD)
+    if checkpoint is None:
+        checkpoint = BroadcastCheckpoint(newCheckpointPath(msg), msg)
+        print(f"Saving progress to {checkpoint.path}, continue if interrupted with --resume {checkpoint.path}")
+    try:
+        stats = SmsBroadcast(elks, msg, checkpoint).run(numbers, total=total)
+    except BaseException:
+        checkpoint.close()
+        raise
+    finally:
+        elks.close()
+    if stats.counts[FAILED]:
+        checkpoint.close()
+        print(f"{stats.counts[FAILED]} users were not sent to, try them again with --resume {checkpoint.path}")
+    else:
+        print(f"Broadcast finished, the numbers handled are in {checkpoint.finish()}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+"""Import-time report and startup budget for the server.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter, prints
+the slowest imports and exits with status 1 if importing the module took longer
+than the budget. Run it from the repository root:
+
+    python -m server.startupTime --module server.api --budget-ms 1500
+
+The budget defaults to the STARTUP_BUDGET_MS environment variable.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+DEFAULT_MODULE = "server.api"
+DEFAULT_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", 2000))
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# e.g. "import time:       357 |       1049 |   encodings"
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+# Input: module to import, working directory of the interpreter, environment variables to set in it
+# Output: list of (module, self time in ms, cumulative time in ms, nesting depth) in the order they finished
+def measureImportTime(module, cwd=ROOT_DIR, env=None):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        env=None if env is None else {**os.environ, **env},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            selfUs, cumulativeUs, indent, name = match.groups()
+            imports.append((name, int(selfUs) / 1000, int(cumulativeUs) / 1000, (len(indent) - 1) // 2))
+    return imports
+
+
+# Top level imports include everything imported beneath them, their sum is the total startup cost
+def totalImportTime(imports):
+    return sum(cumulative for _, _, cumulative, depth in imports if depth == 0)
+
+
+def report(module, imports, budgetMs, top=15):
+    total = totalImportTime(imports)
+    print(f"Importing {module}: {total:.1f} ms (budget {budgetMs:.0f} ms), {len(imports)} modules")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for name, selfMs, cumulativeMs, _ in sorted(imports, key=lambda i: i[2], reverse=True)[:top]:
+        print(f"{cumulativeMs:14.1f} {selfMs:9.1f}  {name}")
+    return total <= budgetMs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import-time report with a startup budget")
+    parser.add_argument("--module", default=DEFAULT_MODULE, help="module to import (default: %(default)s)")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="default: %(default)s")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to list")
+    args = parser.parse_args(argv)
+
+    withinBudget = report(args.module, measureImportTime(args.module), args.budget_ms, args.top)
+    if not withinBudget:
+        print("Startup budget exceeded")
+    return 0 if withinBudget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,19 +3,31 @@
 Note: ssml must be well-formed according to:
     https://www.w3.org/TR/speech-synthesis/
 """
+import argparse
+import hashlib
+import json
 import os
+import threading
 import time
 import urllib.parse
+from concurrent.futures import as_completed
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
-from google.cloud import texttospeech
-from google.oauth2 import service_account
 
+from .lazyImport import LazyModule
+from .metrics import Histogram
+from .rateLimit import TokenBucket
 from .zipcode_utils import getListOfCities
 from .zipcode_utils import readZipCodeData
 
 load_dotenv()
 
+# The Google client libraries are slow to import, they are only loaded once speech is synthesized
+texttospeech = LazyModule("google.cloud.texttospeech")
+service_account = LazyModule("google.oauth2.service_account")
+
 text_input = dict()  # contains key as filename and string for tts
 
 """
@@ -96,90 +108,310 @@ text_input[
 ] = "Vi hittade tyvärr ingen ledig volontär i ditt område. Vänligen försök att ringa tillbaka senare. Hejdå"
 
 """
-Input parameters for text-to-speech model
+Input parameters for text-to-speech model, created together with the client on first use
 """
-voice = texttospeech.types.VoiceSelectionParams(
-    language_code="sv-SE", name="sv-SE-Wavenet-A", ssml_gender=texttospeech.enums.SsmlVoiceGender.NEUTRAL,
-)
+LANGUAGE_CODE = "sv-SE"
+VOICE_NAME = "sv-SE-Wavenet-A"
+SPEAKING_RATE = 0.85
+
+_synthesis = None
+_synthesisLock = threading.Lock()
+
+
+def getSynthesis():
+    global _synthesis
+    with _synthesisLock:
+        if _synthesis is None:
+            if os.getenv("GOOGLE_APPLICATION_CREDENTIALS") is None:
+                raise RuntimeError(
+                    "Environment variable GOOGLE_APPLICATION_CREDENTIALS is not present, text to speech unavailable"
+                )
+
+            voice = texttospeech.types.VoiceSelectionParams(
+                language_code=LANGUAGE_CODE, name=VOICE_NAME, ssml_gender=texttospeech.enums.SsmlVoiceGender.NEUTRAL,
+            )
+
+            # Select the type of audio file you want returned
+            audio_config = texttospeech.types.AudioConfig(
+                audio_encoding=texttospeech.enums.AudioEncoding.MP3, speaking_rate=SPEAKING_RATE
+            )
+
+            # Instantiates a client
+            dirname = os.path.dirname(__file__)
+            filepath_json = os.path.join(dirname, "..", "..", "GoogleTextToSpeech.json")
+            cred = service_account.Credentials.from_service_account_file(filepath_json)
+            client = texttospeech.TextToSpeechClient(credentials=cred)
+            _synthesis = client, voice, audio_config
+        return _synthesis
+
+
+def synthesize(text):
+    client, voice, audio_config = getSynthesis()
+    synthesis_input = texttospeech.types.SynthesisInput(text=text)
+    # The response's audio_content is binary.
+    return client.synthesize_speech(synthesis_input, voice, audio_config).audio_content
 
-# Select the type of audio file you want returned
-audio_config = texttospeech.types.AudioConfig(
-    audio_encoding=texttospeech.enums.AudioEncoding.MP3, speaking_rate=0.85
-)
 
-# Instantiates a client
-if os.getenv("GOOGLE_APPLICATION_CREDENTIALS") is not None:
-    dirname = os.path.dirname(__file__)
-    filepath_json = os.path.join(dirname, "..", "..", "GoogleTextToSpeech.json")
-    cred = service_account.Credentials.from_service_account_file(filepath_json)
-    client = texttospeech.TextToSpeechClient(credentials=cred)
-else:
+if os.getenv("GOOGLE_APPLICATION_CREDENTIALS") is None:
     print("Environment variable GOOGLE_APPLICATION_CREDENTIALS is not present, text to speech unavailable")
 
 
-def generateSoundBytes():
-    print("Generating IVR sound bytes (skips existing)")
-    for key in text_input:
-        # The response's audio_content is binary.
-        outputPath = os.path.join("media/sv", "ivr", key + ".mp3")
-        if not os.path.isfile(outputPath):
-            synthesis_input = texttospeech.types.SynthesisInput(text=text_input[key])
-            response = client.synthesize_speech(synthesis_input, voice, audio_config)
-
-            with open(outputPath, "wb") as out:
-                # Write the response to the output file.
-                out.write(response.audio_content)
-                print('  Audio content written to file "' + outputPath + '" (relative to current dir).')
-
-            # Insert pause to not reach quota of calls per minute
-            time.sleep(0.2)
-
+def speechAvailable():
+    return os.getenv("GOOGLE_APPLICATION_CREDENTIALS") is not None
 
-# Generate sound bytes for all cities in SE.txt, without overwriting existing ones
-def generateCitySoundBytes():
-    print("Generating city sound bytes (skips existing)")
-    cities = getListOfCities("SE.txt")
-    for city in cities:
-        outputPath = os.path.join("media/sv", "city", city + ".mp3")
-        if not os.path.isfile(outputPath):
-            synthesis_input = texttospeech.types.SynthesisInput(text=city)
-            response = client.synthesize_speech(synthesis_input, voice, audio_config)
 
-            with open(outputPath, "wb") as out:
-                out.write(response.audio_content)
-                print('  Audio content written to file "' + outputPath + '"')
-
-            # Insert pause to not reach quota of calls per minute
-            time.sleep(0.15)
+"""
+Background synthesis queue
+"""
+SPEECH_CACHE_DIR = os.getenv("SPEECH_CACHE_DIR", os.path.join("media", "cache"))
+NAME_DIR = os.path.join("media/sv", "name")
+TTS_WORKERS = 2  # Synthesis requests in flight at the same time
+TTS_REQUESTS_PER_MINUTE = int(os.getenv("TTS_REQUESTS_PER_MINUTE", 300))  # Keep within the Google quota
+MANIFEST_NAME = "manifest.json"
+PROGRESS_INTERVAL = 10.0  # Seconds between progress reports of generatePrompts
+
+SYNTHESIS_SECONDS = Histogram(
+    "telehelp_tts_synthesis_seconds", "Duration of text-to-speech requests", ["outcome"]
+)
 
 
+class GoogleSynthesizer:
+    voice = VOICE_NAME
+    speakingRate = SPEAKING_RATE
+
+    def synthesize(self, text):
+        return synthesize(text)
+
+
+# Output: cache key of the audio for text spoken with the given voice and speaking rate
+def speechKey(text, voice, speakingRate):
+    return hashlib.sha256(f"{voice}\n{speakingRate}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _writeAtomic(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(data)
+    os.replace(tmp_path, path)
+
+
+class SpeechQueue:
+    """Synthesizes speech in the background.
+
+    Audio is cached in cacheDir under a hash of the text, voice and speaking rate, so
+    a text is only synthesized once per voice. Jobs for a text that is already being
+    synthesized join the running job, and requests to the synthesizer are limited to
+    requestsPerMinute, spread over a small pool of workers.
+    """
+
+    def __init__(
+        self,
+        synthesizer,
+        cacheDir=SPEECH_CACHE_DIR,
+        workers=TTS_WORKERS,
+        requestsPerMinute=TTS_REQUESTS_PER_MINUTE,
+    ):
+        self.synthesizer = synthesizer
+        self.cacheDir = cacheDir
+        self.bucket = TokenBucket(requestsPerMinute / 60, workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts")
+        self._inFlight = {}  # key -> (future, output paths)
+        self._lock = threading.Lock()
+
+    def cachePath(self, text):
+        key = speechKey(text, self.synthesizer.voice, self.synthesizer.speakingRate)
+        return os.path.join(self.cacheDir, key[:2], key + ".mp3")
+
+    # Input: text to speak, optional path to also write the audio to, whether to replace an existing outputPath
+    # Output: future of the cache path of the audio, already done if outputPath (or the cached audio) exists
+    def submit(self, text, outputPath=None, replace=False):
+        cached = self.cachePath(text)
+        if outputPath is None:
+            done = os.path.isfile(cached)
+        else:
+            done = not replace and os.path.isfile(outputPath)
+        with self._lock:
+            if done:
+                future = Future()
+                future.set_result(cached)
+                return future
+            job = self._inFlight.get(cached)
+            if job is None:
+                job = self._inFlight[cached] = (self._executor.submit(self._run, text, cached), set())
+                job[0].add_done_callback(self._logFailure)
+            if outputPath is not None:
+                job[1].add(outputPath)
+            return job[0]
+
+    def _run(self, text, cached):
+        try:
+            if not os.path.isfile(cached):
+                self.bucket.acquire()
+                start = time.perf_counter()
+                outcome = "error"
+                try:
+                    audio = self.synthesizer.synthesize(text)
+                    outcome = "ok"
+                finally:
+                    SYNTHESIS_SECONDS.observe(time.perf_counter() - start, outcome)
+                _writeAtomic(cached, audio)
+                print(f"  Synthesized {text!r}")
+        finally:
+            with self._lock:
+                _, outputPaths = self._inFlight.pop(cached)
+        for outputPath in outputPaths:
+            with open(cached, "rb") as audio:
+                _writeAtomic(outputPath, audio.read())
+            print(f'  Audio content written to file "{outputPath}"')
+        return cached
+
+    @staticmethod
+    def _logFailure(future):
+        if future.exception() is not None:
+            print(f"Speech synthesis failed: {future.exception()}")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+_speechQueue = None
+_speechQueueLock = threading.Lock()
+
+
+# Output: the process' SpeechQueue using Google text-to-speech
+def getSpeechQueue():
+    global _speechQueue
+    with _speechQueueLock:
+        if _speechQueue is None:
+            _speechQueue = SpeechQueue(GoogleSynthesizer())
+        return _speechQueue
+
+
+def namePath(name):
+    return os.path.join(NAME_DIR, name + ".mp3")
+
+
+class PromptManifest:
+    """manifest.json of a prompt directory, recording what each file was synthesized from.
+
+    A file is current if the hash of its text, the voice and the speaking rate all
+    match the manifest, so changing any of them regenerates exactly the files affected.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.entries = {}  # file name -> {"text_sha256", "voice", "speaking_rate"}
+        if os.path.isfile(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.entries = json.load(file)
+
+    @staticmethod
+    def entry(text, voice, speakingRate):
+        return {
+            "text_sha256": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+            "voice": voice,
+            "speaking_rate": speakingRate,
+        }
+
+    def isCurrent(self, fileName, entry):
+        return self.entries.get(fileName) == entry
+
+    def record(self, fileName, entry):
+        self.entries[fileName] = entry
+
+    def save(self):
+        _writeAtomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True).encode("utf-8"))
+
+
+# Input: {file name: text}, directory to write them to, number of parallel synthesis requests,
+#        whether to regenerate every file, synthesizer (Google text-to-speech if not given)
+# Output: number of files written and number of failures. Files matching the manifest are skipped, files
+#         that exist but are missing from it (made before there was a manifest) are assumed to be current.
+def generatePrompts(
+    prompts,
+    directory,
+    workers=TTS_WORKERS,
+    force=False,
+    reportInterval=PROGRESS_INTERVAL,
+    synthesizer=None,
+    cacheDir=SPEECH_CACHE_DIR,
+):
+    queue = SpeechQueue(synthesizer or GoogleSynthesizer(), cacheDir=cacheDir, workers=workers)
+    voice, speakingRate = queue.synthesizer.voice, queue.synthesizer.speakingRate
+    manifest = PromptManifest(directory)
+
+    futures = {}
+    for fileName, text in prompts.items():
+        entry = PromptManifest.entry(text, voice, speakingRate)
+        if not force and manifest.isCurrent(fileName, entry):
+            continue
+        outputPath = os.path.join(directory, fileName)
+        if not force and fileName not in manifest.entries and os.path.isfile(outputPath):
+            manifest.record(fileName, entry)
+            continue
+        futures[queue.submit(text, outputPath, replace=True)] = (fileName, entry)
+    print(f"{len(futures)} of {len(prompts)} prompts in {directory} need to be generated")
+
+    written = failed = 0
+    start = lastReport = time.monotonic()
+    try:
+        for future in as_completed(futures):
+            fileName, entry = futures[future]
+            if future.exception() is None:
+                manifest.record(fileName, entry)
+                written += 1
+            else:
+                failed += 1
+            now = time.monotonic()
+            if now - lastReport >= reportInterval:
+                lastReport = now
+                manifest.save()  # Lets an interrupted run continue where it stopped
+                rate = written / (now - start)
+                print(f"  {written + failed}/{len(futures)} done, {failed} failed, {rate:.1f} prompts/s")
+    finally:
+        manifest.save()
+        queue.close()
+    elapsed = time.monotonic() - start
+    print(f"Wrote {written} prompts to {directory} in {elapsed:.0f} s, {failed} failed")
+    return written, failed
+
+
+def generateSoundBytes(workers=TTS_WORKERS, force=False):
+    print("Generating IVR sound bytes")
+    prompts = {key + ".mp3": text for key, text in text_input.items()}
+    return generatePrompts(prompts, os.path.join("media/sv", "ivr"), workers=workers, force=force)
+
+
+# Generate sound bytes for all cities in SE.txt
+def generateCitySoundBytes(workers=TTS_WORKERS, force=False):
+    print("Generating city sound bytes")
+    prompts = {city + ".mp3": city for city in sorted(getListOfCities("SE.txt"))}
+    return generatePrompts(prompts, os.path.join("media/sv", "city"), workers=workers, force=force)
+
+
+# Synthesizes the name unless it already has a sound byte and waits for it. The api queues names with
+# getSpeechQueue().submit instead, so that requests never wait for synthesis.
 def generateNameSoundByte(name):
     print("Generating name sound bytes (skips existing)")
-    outputPath = os.path.join("media/sv", "name", name + ".mp3")
-    if not os.path.isfile(outputPath):
-        synthesis_input = texttospeech.types.SynthesisInput(text=name)
-        response = client.synthesize_speech(synthesis_input, voice, audio_config)
-
-        with open(outputPath, "wb") as out:
-            out.write(response.audio_content)
-            print('  Audio content written to file "' + outputPath + '"')
+    getSpeechQueue().submit(name, namePath(name)).result()
 
 
 def generateCustomSoundByte(text_string, filename, saveDir="/media/sv"):
-    # Set the text input to be synthesized
-    synthesis_input = texttospeech.types.SynthesisInput(text=text_string)
-
     # Perform the text-to-speech request on the text input with the selected
     # voice parameters and audio file type
-    response = client.synthesize_speech(synthesis_input, voice, audio_config)
+    audio = synthesize(text_string)
 
-    # The response's audio_content is binary.
     with open(os.path.join(saveDir, filename), "wb") as out:
         # Write the response to the output file.
-        out.write(response.audio_content)
+        out.write(audio)
         print("  Audio content written to file %s" % os.path.join(saveDir, filename))
 
 
 if __name__ == "__main__":
-    generateSoundBytes()
-    generateCitySoundBytes()
+    parser = argparse.ArgumentParser(description="Generate IVR and city sound bytes that are missing or stale")
+    parser.add_argument("--workers", type=int, default=4, help="parallel synthesis requests")
+    parser.add_argument("--force", action="store_true", help="regenerate every sound byte")
+    args = parser.parse_args()
+    generateSoundBytes(workers=args.workers, force=args.force)
+    generateCitySoundBytes(workers=args.workers, force=args.force)
@@ -0,0 +1,313 @@
+"""Tracing of calls across the webhooks that 46elks calls during them.
+
+Every request handled for a call becomes a span of the trace named by the call's
+telehelpCallId: receiveCall, handleNumberInput, checkZipcode, postcodeInput,
+call/N, connectUsers and so on. A span records the time spent in the server, the
+time spent in database statements and 46elks requests made while answering, and
+every 46elks request gets a span of its own, also when it is sent in the
+background after the webhook answered. The time between the spans is the time
+46elks, the caller or a volunteer took until the next webhook.
+
+Spans are buffered in memory and written in the background to TRACE_FILE (JSON
+lines) and/or sent to an OpenTelemetry collector at OTLP_ENDPOINT (OTLP/HTTP
+JSON). Tracing is off when neither is set. The waterfall of a call is printed by
+
+    python -m server.tracing <trace file> [telehelpCallId ...]
+"""
+import argparse
+import atexit
+import contextvars
+import json
+import os
+import secrets
+import threading
+import time
+import uuid
+from collections import defaultdict
+from collections import deque
+
+from .lazyImport import LazyModule
+
+requests = LazyModule("requests")
+
+TRACE_FILE = os.getenv("TRACE_FILE")
+OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT")  # e.g. http://localhost:4318
+SERVICE_NAME = "telehelp"
+MAX_BUFFERED = 10000  # Spans kept while the exporter is behind, the oldest are dropped beyond that
+FLUSH_INTERVAL = 2.0  # Seconds between exports
+OTLP_TIMEOUT = 5
+
+_currentSpan = contextvars.ContextVar("span", default=None)
+
+
+# Output: 32 hex digit trace id of a telehelpCallId (a uuid), None for anything else
+def traceIdOf(telehelpCallId):
+    try:
+        return uuid.UUID(telehelpCallId).hex
+    except (TypeError, ValueError):
+        return None
+
+
+class Span:
+    def __init__(self, name, traceId=None, parentId=None, attributes=None):
+        self.name = name
+        self.traceId = traceId
+        self.spanId = secrets.token_hex(8)
+        self.parentId = parentId
+        self.attributes = dict(attributes or {})
+        self.start = time.time_ns()
+        self.end = None
+        self.thread = threading.get_ident()
+        self.dbSeconds = 0.0
+        self.dbQueries = 0
+        self.elksSeconds = 0.0
+
+    def asDict(self):
+        attributes = {key: value for key, value in self.attributes.items() if value is not None}
+        if self.dbQueries:
+            attributes.update({"db.ms": round(self.dbSeconds * 1000, 3), "db.queries": self.dbQueries})
+        if self.elksSeconds:
+            attributes["elks.ms"] = round(self.elksSeconds * 1000, 3)
+        return {
+            "trace_id": self.traceId,
+            "span_id": self.spanId,
+            "parent_id": self.parentId,
+            "name": self.name,
+            "start_ns": self.start,
+            "end_ns": self.end,
+            "attributes": attributes,
+        }
+
+
+# Makes the current request's span part of the call's trace, for hops that start a call
+def setTraceId(telehelpCallId):
+    span = _currentSpan.get()
+    if span is not None:
+        span.traceId = traceIdOf(telehelpCallId)
+
+
+class Tracer:
+    def __init__(self, exporters, maxBuffered=MAX_BUFFERED, flushInterval=FLUSH_INTERVAL):
+        self.exporters = exporters
+        self.dropped = 0
+        self._buffer = deque()
+        self._maxBuffered = maxBuffered
+        self._lock = threading.Lock()
+        self._exportLock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flushEvery, args=(flushInterval,), daemon=True)
+        self._flusher.start()
+
+    # Input: name, e.g. the route's function, telehelpCallId if known
+    # Output: (span, token), the span is current in this context until endSpan(span, token)
+    def startSpan(self, name, telehelpCallId=None, attributes=None):
+        span = Span(name, traceIdOf(telehelpCallId), attributes=attributes)
+        return span, _currentSpan.set(span)
+
+    def endSpan(self, span, token=None, **attributes):
+        span.end = time.time_ns()
+        span.attributes.update(attributes)
+        if token is not None:
+            _currentSpan.reset(token)
+        self._add(span)
+
+    def _add(self, span):
+        if span.traceId is None:
+            return  # Not part of a call
+        with self._lock:
+            if len(self._buffer) >= self._maxBuffered:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(span.asDict())
+
+    # Query listener of databaseIntegration
+    def recordQuery(self, query, params, seconds):
+        span = _currentSpan.get()
+        if span is not None and span.end is None:
+            span.dbSeconds += seconds
+            span.dbQueries += 1
+
+    # Request listener of elksClient. Requests sent in the background run in a copy of the context of the
+    # request that sent them, so they are traced as part of its call.
+    def recordElksRequest(self, path, seconds, error):
+        parent = _currentSpan.get()
+        if parent is None:
+            return
+        if parent.end is None and parent.thread == threading.get_ident():
+            parent.elksSeconds += seconds
+        span = Span(f"46elks {path}", parent.traceId, parent.spanId, {"error": error})
+        span.end = time.time_ns()
+        span.start = span.end - int(seconds * 1e9)
+        self._add(span)
+
+    def flush(self):
+        with self._exportLock:
+            with self._lock:
+                spans = list(self._buffer)
+                self._buffer.clear()
+            if not spans:
+                return
+            for exporter in self.exporters:
+                try:
+                    exporter.export(spans)
+                except Exception as err:
+                    print(f"Failed to export {len(spans)} spans with {type(exporter).__name__}: {err}")
+
+    def _flushEvery(self, interval):
+        while not self._closed.wait(interval):
+            self.flush()
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+
+
+class JsonLinesExporter:
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.writelines(json.dumps(span, ensure_ascii=False) + "\n" for span in spans)
+
+
+def _otlpValue(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+# Output: the OTLP/JSON ExportTraceServiceRequest of spans
+def otlpPayload(spans, serviceName=SERVICE_NAME):
+    otlpSpans = []
+    for span in spans:
+        otlpSpan = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 3 if span["parent_id"] else 2,  # Client for 46elks requests, server for webhooks
+            "startTimeUnixNano": str(span["start_ns"]),
+            "endTimeUnixNano": str(span["end_ns"]),
+            "attributes": [{"key": key, "value": _otlpValue(v)} for key, v in span["attributes"].items()],
+        }
+        if span["parent_id"]:
+            otlpSpan["parentSpanId"] = span["parent_id"]
+        otlpSpans.append(otlpSpan)
+    resource = {"attributes": [{"key": "service.name", "value": {"stringValue": serviceName}}]}
+    scopeSpans = [{"scope": {"name": __name__}, "spans": otlpSpans}]
+    return {"resourceSpans": [{"resource": resource, "scopeSpans": scopeSpans}]}
+
+
+class OtlpExporter:
+    def __init__(self, endpoint, timeout=OTLP_TIMEOUT):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.timeout = timeout
+
+    def export(self, spans):
+        response = requests.post(self.url, json=otlpPayload(spans), timeout=self.timeout)
+        response.raise_for_status()
+
+
+_tracer = None
+_tracerLock = threading.Lock()
+
+
+# Output: the process' Tracer exporting to TRACE_FILE and OTLP_ENDPOINT, None if neither is set
+def getTracer():
+    global _tracer
+    with _tracerLock:
+        if _tracer is None:
+            exporters = []
+            if TRACE_FILE:
+                exporters.append(JsonLinesExporter(TRACE_FILE))
+            if OTLP_ENDPOINT:
+                exporters.append(OtlpExporter(OTLP_ENDPOINT))
+            if not exporters:
+                return None
+            _tracer = Tracer(exporters)
+            atexit.register(_tracer.close)
+        return _tracer
+
+
+"""
+Waterfall view
+"""
+
+
+def readTraces(path):
+    traces = defaultdict(list)
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            span = json.loads(line)
+            traces[span["trace_id"]].append(span)
+    for spans in traces.values():
+        spans.sort(key=lambda span: span["start_ns"])
+    return traces
+
+
+# Output: lines of a waterfall of the spans of one call, one line per span with a bar in a column of width
+def renderWaterfall(spans, width=40):
+    first = spans[0]["start_ns"]
+    total = max(span["end_ns"] for span in spans) - first
+    scale = width / total if total > 0 else 0
+    ms = 1e6
+    lines = [f"{'start s':>9} {'gap s':>7} {'hop':32} {'server ms':>9} {'db ms':>8} {'46elks ms':>9}"]
+    lastEnd = first
+    gaps = server = db = elks = 0
+    for span in spans:
+        duration = span["end_ns"] - span["start_ns"]
+        attributes = span["attributes"]
+        if span["parent_id"]:
+            gap = ""
+            name = "  " + span["name"]
+            serverMs, elksMs = "", f"{duration / ms:9.1f}"
+        else:
+            gapNs = max(0, span["start_ns"] - lastEnd)
+            gaps += gapNs
+            server += duration
+            db += attributes.get("db.ms", 0) * ms
+            elks += attributes.get("elks.ms", 0) * ms
+            lastEnd = max(lastEnd, span["end_ns"])
+            gap = f"{gapNs / 1e9:7.2f}"
+            name = span["name"]
+            serverMs, elksMs = f"{duration / ms:9.1f}", f"{attributes.get('elks.ms', 0):9.1f}"
+        start = span["start_ns"] - first
+        bar = " " * int(start * scale) + "#" * max(1, int(duration * scale))
+        dbMs = f"{attributes['db.ms']:8.1f}" if "db.ms" in attributes else ""
+        lines.append(f"{start / 1e9:9.2f} {gap:>7} {name:32} {serverMs:>9} {dbMs:>8} {elksMs:>9} |{bar}")
+    lines.append(
+        f"{total / 1e9:.2f} s in total: {server / ms:.1f} ms in the server ({db / ms:.1f} ms database, "
+        f"{elks / ms:.1f} ms 46elks), {gaps / 1e9:.2f} s waiting for 46elks, callers and volunteers"
+    )
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Waterfall of traced calls")
+    parser.add_argument("file", help="Trace file (TRACE_FILE)")
+    parser.add_argument("calls", nargs="*", help="telehelpCallIds to show, default: list the slowest calls")
+    parser.add_argument("--top", type=int, default=20, help="Number of calls listed")
+    args = parser.parse_args()
+
+    traces = readTraces(args.file)
+    if not args.calls:
+        calls = []
+        for traceId, spans in traces.items():
+            duration = max(span["end_ns"] for span in spans) - spans[0]["start_ns"]
+            calls.append((duration, traceId, spans))
+        for duration, traceId, spans in sorted(calls, reverse=True)[: args.top]:
+            hops = " -> ".join(span["name"] for span in spans if not span["parent_id"])
+            print(f"{uuid.UUID(traceId)} {duration / 1e9:8.2f} s  {hops}")
+    for call in args.calls:
+        spans = traces.get(traceIdOf(call))
+        if not spans:
+            print(f"No spans of {call}")
+            continue
+        print(f"Call {call}")
+        print("\n".join(renderWaterfall(spans)))
+        print()
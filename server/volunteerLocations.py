@@ -0,0 +1,189 @@
+"""Volunteer counts per zipcode for the public map (/getVolunteerLocations).
+
+The counts are kept in the helper_zipcode_counts table by triggers on user_helpers,
+both created by the schema migrations, so every registration, deletion or zipcode
+change updates them in the same transaction, whichever process makes it.
+helper_counts_version is bumped at the same time. Workers keep the rendered
+response and only rebuild it when the version has changed, and the response
+carries an ETag so browsers can revalidate without downloading it again.
+
+For the map itself, tile(zoom, x, y) groups the volunteers in one slippy map tile
+into at most TILE_GRID x TILE_GRID clusters, so the client downloads a constant
+amount per visible tile however many volunteers there are.
+"""
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from collections import OrderedDict
+
+import numpy as np
+
+from .zipcode_utils import lookupLocations
+
+VERSION_CHECK_INTERVAL = 5.0  # Seconds a rendered response is served before the version is checked again
+TILE_GRID = 8  # A map tile is split into TILE_GRID x TILE_GRID cells, each giving at most one cluster
+TILE_CACHE_SIZE = 1024  # Rendered tiles kept per worker
+MAX_ZOOM = 19
+MAX_LATITUDE = 85.0511  # Edge of the Web Mercator map
+
+
+class SqliteVolunteerCounts:
+    """helper_zipcode_counts of a SQLite (or SQLCipher) database.
+
+    connect is a function returning a context manager yielding a connection, such as
+    ConnectionPool.connection.
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    def version(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT version FROM helper_counts_version").fetchone()[0]
+
+    # Output: (version, list of (zipcode, count)). The version is read first, a change made in between
+    #         leaves it behind the counts and only causes one extra rebuild.
+    def counts(self):
+        with self.connect() as conn:
+            version = conn.execute("SELECT version FROM helper_counts_version").fetchone()[0]
+            rows = conn.execute("SELECT zipcode, count FROM helper_zipcode_counts").fetchall()
+        return version, rows
+
+
+# Input: list of (zipcode, count), zipcode location, district and city lookups
+# Output: the /getVolunteerLocations response, districts and zipcodes with the most volunteers first
+def renderVolunteerLocations(counts, location_dict, district_dict, city_dict):
+    counts = sorted(counts, key=lambda row: (-row[1], str(row[0])))
+    lats, lons, found = lookupLocations([zipCode for zipCode, _ in counts], location_dict)
+
+    district_data = defaultdict(list)
+    for (zipCode, count), lat, lon, known in zip(counts, lats, lons, found):
+        z = int(zipCode)  # Should change this to use string if we have the time
+        entry = {
+            "coordinates": (float(lat), float(lon)) if known else None,
+            "city": city_dict.get(z),
+            "zipcode": zipCode,
+            "count": count,
+        }
+        district_data[district_dict.get(z)].append(entry)
+
+    return {
+        "total": sum(count for _, count in counts),
+        "locations": [{"district": key, "data": val} for key, val in district_data.items()],
+    }
+
+
+# Input: arrays of latitudes and longitudes in degrees
+# Output: Web Mercator x and y, both from 0 to 1 with y growing southwards, as used by map tiles
+def mercator(lats, lons):
+    lats = np.clip(lats, -MAX_LATITUDE, MAX_LATITUDE)
+    x = (np.asarray(lons) + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(np.radians(lats)) + 1 / np.cos(np.radians(lats))) / math.pi) / 2.0
+    return x, y
+
+
+class VolunteerPoints:
+    """Zipcodes with volunteers as arrays, for clustering into map tiles."""
+
+    def __init__(self, counts, location_dict, city_dict):
+        lats, lons, found = lookupLocations([zipCode for zipCode, _ in counts], location_dict)
+        self.zipcodes = [zipCode for (zipCode, _), known in zip(counts, found) if known]
+        self.counts = np.array([count for _, count in counts], dtype=np.int64)[found]
+        self.lats = lats[found]
+        self.lons = lons[found]
+        self.x, self.y = mercator(self.lats, self.lons)
+        self.city_dict = city_dict
+        self.total = sum(count for _, count in counts)
+
+    # Input: slippy map tile (zoom, x, y)
+    # Output: the tile's volunteers grouped into at most TILE_GRID x TILE_GRID clusters. A cluster is placed
+    #         at the volunteer weighted mean of its zipcodes, a cluster of one zipcode also names it.
+    def cluster(self, zoom, x, y):
+        scale = 2 ** zoom
+        tx = self.x * scale - x
+        ty = self.y * scale - y
+        inside = np.flatnonzero((tx >= 0) & (tx < 1) & (ty >= 0) & (ty < 1))
+        cells = (
+            np.minimum((ty[inside] * TILE_GRID).astype(np.int64), TILE_GRID - 1) * TILE_GRID
+            + np.minimum((tx[inside] * TILE_GRID).astype(np.int64), TILE_GRID - 1)
+        )
+        counts = self.counts[inside]
+        size = TILE_GRID * TILE_GRID
+        volunteers = np.bincount(cells, weights=counts, minlength=size)
+        zipcodes = np.bincount(cells, minlength=size)
+        latSums = np.bincount(cells, weights=self.lats[inside] * counts, minlength=size)
+        lonSums = np.bincount(cells, weights=self.lons[inside] * counts, minlength=size)
+        # The point of a single zipcode cell is the only one summed into it
+        pointSums = np.bincount(cells, weights=inside, minlength=size)
+
+        clusters = []
+        for cell in np.flatnonzero(zipcodes):
+            n = volunteers[cell]
+            cluster = {
+                "coordinates": (round(latSums[cell] / n, 4), round(lonSums[cell] / n, 4)),
+                "count": int(n),
+            }
+            if zipcodes[cell] == 1:
+                zipCode = self.zipcodes[int(pointSums[cell])]
+                cluster["zipcode"] = zipCode
+                cluster["city"] = self.city_dict.get(int(zipCode))
+            clusters.append(cluster)
+        return {"zoom": zoom, "x": x, "y": y, "total": self.total, "clusters": clusters}
+
+
+class VolunteerLocations:
+    def __init__(self, store, location_dict, district_dict, city_dict, checkInterval=VERSION_CHECK_INTERVAL):
+        self.store = store
+        self.location_dict = location_dict
+        self.district_dict = district_dict
+        self.city_dict = city_dict
+        self.checkInterval = checkInterval
+        self._version = None
+        self._response = None  # (etag, JSON body)
+        self._points = None
+        self._tiles = OrderedDict()  # (zoom, x, y) -> (etag, JSON body), least recently used first
+        self._checkedAt = float("-inf")
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._checkedAt < self.checkInterval:
+            return
+        if self._version is None or self.store.version() != self._version:
+            self._version, counts = self.store.counts()
+            body = json.dumps(
+                renderVolunteerLocations(counts, self.location_dict, self.district_dict, self.city_dict)
+            ).encode("utf-8")
+            self._response = (hashlib.sha1(body).hexdigest()[:20], body)
+            self._points = VolunteerPoints(counts, self.location_dict, self.city_dict)
+            self._tiles.clear()
+        self._checkedAt = now
+
+    # Output: (etag, JSON body) of the current response
+    def current(self):
+        with self._lock:
+            self._refresh()
+            return self._response
+
+    # Input: slippy map tile (zoom, x, y), checked by the caller
+    # Output: (etag, JSON body) of the tile's clusters, see VolunteerPoints.cluster
+    def tile(self, zoom, x, y):
+        with self._lock:
+            self._refresh()
+            key = (zoom, x, y)
+            response = self._tiles.get(key)
+            if response is not None:
+                self._tiles.move_to_end(key)
+                return response
+            points = self._points
+        body = json.dumps(points.cluster(zoom, x, y)).encode("utf-8")
+        response = (hashlib.sha1(body).hexdigest()[:20], body)
+        with self._lock:
+            if self._points is points:
+                self._tiles[key] = response
+                while len(self._tiles) > TILE_CACHE_SIZE:
+                    self._tiles.popitem(last=False)
+        return response
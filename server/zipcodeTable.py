@@ -0,0 +1,198 @@
+"""Compiled, memory-mapped version of the GeoNames zip code data (SE.txt).
+
+Parsing SE.txt into dicts takes time at every worker start and leaves each worker
+with its own copy. The build step below writes the same data as sorted int32 zip
+codes, float32 coordinates and indexes into small district and city string tables.
+Workers mmap the file read-only, so the arrays are shared through the page cache.
+
+Build it from the repository root with
+
+    python -m server.zipcodeTable server/SE.txt
+
+The views returned by loadZipCodeData behave like the dicts from readZipCodeData,
+so getDistrict, getCity and getDistanceApart work unchanged.
+"""
+import mmap
+import os
+import struct
+import sys
+from collections.abc import Mapping
+
+import numpy as np
+
+from .zipcode_utils import MAX_ZIPCODE
+from .zipcode_utils import readZipCodeData
+
+MAGIC = b"ZIPT"
+VERSION = 1
+HEADER = struct.Struct("<4sIIII")  # magic, version, number of zip codes, number of districts, number of cities
+COORDINATE_DECIMALS = 4  # Precision of the coordinates in SE.txt, undoes float32 rounding noise
+
+
+def compiledPath(file_name):
+    return os.path.splitext(file_name)[0] + ".zipt"
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _layout(n, nStrings):
+    # Offsets of the arrays following the header, each 8-byte aligned
+    offsets = {}
+    offset = _align(HEADER.size)
+    for name, dtype, count in (
+        ("zips", np.int32, n),
+        ("lats", np.float32, n),
+        ("lons", np.float32, n),
+        ("districts", np.uint16, n),
+        ("cities", np.uint16, n),
+        ("stringOffsets", np.uint32, nStrings + 1),
+    ):
+        offsets[name] = (offset, dtype, count)
+        offset = _align(offset + np.dtype(dtype).itemsize * count)
+    offsets["strings"] = offset
+    return offsets
+
+
+def compileZipCodeData(file_name, out_name=None):
+    out_name = out_name or compiledPath(file_name)
+    location_dict, district_dict, city_dict = readZipCodeData(file_name)
+
+    zips = np.array(sorted(location_dict), dtype=np.int32)
+    coords = np.array([location_dict[z] for z in zips.tolist()], dtype=np.float64).reshape(-1, 2)
+    districtNames = sorted(set(district_dict.values()))
+    cityNames = sorted(set(city_dict.values()))
+    districtIdx = {name: i for i, name in enumerate(districtNames)}
+    cityIdx = {name: i for i, name in enumerate(cityNames)}
+
+    encoded = [name.encode("utf-8") for name in districtNames + cityNames]
+    stringOffsets = np.cumsum([0] + [len(s) for s in encoded], dtype=np.uint32)
+    arrays = {
+        "zips": zips,
+        "lats": coords[:, 0].astype(np.float32),
+        "lons": coords[:, 1].astype(np.float32),
+        "districts": np.array([districtIdx[district_dict[z]] for z in zips.tolist()], dtype=np.uint16),
+        "cities": np.array([cityIdx[city_dict[z]] for z in zips.tolist()], dtype=np.uint16),
+        "stringOffsets": stringOffsets,
+    }
+
+    layout = _layout(len(zips), len(encoded))
+    buffer = bytearray(layout["strings"] + int(stringOffsets[-1]))
+    HEADER.pack_into(buffer, 0, MAGIC, VERSION, len(zips), len(districtNames), len(cityNames))
+    for name, array in arrays.items():
+        offset, dtype, count = layout[name]
+        data = array.astype(dtype).tobytes()
+        buffer[offset : offset + len(data)] = data
+    buffer[layout["strings"] :] = b"".join(encoded)
+
+    # Write next to the destination and rename, so running workers never see a half written table
+    tmp_name = out_name + ".tmp"
+    with open(tmp_name, "wb") as file:
+        file.write(buffer)
+    os.replace(tmp_name, out_name)
+    return out_name
+
+
+class ZipCodeTable:
+    def __init__(self, file_name):
+        with open(file_name, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, nDistricts, nCities = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{file_name} is not a version {VERSION} zip code table")
+
+        layout = _layout(n, nDistricts + nCities)
+        arrays = {}
+        for name, value in layout.items():
+            if name != "strings":
+                offset, dtype, count = value
+                arrays[name] = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+        self.zips = arrays["zips"]
+        self.lats = arrays["lats"]
+        self.lons = arrays["lons"]
+        self.districtIdx = arrays["districts"]
+        self.cityIdx = arrays["cities"]
+
+        offsets = arrays["stringOffsets"].tolist()
+        blob = self._mmap[layout["strings"] : layout["strings"] + offsets[-1]]
+        names = [sys.intern(blob[start:end].decode("utf-8")) for start, end in zip(offsets, offsets[1:])]
+        self.districtNames = names[:nDistricts]
+        self.cityNames = names[nDistricts:]
+
+    def __len__(self):
+        return len(self.zips)
+
+    # Output: row of the zip code in the table, raises KeyError if it is not there
+    def find(self, zipcode):
+        try:
+            z = int(zipcode)
+        except (TypeError, ValueError):
+            raise KeyError(zipcode)
+        if not 0 <= z <= MAX_ZIPCODE:  # Doesn't fit the int32 zip codes
+            raise KeyError(zipcode)
+        i = int(np.searchsorted(self.zips, z))
+        if i == len(self.zips) or self.zips[i] != z:
+            raise KeyError(zipcode)
+        return i
+
+
+class _TableView(Mapping):
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, zipcode):
+        return self._value(self.table.find(zipcode))
+
+    def __iter__(self):
+        return iter(self.table.zips.tolist())
+
+    def __len__(self):
+        return len(self.table)
+
+
+class LocationView(_TableView):
+    _arrays = None
+
+    def _value(self, i):
+        return (
+            round(float(self.table.lats[i]), COORDINATE_DECIMALS),
+            round(float(self.table.lons[i]), COORDINATE_DECIMALS),
+        )
+
+    # Used by zipcode_utils.getLocationArrays instead of building its own sorted copy
+    def locationArrays(self):
+        if self._arrays is None:
+            self._arrays = (
+                self.table.zips,
+                np.round(self.table.lats.astype(np.float64), COORDINATE_DECIMALS),
+                np.round(self.table.lons.astype(np.float64), COORDINATE_DECIMALS),
+            )
+        return self._arrays
+
+
+class DistrictView(_TableView):
+    def _value(self, i):
+        return self.table.districtNames[self.table.districtIdx[i]]
+
+
+class CityView(_TableView):
+    def _value(self, i):
+        return self.table.cityNames[self.table.cityIdx[i]]
+
+
+# Input: path to zip code file (e.g. SE.txt)
+# Output: location, district and city lookups like readZipCodeData. Served from the compiled table when
+# it is at least as new as the text file, otherwise parsed from the text file.
+def loadZipCodeData(file_name):
+    table_name = compiledPath(file_name)
+    if os.path.isfile(table_name) and os.path.getmtime(table_name) >= os.path.getmtime(file_name):
+        table = ZipCodeTable(table_name)
+        return LocationView(table), DistrictView(table), CityView(table)
+    print(f"No up to date {table_name}, parsing {file_name}. Build it with python -m server.zipcodeTable")
+    return readZipCodeData(file_name)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:] or ["SE.txt"]:
+        print(f"Compiled {path} -> {compileZipCodeData(path)}")
@@ -0,0 +1,139 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from server.analyticsWriter import AnalyticsWriter
+from server.migrations import migrate
+
+CUSTOMER = "call_analytics_customer"
+HELPER = "call_analytics_helper"
+
+
+class TestAnalyticsWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.conn = sqlite3.connect(os.path.join(self.dir, "telehelp.db"), check_same_thread=False)
+        migrate(self.conn)
+        self.batches = []  # (time, statements) of the batches written
+        self.failures = 0  # Batches to fail before writing succeeds
+        self.written = threading.Event()
+        self.writers = []
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.close()
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def writeBatch(self, statements):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        with self.conn:
+            for query, params in statements:
+                self.conn.execute(query, params)
+        self.batches.append((time.monotonic(), statements))
+        self.written.set()
+
+    def startWriter(self, **kwargs):
+        writer = AnalyticsWriter(self.writeBatch, **kwargs)
+        self.writers.append(writer)
+        return writer
+
+    def rows(self, table, columns):
+        return self.conn.execute(f"SELECT telehelp_callid, {columns} FROM {table} ORDER BY rowid").fetchall()
+
+    def test_mergedUpdates(self):
+        writer = self.startWriter(flushInterval=60)
+        writer.record(CUSTOMER, "call", {"call_start_time": "12:00", "new_customer": "True"})
+        writer.record(CUSTOMER, "call", {"match_found": "False"})
+        writer.record(CUSTOMER, "call", {"match_found": "True", "n_helpers_contacted": "2"})
+        writer.record(HELPER, "call", {"contacted_prev_customer": "False"})
+        self.assertTrue(writer.flush())
+        [(_, statements)] = self.batches
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(
+            self.rows(CUSTOMER, "call_start_time, new_customer, match_found, n_helpers_contacted"),
+            [("call", "12:00", "True", "True", "2")],
+        )
+
+        # A later batch updates the columns it has and keeps the others
+        writer.record(CUSTOMER, "call", {"call_end_time": "12:05"})
+        self.assertTrue(writer.flush())
+        self.assertEqual(self.rows(CUSTOMER, "call_start_time, call_end_time"), [("call", "12:00", "12:05")])
+        self.assertEqual(self.rows(HELPER, "contacted_prev_customer"), [("call", "False")])
+        self.assertTrue(writer.flush())  # Nothing queued, nothing written
+        self.assertEqual(len(self.batches), 2)
+
+    def test_flushInterval(self):
+        writer = self.startWriter(flushInterval=0.3)
+        start = time.monotonic()
+        writer.record(CUSTOMER, "call", {"match_found": "True"})
+        self.assertTrue(self.written.wait(5))
+        self.assertGreaterEqual(self.batches[0][0] - start, 0.25)
+        self.assertEqual(self.rows(CUSTOMER, "match_found"), [("call", "True")])
+
+    def test_flushSize(self):
+        writer = self.startWriter(flushInterval=60, flushSize=5)
+        for i in range(4):
+            writer.record(CUSTOMER, f"call {i}", {"match_found": "True"})
+            writer.record(CUSTOMER, f"call {i}", {"match_found": "False"})  # Same call, not counted again
+        self.assertFalse(self.written.wait(0.3))
+        writer.record(CUSTOMER, "call 4", {"match_found": "True"})
+        self.assertTrue(self.written.wait(5))
+        self.assertEqual(len(self.batches[0][1]), 5)
+
+    def test_failedWriteIsRetried(self):
+        self.failures = 1
+        writer = self.startWriter(flushInterval=60)
+        writer.record(CUSTOMER, "call", {"match_found": "False", "new_customer": "True"})
+        self.assertFalse(writer.flush())
+        self.assertEqual(self.batches, [])
+
+        # Recorded after the failed batch was taken, so newer than what it held
+        writer.record(CUSTOMER, "call", {"match_found": "True"})
+        self.assertTrue(writer.flush())
+        self.assertEqual(self.rows(CUSTOMER, "match_found, new_customer"), [("call", "True", "True")])
+
+    def test_badRowIsDropped(self):
+        writer = self.startWriter(flushInterval=60, maxAttempts=2)
+        writer.record(CUSTOMER, "call", {"match_found": "True"})
+        writer.record(CUSTOMER, "bad call", {"no_such_column": "True"})
+        writer.record(HELPER, "call", {"deregistered": "True"})
+        self.assertFalse(writer.flush())
+        self.assertEqual(self.batches, [])
+
+        # The second failure writes the rows one by one and gives up on the bad one
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(self.rows(CUSTOMER, "match_found"), [("call", "True")])
+        self.assertEqual(self.rows(HELPER, "deregistered"), [("call", "True")])
+        self.assertEqual(writer._pending, {})
+
+        # Later batches are written whole again
+        writer.record(CUSTOMER, "call", {"new_customer": "False"})
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(self.batches[2][1]), 1)
+
+    def test_retriedByThread(self):
+        self.failures = 1
+        writer = self.startWriter(flushInterval=0.1)
+        writer.record(CUSTOMER, "call", {"match_found": "True"})
+        self.assertTrue(self.written.wait(5))
+        self.assertEqual(self.failures, 0)
+        self.assertEqual(self.rows(CUSTOMER, "match_found"), [("call", "True")])
+
+    def test_flushedOnClose(self):
+        writer = self.startWriter(flushInterval=60)
+        writer.record(HELPER, "call", {"deregistered": "True"})
+        writer.close()
+        self.assertEqual(self.rows(HELPER, "deregistered"), [("call", "True")])
+        self.assertEqual(len(self.batches), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
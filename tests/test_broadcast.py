@@ -0,0 +1,108 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+from server.broadcast import BroadcastCheckpoint
+from server.broadcast import FAILED
+from server.broadcast import SENDING
+from server.broadcast import MESSAGE
+from server.broadcast import SENT
+from server.broadcast import SmsBroadcast
+from server.rateLimit import TokenBucket
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ""
+
+
+class FakeElks:
+    def __init__(self, unreachable=()):
+        self.sent = []
+        self.unreachable = set(unreachable)
+        self._lock = threading.Lock()
+
+    def sendSms(self, fields, wait=False):
+        if fields["to"] in self.unreachable:
+            raise requests.ConnectionError("connection refused")
+        with self._lock:
+            self.sent.append(fields["to"])
+        return FakeResponse(200)
+
+
+def numbers(n):
+    return [f"+467000{i:05d}" for i in range(n)]
+
+
+class TestSmsBroadcast(unittest.TestCase):
+    def setUp(self):
+        handle, self.checkpointPath = tempfile.mkstemp(suffix=".checkpoint")
+        os.close(handle)
+
+    def tearDown(self):
+        for path in (self.checkpointPath, self.checkpointPath + ".done"):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def broadcast(self, elks, targets, **kwargs):
+        checkpoint = BroadcastCheckpoint(self.checkpointPath, "Hej")
+        try:
+            return SmsBroadcast(elks, "Hej", checkpoint, rate=1000, burst=50, **kwargs).run(targets)
+        finally:
+            checkpoint.close()
+
+    def test_tokenBucket(self):
+        bucket = TokenBucket(rate=50, burst=5)
+        start = time.monotonic()
+        for _ in range(15):
+            bucket.acquire()
+        # 5 from the burst, 10 more at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_broadcast(self):
+        targets = numbers(50)
+        elks = FakeElks(unreachable=targets[:2])
+        stats = self.broadcast(elks, iter(targets + ["0701234567", targets[10]]))
+        self.assertEqual(sorted(elks.sent), targets[2:])
+        self.assertEqual(stats.counts[SENT], 48)
+        self.assertEqual(stats.counts[FAILED], 2)
+        self.assertEqual(stats.counts["invalid"], 1)
+        self.assertEqual(stats.counts["resumed"], 1)
+
+    def test_resume(self):
+        targets = numbers(20)
+        self.broadcast(FakeElks(unreachable=targets[:1]), targets[:5])
+        # The process died while sending to the sixth number
+        checkpoint = BroadcastCheckpoint(self.checkpointPath, "Hej")
+        checkpoint.mark(targets[5], SENDING)
+        checkpoint.close()
+
+        elks = FakeElks()
+        stats = self.broadcast(elks, targets)
+        # The failed number is tried again, the one cut off mid request is not
+        self.assertEqual(sorted(elks.sent), [targets[0]] + targets[6:])
+        self.assertEqual(stats.counts["resumed"], 5)
+
+    def test_checkpointOfOneMessage(self):
+        checkpoint = BroadcastCheckpoint(self.checkpointPath, "Hej")
+        checkpoint.mark("+46700000001", SENT)
+        checkpoint.close()
+        with open(self.checkpointPath, encoding="utf-8") as file:
+            self.assertTrue(file.readline().startswith(MESSAGE + "\t"))
+        with self.assertRaises(ValueError):
+            BroadcastCheckpoint(self.checkpointPath, "Hej då")
+
+        checkpoint = BroadcastCheckpoint(self.checkpointPath, "Hej")
+        self.assertEqual(checkpoint.done, {"+46700000001"})
+        self.assertEqual(checkpoint.finish(), self.checkpointPath + ".done")
+        self.assertFalse(os.path.exists(self.checkpointPath))
+        self.assertTrue(os.path.isfile(self.checkpointPath + ".done"))
+
+
+if __name__ == "__main__":
+    unittest.main()
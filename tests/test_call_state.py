@@ -0,0 +1,95 @@
+import importlib.util
+import os
+import unittest
+import uuid
+
+import redis
+
+from server.callState import CALL
+from server.callState import DUPLICATE
+from server.callState import EXHAUSTED
+from server.callState import HUNG_UP
+from server.callState import InMemoryCallStateStore
+from server.callState import MISSING
+from server.callState import REDIS_URL
+from server.callState import RedisCallStateStore
+
+
+# The same cases for every store, mixed into one TestCase per store
+class CallStateStoreCases:
+    def createStore(self, ttl=60):
+        raise NotImplementedError
+
+    def test_dialChain(self):
+        store = self.createStore()
+        store.startCall("c1", ["+46700000001", "+46700000002"])
+        self.assertEqual(store.getHelpers("c1"), ["+46700000001", "+46700000002"])
+        self.assertFalse(store.isHungUp("c1"))
+
+        self.assertEqual(store.claimHelper("c1", 0), (CALL, "+46700000001"))
+        self.assertEqual(store.claimHelper("c1", 1), (CALL, "+46700000002"))
+        # "next" and "whenhangup" of the same call both lead to the next index
+        self.assertEqual(store.claimHelper("c1", 1), (DUPLICATE, None))
+        self.assertEqual(store.claimHelper("c1", 0), (DUPLICATE, None))
+        self.assertEqual(store.claimHelper("c1", 2), (EXHAUSTED, None))
+        self.assertTrue(store.isHungUp("c1"))
+        self.assertEqual(store.claimHelper("c1", 3), (HUNG_UP, None))
+
+        # Starting the call again resets its state
+        store.startCall("c1", ["+46700000003"])
+        self.assertEqual(store.claimHelper("c1", 0), (CALL, "+46700000003"))
+
+    def test_hangup(self):
+        store = self.createStore()
+        store.startCall("c1", ["+46700000001"])
+        self.assertFalse(store.hangup("c1"))
+        self.assertTrue(store.hangup("c1"))
+        self.assertTrue(store.isHungUp("c1"))
+        self.assertEqual(store.claimHelper("c1", 0), (HUNG_UP, None))
+        self.assertEqual(store.claimHelper("unknown", 0), (MISSING, None))
+        self.assertTrue(store.hangup("unknown"))
+        self.assertTrue(store.isHungUp("unknown"))
+        self.assertIsNone(store.getHelpers("unknown"))
+
+    def test_expiry(self):
+        store = self.createStore(ttl=0)
+        store.startCall("c1", ["+46700000001"])
+        self.assertIsNone(store.getHelpers("c1"))
+        self.assertTrue(store.isHungUp("c1"))
+        self.assertEqual(store.claimHelper("c1", 0), (MISSING, None))
+
+
+class TestInMemoryCallStateStore(CallStateStoreCases, unittest.TestCase):
+    def createStore(self, ttl=60):
+        return InMemoryCallStateStore(ttl=ttl)
+
+
+# Runs against fakeredis[lua] if installed, otherwise against the Redis server of TEST_REDIS_URL or
+# REDIS_URL, skipped if there is none
+class TestRedisCallStateStore(CallStateStoreCases, unittest.TestCase):
+    def setUp(self):
+        if importlib.util.find_spec("fakeredis") is not None:
+            import fakeredis
+
+            self.client = fakeredis.FakeRedis()
+        else:
+            self.client = redis.Redis.from_url(os.getenv("TEST_REDIS_URL", REDIS_URL))
+            try:
+                self.client.ping()
+            except redis.ConnectionError:
+                self.client.close()
+                self.skipTest("needs fakeredis or a Redis server")
+        self.prefix = f"test-callstate-{uuid.uuid4()}:"
+
+    def tearDown(self):
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+        self.client.close()
+
+    def createStore(self, ttl=60):
+        return RedisCallStateStore(self.client, ttl=ttl, prefix=self.prefix)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import logging
+import socket
+import threading
+import time
+import unittest
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+from server import checkMedia
+from server.checkMedia import checkAllURLs
+from server.checkMedia import checkURLAsync
+
+LOG = logging.getLogger("test_check_media")
+
+
+class StubMediaHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        with self.server.lock:
+            self.server.heads[self.path] += 1
+        time.sleep(0.2)  # Long enough for concurrent checks of the same url to overlap
+        self.send_response(200 if self.path.startswith("/ivr/") else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCheckMedia(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubMediaHandler)
+        self.server.heads = Counter()
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with checkMedia._cacheLock:
+            checkMedia._statusCache.clear()
+
+    def test_cache(self):
+        found, missing = f"{self.base}/ivr/info.mp3", f"{self.base}/city/Atlantis.mp3"
+        with self.assertLogs(LOG, "WARNING") as logs:
+            self.assertEqual(checkAllURLs([found, missing], log=LOG), {missing: 404})
+        self.assertEqual(len(logs.output), 1)
+        self.assertEqual(self.server.heads, {"/ivr/info.mp3": 1, "/city/Atlantis.mp3": 1})
+
+        # Known urls are answered from the cache, bad ones are still warned about
+        with self.assertLogs(LOG, "WARNING") as logs:
+            self.assertIsNone(checkURLAsync(found, log=LOG))
+            self.assertIsNone(checkURLAsync(missing, log=LOG))
+        self.assertIn("(cached)", logs.output[0])
+        self.assertEqual(checkAllURLs([found, missing]), {missing: 404})
+        self.assertEqual(sum(self.server.heads.values()), 2)
+
+        with mock.patch.object(checkMedia, "URL_CACHE_TTL", 0):
+            self.assertEqual(checkURLAsync(found).result(timeout=5), 200)
+        self.assertEqual(self.server.heads["/ivr/info.mp3"], 2)
+
+    def test_concurrentChecks(self):
+        url = f"{self.base}/ivr/info.mp3"
+        futures = []
+        barrier = threading.Barrier(8)
+
+        def check():
+            barrier.wait()
+            futures.append(checkURLAsync(url))
+
+        threads = [threading.Thread(target=check) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(futures)), 1)
+        self.assertEqual(futures[0].result(timeout=5), 200)
+        self.assertEqual(self.server.heads["/ivr/info.mp3"], 1)
+        self.assertEqual(checkMedia._pending, {})
+
+    def test_unreachable(self):
+        # A port nobody listens on
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            url = f"http://127.0.0.1:{sock.getsockname()[1]}/ivr/info.mp3"
+        with self.assertLogs(LOG, "WARNING") as logs:
+            self.assertEqual(checkAllURLs([url], log=LOG), {url: None})
+        self.assertIn("Can't reach path", logs.output[0])
+        self.assertEqual(checkMedia.cachedStatus(url)[0], None)
+
+        with self.assertLogs(LOG, "WARNING") as logs:
+            self.assertIsNone(checkURLAsync(url, log=LOG))
+        self.assertIn("Status None (cached)", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
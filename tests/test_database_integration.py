@@ -0,0 +1,221 @@
+import importlib.util
+import os
+import secrets
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+HAS_SQLCIPHER = importlib.util.find_spec("pysqlcipher3") is not None
+if HAS_SQLCIPHER:
+    from pysqlcipher3 import dbapi2 as sqlite3
+
+    from server import databaseIntegration
+    from server.databaseIntegration import clearCustomerHelperPairing
+    from server.databaseIntegration import closeAllPools
+    from server.databaseIntegration import create_connection
+    from server.databaseIntegration import deleteFromDatabase
+    from server.databaseIntegration import fetchHelper
+    from server.databaseIntegration import getDatabaseWriter
+    from server.databaseIntegration import migrateDatabase
+    from server.databaseIntegration import readActiveCustomer
+    from server.databaseIntegration import readActiveHelper
+    from server.databaseIntegration import readHelperLocations
+    from server.databaseIntegration import unitOfWork
+    from server.databaseIntegration import userExists
+    from server.databaseIntegration import writeActiveCustomer
+    from server.databaseIntegration import writeActiveHelper
+    from server.databaseIntegration import writeBatchToDatabase
+    from server.helperIndex import existingHelperIndex
+    from server.helperIndex import getHelperIndex
+
+LOCATION_DICT = {
+    11122: (59.3326, 18.0649),  # Stockholm
+    11123: (59.3326, 18.1649),  # 5.7 km east
+    11124: (59.3326, 18.5649),  # 28 km east
+    41103: (57.7072, 11.9668),  # Göteborg
+}
+
+
+@unittest.skipUnless(HAS_SQLCIPHER, "needs pysqlcipher3")
+class TestFetchHelper(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, "telehelp.db")
+        self.key = secrets.token_hex(32)
+        migrateDatabase(self.db, self.key)
+        self.queries = []
+
+    def tearDown(self):
+        closeAllPools()
+        shutil.rmtree(self.dir)
+
+    # Registers helpers as another worker would, without the index of this process knowing
+    def execute(self, query, rows):
+        conn, cursor = create_connection(self.db, self.key)
+        cursor.executemany(query, rows)
+        conn.commit()
+        conn.close()
+
+    def addHelpers(self, *helpers):
+        self.execute("INSERT INTO user_helpers (phone, zipcode, district) values(?, ?, ?)", helpers)
+
+    def fetchHelper(self, zipcode="11122", district="Stockholm"):
+        listeners = [lambda query, params, seconds: self.queries.append(query)]
+        with mock.patch.object(databaseIntegration, "_queryListeners", listeners):
+            return fetchHelper(self.db, self.key, district, zipcode, LOCATION_DICT)
+
+    def test_nearestAvailable(self):
+        self.addHelpers(
+            ("+46700000001", "11123", "Stockholm"),
+            ("+46700000002", "11124", "Stockholm"),  # Further than maxDist
+            ("+46700000003", "11122", "Stockholm"),
+            ("+46700000004", "41103", "Göteborg"),
+        )
+        self.assertEqual(self.fetchHelper(), ["+46700000003", "+46700000001"])
+        self.assertEqual(len(existingHelperIndex(self.db)), 4)
+
+        # Once the index is built a call makes one round trip to the database
+        self.queries.clear()
+        self.assertEqual(self.fetchHelper(), ["+46700000003", "+46700000001"])
+        self.assertEqual(len(self.queries), 1)
+        self.assertIn("active_customers IS NULL", self.queries[0])
+
+        self.assertIsNone(self.fetchHelper("41103", "Stockholm"))
+        self.assertIsNone(self.fetchHelper("99999"))  # Unknown zipcode
+        self.assertIsNone(self.fetchHelper(district="Uppsala"))
+
+    def test_helpersChangedByOtherWorkers(self):
+        self.addHelpers(("+46700000001", "11122", "Stockholm"))
+        self.assertEqual(self.fetchHelper(), ["+46700000001"])
+
+        self.addHelpers(("+46700000002", "11123", "Stockholm"))
+        self.assertEqual(self.fetchHelper(), ["+46700000001", "+46700000002"])
+        self.assertIn("+46700000002", existingHelperIndex(self.db))
+
+        # The index still has the helper as unpaired, the database decides
+        pair = "UPDATE user_helpers set active_customers=? where phone=?"
+        self.execute(pair, [("+46760000001", "+46700000001")])
+        self.assertEqual(self.fetchHelper(), ["+46700000002"])
+        self.execute(pair, [("+46760000002", "+46700000002")])
+        self.assertIsNone(self.fetchHelper())
+
+    def test_maxQueue(self):
+        self.addHelpers(*[("+467000000%02d" % i, "11122", "Stockholm") for i in range(12)])
+        self.addHelpers(("+46700000100", "11123", "Stockholm"))
+        closest = self.fetchHelper()
+        self.assertEqual(len(closest), 10)
+        self.assertNotIn("+46700000100", closest)
+
+
+@unittest.skipUnless(HAS_SQLCIPHER, "needs pysqlcipher3")
+class TestUnitOfWork(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, "telehelp.db")
+        self.key = secrets.token_hex(32)
+        migrateDatabase(self.db, self.key)
+        insertHelper = "INSERT INTO user_helpers (phone, zipcode, district) values(?, ?, ?)"
+        insertCustomer = "INSERT INTO user_customers (phone, zipcode, district) values(?, ?, ?)"
+        statements = [
+            (insertHelper, ("+46700000001", "11122", "Stockholm")),
+            (insertHelper, ("+46700000002", "11123", "Stockholm")),
+            (insertCustomer, ("+46760000001", "11122", "Stockholm")),
+        ]
+        writeBatchToDatabase(self.db, self.key, statements)
+        self.index = getHelperIndex(self.db, lambda: readHelperLocations(self.db, self.key), LOCATION_DICT)
+        self.queries = []
+        listeners = [lambda query, params, seconds: self.queries.append(query)]
+        patcher = mock.patch.object(databaseIntegration, "_queryListeners", listeners)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        getDatabaseWriter(self.db, self.key).close()
+        closeAllPools()
+        shutil.rmtree(self.dir)
+
+    def pair(self, helperPhone, customerPhone):
+        with unitOfWork(self.db, self.key):
+            writeActiveCustomer(self.db, self.key, helperPhone, customerPhone)
+            writeActiveHelper(self.db, self.key, customerPhone, helperPhone)
+
+    # Output: helpers the index of this process considers unpaired
+    def unpaired(self):
+        return [phone for phone, _ in self.index.nearest("11122", 20)]
+
+    def test_commitsTogether(self):
+        with unitOfWork(self.db, self.key):
+            self.pair("+46700000001", "+46760000001")  # Joins the enclosing unit
+            # Nothing is written or known to the index until the unit ends
+            self.assertIsNone(readActiveCustomer(self.db, self.key, "+46700000001"))
+            self.assertEqual(self.unpaired(), ["+46700000001", "+46700000002"])
+            self.assertEqual(self.queries.count("COMMIT"), 0)
+        self.assertEqual(self.queries.count("COMMIT"), 1)
+        self.assertEqual(readActiveCustomer(self.db, self.key, "+46700000001"), "+46760000001")
+        self.assertEqual(readActiveHelper(self.db, self.key, "+46760000001"), "+46700000001")
+        self.assertEqual(self.unpaired(), ["+46700000002"])
+
+        # Outside a unit of work every write is committed, and the index updated, on its own
+        writeActiveCustomer(self.db, self.key, "+46700000002", "+46760000002")
+        self.assertEqual(self.queries.count("COMMIT"), 2)
+        self.assertEqual(self.unpaired(), [])
+
+    def test_rollsBack(self):
+        with self.assertRaises(ValueError):
+            with unitOfWork(self.db, self.key):
+                self.pair("+46700000001", "+46760000001")
+                raise ValueError("The customer hung up")
+        self.assertIsNone(readActiveCustomer(self.db, self.key, "+46700000001"))
+        self.assertIsNone(readActiveHelper(self.db, self.key, "+46760000001"))
+        self.assertEqual(self.unpaired(), ["+46700000001", "+46700000002"])
+
+        # A failing statement undoes the statements before it and the index is left alone
+        with self.assertRaises(sqlite3.IntegrityError):
+            with unitOfWork(self.db, self.key):
+                self.pair("+46700000001", "+46760000001")
+                writeBatchToDatabase(
+                    self.db,
+                    self.key,
+                    [("UPDATE user_helpers set phone=? where phone=?", ("+46700000001", "+46700000002"))],
+                )
+        self.assertIsNone(readActiveCustomer(self.db, self.key, "+46700000001"))
+        self.assertEqual(self.unpaired(), ["+46700000001", "+46700000002"])
+        self.assertEqual(self.queries.count("COMMIT"), 0)
+
+    def test_clearCustomerHelperPairing(self):
+        self.pair("+46700000001", "+46760000001")
+        self.queries.clear()
+        clearCustomerHelperPairing(self.db, self.key, "+46700000001")
+        self.assertEqual(self.queries.count("COMMIT"), 1)
+        self.assertIsNone(readActiveCustomer(self.db, self.key, "+46700000001"))
+        self.assertIsNone(readActiveHelper(self.db, self.key, "+46760000001"))
+        self.assertEqual(self.unpaired(), ["+46700000001", "+46700000002"])
+
+        # An unpaired helper has nothing to clear
+        self.queries.clear()
+        clearCustomerHelperPairing(self.db, self.key, "+46700000001")
+        self.assertEqual(self.queries.count("COMMIT"), 0)
+
+    def test_deleteHelper(self):
+        self.pair("+46700000001", "+46760000001")
+        self.queries.clear()
+        deleteFromDatabase(self.db, self.key, "+46700000001", "helper")
+        self.assertEqual(self.queries.count("COMMIT"), 1)
+        self.assertFalse(userExists(self.db, self.key, "+46700000001", "helper"))
+        self.assertIsNone(readActiveHelper(self.db, self.key, "+46760000001"))
+        self.assertNotIn("+46700000001", self.index)
+        self.assertEqual(self.unpaired(), ["+46700000002"])
+
+    def test_deleteCustomer(self):
+        self.pair("+46700000001", "+46760000001")
+        self.queries.clear()
+        deleteFromDatabase(self.db, self.key, "+46760000001", "customer")
+        self.assertEqual(self.queries.count("COMMIT"), 1)
+        self.assertFalse(userExists(self.db, self.key, "+46760000001", "customer"))
+        self.assertIsNone(readActiveCustomer(self.db, self.key, "+46700000001"))
+        self.assertEqual(self.unpaired(), ["+46700000001", "+46700000002"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from server.databaseWriter import beginUnitOfWork
+from server.databaseWriter import currentUnitOfWork
+from server.databaseWriter import DatabaseWriter
+
+PAIR_HELPER = "UPDATE user_helpers set active_customers=? where phone=?"
+PAIR_CUSTOMER = "UPDATE user_customers set active_helpers=? where phone=?"
+
+
+class TestDatabaseWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "telehelp.db")
+        conn = self.connect()
+        conn.execute("CREATE TABLE user_helpers (phone TEXT UNIQUE, active_customers TEXT)")
+        conn.commit()
+        conn.close()
+        self.writer = DatabaseWriter(self.connect, checkpointInterval=0.05)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.dir)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL").fetchall()
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def count(self, conn):
+        return conn.execute("SELECT count(*) FROM user_helpers").fetchone()[0]
+
+    def test_failingRequestIsRolledBackAlone(self):
+        insert = "INSERT INTO user_helpers (phone) values(?)"
+        timings = self.writer.write([(insert, ["+46700000001"])])
+        self.assertEqual([query for query, _, _ in timings], [insert, "COMMIT"])
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.writer.write([(insert, ["+46700000002"]), (insert, ["+46700000001"])])
+        self.writer.write([(insert, ["+46700000003"])])
+        conn = self.connect()
+        phones = conn.execute("SELECT phone FROM user_helpers ORDER BY phone").fetchall()
+        self.assertEqual(phones, [("+46700000001",), ("+46700000003",)])
+        conn.close()
+
+        # After close, e.g. at exit, writes are made by the caller
+        self.writer.close()
+        self.writer.write([(insert, ["+46700000004"])])
+
+    def test_concurrentWebhooks(self):
+        nThreads, nWrites = 16, 100
+        errors = []
+        reads = []
+        done = threading.Event()
+
+        def webhook(thread):
+            try:
+                for i in range(nWrites):
+                    phone = "+4670%03d%04d" % (thread, i)
+                    self.writer.write([("INSERT INTO user_helpers (phone) values(?)", [phone])])
+                    update = "UPDATE user_helpers set active_customers=? where phone=?"
+                    self.writer.write([(update, ["c", phone])])
+            except Exception as err:
+                errors.append(err)
+
+        def reader():
+            conn = self.connect()
+            try:
+                while not done.is_set():
+                    reads.append(self.count(conn))
+            except Exception as err:
+                errors.append(err)
+            conn.close()
+
+        readers = [threading.Thread(target=reader) for _ in range(4)]
+        threads = [threading.Thread(target=webhook, args=(thread,)) for thread in range(nThreads)]
+        for thread in readers + threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        conn = self.connect()
+        paired = conn.execute("SELECT count(*) FROM user_helpers WHERE active_customers='c'").fetchone()[0]
+        self.assertEqual(paired, nThreads * nWrites)
+        conn.close()
+        # Readers ran alongside the writer and saw the table grow
+        self.assertGreater(len(set(reads)), 1)
+        # Writes queued together were committed together
+        self.assertLess(self.writer.commits, 2 * nThreads * nWrites)
+        self.assertGreater(self.writer.checkpoints, 0)
+
+
+class TestUnitOfWork(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "telehelp.db")
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE user_helpers (phone TEXT UNIQUE, active_customers TEXT)")
+        self.conn.execute("CREATE TABLE user_customers (phone TEXT UNIQUE, active_helpers TEXT)")
+        self.conn.executemany("INSERT INTO user_helpers (phone) values(?)", [("h1",), ("h2",)])
+        self.conn.executemany("INSERT INTO user_customers (phone) values(?)", [("c1",)])
+        self.conn.commit()
+        self.writer = DatabaseWriter(lambda: sqlite3.connect(self.path, check_same_thread=False))
+        self.committed = []
+
+    def tearDown(self):
+        self.writer.close()
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def unitOfWork(self):
+        return beginUnitOfWork(self.path, self.writer.write)
+
+    def write(self, query, params):
+        unit = currentUnitOfWork(self.path)
+        if unit is None:
+            self.writer.write([(query, params)])
+        else:
+            unit.add([(query, params)])
+
+    def pair(self, helperPhone, customerPhone):
+        with self.unitOfWork() as unit:
+            self.write(PAIR_HELPER, (customerPhone, helperPhone))
+            self.write(PAIR_CUSTOMER, (helperPhone, customerPhone))
+            unit.afterCommit(lambda: self.committed.append((helperPhone, customerPhone)))
+
+    def pairings(self):
+        helpers = self.conn.execute("SELECT phone FROM user_helpers WHERE active_customers='c1'").fetchall()
+        customers = self.conn.execute("SELECT active_helpers FROM user_customers").fetchall()
+        return helpers, customers
+
+    def test_commitsOnce(self):
+        commits = self.writer.commits
+        with self.unitOfWork():
+            self.pair("h1", "c1")  # Joins the enclosing unit
+            self.assertEqual(self.pairings(), ([], [(None,)]))
+            self.assertEqual(self.committed, [])
+        self.assertEqual(self.writer.commits, commits + 1)
+        self.assertEqual(self.pairings(), ([("h1",)], [("h1",)]))
+        self.assertEqual(self.committed, [("h1", "c1")])
+        self.assertIsNone(currentUnitOfWork(self.path))
+
+    def test_rollsBack(self):
+        with self.assertRaises(ValueError):
+            with self.unitOfWork():
+                self.pair("h1", "c1")
+                raise ValueError("The customer hung up")
+        self.assertEqual(self.pairings(), ([], [(None,)]))
+
+        # A failing statement undoes the statements before it
+        with self.assertRaises(sqlite3.IntegrityError):
+            with self.unitOfWork() as unit:
+                self.write(PAIR_CUSTOMER, ("h1", "c1"))
+                self.write("UPDATE user_helpers set phone=? where phone=?", ("h1", "h2"))
+                unit.afterCommit(lambda: self.committed.append("index"))
+        self.assertEqual(self.pairings(), ([], [(None,)]))
+        self.assertEqual(self.committed, [])
+
+    def test_otherThreadsWriteDirectly(self):
+        with self.unitOfWork():
+            thread = threading.Thread(target=self.pair, args=("h2", "c1"))
+            thread.start()
+            thread.join()
+            self.assertEqual(self.committed, [("h2", "c1")])
+
+
+if __name__ == "__main__":
+    unittest.main()
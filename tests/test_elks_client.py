@@ -0,0 +1,90 @@
+import base64
+import threading
+import time
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+from server import elksClient
+from server.elksClient import ElksClient
+
+
+class StubElksHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like api.46elks.com
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append(
+            (
+                self.path,
+                self.headers["Authorization"],
+                dict(urllib.parse.parse_qsl(body.decode())),
+                self.client_address,
+            )
+        )
+        if self.path == "/a1/slow":
+            time.sleep(0.5)
+        status = 200 if self.path in ("/a1/calls", "/a1/sms") else 404
+        response = b'{"status": "created"}'
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestElksClient(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubElksHandler)
+        self.server.received = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_port}"
+        self.client = ElksClient("user", "pass", base=base, timeout=(1, 0.2))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_postReusesConnection(self):
+        self.client.sendSms({"from": "Telehelp", "to": "+46700000000", "message": "123456"}, wait=True)
+        response = self.client.placeCall({"from": "+46700000001", "to": "+46700000000"}, wait=True)
+
+        self.assertEqual(response.status_code, 200)
+        (smsPath, auth, fields, smsClient), (callPath, _, _, callClient) = self.server.received
+        self.assertEqual((smsPath, callPath), ("/a1/sms", "/a1/calls"))
+        self.assertEqual(auth, "Basic " + base64.b64encode(b"user:pass").decode())
+        self.assertEqual(fields, {"from": "Telehelp", "to": "+46700000000", "message": "123456"})
+        self.assertEqual(smsClient, callClient)
+
+    def test_postAsync(self):
+        future = self.client.placeCall({"to": "+46700000000"})
+        self.assertEqual(future.result(timeout=5).status_code, 200)
+
+    def test_errorsAndTimeouts(self):
+        self.assertIsNone(self.client.postAsync("/a1/slow", {}).result(timeout=5))
+        self.assertEqual(self.client.post("/a1/unknown", {}).status_code, 404)
+
+        metrics = self.client.metrics.snapshot()
+        self.assertEqual((metrics["/a1/slow"]["requests"], metrics["/a1/slow"]["errors"]), (1, 1))
+        self.assertEqual((metrics["/a1/unknown"]["requests"], metrics["/a1/unknown"]["errors"]), (1, 1))
+
+    def test_failingListener(self):
+        calls = []
+
+        def failing(path, seconds, error):
+            raise ValueError("listener bug")
+
+        listeners = [failing, lambda path, seconds, error: calls.append((path, error))]
+        with mock.patch.object(elksClient, "_requestListeners", listeners):
+            response = self.client.sendSms({"to": "+46700000000"}, wait=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, [("/a1/sms", False)])
+
+
+if __name__ == "__main__":
+    unittest.main()
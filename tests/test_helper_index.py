@@ -0,0 +1,194 @@
+import random
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from server.helperIndex import buildHelperIndex
+from server.helperIndex import CELL_SIZE_DEG
+from server.helperIndex import existingHelperIndex
+from server.helperIndex import getHelperIndex
+from server.helperIndex import HelperIndex
+from server.helperIndex import INDEX_MAX_AGE
+from server.zipcode_utils import sphericalDistances
+
+# Stockholm sits in grid cell (296, 90), its edges at latitude 59.4 and longitude 18.2
+LOCATION_DICT = {
+    11122: (59.3326, 18.0649),  # Stockholm
+    11123: (59.3990, 18.1990),  # Just inside the north-east corner of the cell of the origin
+    11124: (59.4010, 18.1990),  # Just across its northern edge
+    11125: (59.3990, 18.2010),  # Just across its eastern edge
+    41103: (57.7072, 11.9668),  # Göteborg, about 400 km away
+    98130: (67.8558, 20.2253),  # Kiruna
+    98131: (67.8558, 20.6500),  # 18 km east of Kiruna, two cells of longitude away
+}
+
+
+class TestHelperIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = HelperIndex(LOCATION_DICT)
+
+    def phones(self, *args, **kwargs):
+        return [phone for phone, _ in self.index.nearest(*args, **kwargs)]
+
+    def test_cellBoundaries(self):
+        self.index.add("inside", "11123", "Stockholm")
+        self.index.add("north", "11124", "Stockholm")
+        self.index.add("east", "11125", "Stockholm")
+        origin = self.index._cell(*LOCATION_DICT[11123])
+        self.assertNotEqual(self.index._cell(*LOCATION_DICT[11124]), origin)
+        self.assertNotEqual(self.index._cell(*LOCATION_DICT[11125]), origin)
+        # Neighbours a few hundred meters away in the next cell are found, in order of distance
+        self.assertEqual(self.phones("11123", 1), ["inside", "east", "north"])
+
+    def test_highLatitude(self):
+        self.index.add("kiruna east", "98131", "Kiruna")
+        cols = [self.index._cell(*LOCATION_DICT[zipcode])[1] for zipcode in (98130, 98131)]
+        self.assertEqual(cols[1] - cols[0], 2)
+        # 0.42 degrees of longitude, further than CELL_SIZE_DEG but only 18 km this far north
+        self.assertGreater(LOCATION_DICT[98131][1] - LOCATION_DICT[98130][1], 2 * CELL_SIZE_DEG)
+        [(phone, distance)] = self.index.nearest("98130", 20)
+        self.assertEqual(phone, "kiruna east")
+        self.assertAlmostEqual(distance, 17.8, delta=0.5)
+        self.assertEqual(self.index.nearest("98130", 15), [])
+
+    def test_matchesHaversine(self):
+        rng = random.Random(0)
+        locations = {10000 + i: (59.3 + rng.uniform(-1, 1), 18.0 + rng.uniform(-2, 2)) for i in range(500)}
+        index = HelperIndex(locations)
+        for zipcode in locations:
+            index.add(str(zipcode), zipcode, "Stockholm")
+        zipcodes = np.array(list(locations))
+        coords = np.array([locations[zipcode] for zipcode in zipcodes])
+        for origin in rng.sample(list(locations), 20):
+            lat, lon = locations[origin]
+            distances = sphericalDistances(lat, lon, coords[:, 0], coords[:, 1])
+            for maxDist in (5, 30, 80):
+                inRange = sorted((distance, str(zipcode)) for zipcode, distance in zip(zipcodes, distances))
+                expected = [phone for distance, phone in inRange if distance <= maxDist]
+                found = index.nearest(origin, maxDist)
+                self.assertEqual([phone for phone, _ in found], expected)
+                for phone, distance in found:
+                    self.assertLessEqual(distance, maxDist)
+
+    def test_filters(self):
+        self.index.add("paired", "11122", "Stockholm", activeCustomer="+46760000001")
+        self.index.add("free", "11123", "Stockholm")
+        self.index.add("other district", "11124", "Solna")
+        self.index.add("far", "41103", "Göteborg")
+        self.assertEqual(self.phones("11122", 50), ["free", "other district"])
+        self.assertEqual(self.phones("11122", 50, district="Stockholm"), ["free"])
+        self.assertEqual(self.phones("11122", 500, district="Göteborg"), ["far"])
+        # A set of available phones replaces the pairings known to the index
+        available = {"paired", "other district"}
+        self.assertEqual(self.phones("11122", 50, available=available), ["paired", "other district"])
+        self.assertEqual(self.phones("11122", 50, available=set()), [])
+
+    def test_k(self):
+        for i, zipcode in enumerate(LOCATION_DICT):
+            self.index.add(f"helper {i}", zipcode, "Sverige")
+        self.assertEqual(self.phones("11122", 2000, k=2), ["helper 0", "helper 1"])
+        self.assertEqual(len(self.phones("11122", 2000)), len(LOCATION_DICT))
+        self.assertEqual(self.phones("11122", 2000, k=0), [])
+
+    def test_unknownZipcodes(self):
+        self.index.add("nowhere", "99999", "Stockholm")
+        self.index.add("invalid", "not a zipcode", "Stockholm")
+        self.assertEqual(len(self.index), 0)
+        self.index.add("free", "11122", "Stockholm")
+        self.assertEqual(self.index.nearest("99999", 100), [])
+
+    def test_updates(self):
+        self.index.add("helper", "11122", "Stockholm")
+        self.assertIn("helper", self.index)
+        self.assertEqual(self.phones("11122", 10), ["helper"])
+
+        # Moving to another zipcode moves the helper to its cell
+        self.index.add("helper", "41103", "Göteborg")
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.phones("11122", 10), [])
+        self.assertEqual(self.phones("41103", 10), ["helper"])
+        self.assertEqual(set(phone for phones in self.index._cells.values() for phone in phones), {"helper"})
+
+        self.index.setActiveCustomer("helper", "+46760000001")
+        self.assertEqual(self.phones("41103", 10), [])
+        self.index.releaseCustomer("+46760000002")
+        self.assertEqual(self.phones("41103", 10), [])
+        self.index.releaseCustomer("+46760000001")
+        self.assertEqual(self.phones("41103", 10), ["helper"])
+
+        self.index.setActiveCustomer("unknown", "+46760000001")  # Not indexed, nothing to do
+        self.assertNotIn("unknown", self.index)
+
+        self.index.remove("helper")
+        self.index.remove("helper")
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(dict(self.index._cells), {})
+
+
+class TestGetHelperIndex(unittest.TestCase):
+    def test_rebuiltAfterMaxAge(self):
+        loads = []
+
+        def loadRows():
+            loads.append(len(loads))
+            return [("+46700000001", "11122", "Stockholm", None)] if len(loads) == 1 else []
+
+        now = [1000.0]
+        with mock.patch("server.helperIndex.time.monotonic", lambda: now[0]):
+            self.assertIsNone(existingHelperIndex("test_rebuiltAfterMaxAge.db"))
+            index = getHelperIndex("test_rebuiltAfterMaxAge.db", loadRows, LOCATION_DICT)
+            self.assertEqual(len(index), 1)
+            self.assertIs(existingHelperIndex("test_rebuiltAfterMaxAge.db"), index)
+
+            now[0] += INDEX_MAX_AGE
+            self.assertIs(getHelperIndex("test_rebuiltAfterMaxAge.db", loadRows, LOCATION_DICT), index)
+            self.assertEqual(loads, [0])
+
+            now[0] += 1
+            rebuilt = getHelperIndex("test_rebuiltAfterMaxAge.db", loadRows, LOCATION_DICT)
+            self.assertIsNot(rebuilt, index)
+            self.assertEqual(len(rebuilt), 0)
+            self.assertEqual(loads, [0, 1])
+
+    def test_oldIndexUsedDuringRebuild(self):
+        loading = threading.Event()
+        release = threading.Event()
+        rows = [("+46700000001", "11122", "Stockholm", None)]
+
+        def slowLoadRows():
+            loading.set()
+            release.wait(5)
+            return rows * 2
+
+        db = "test_oldIndexUsedDuringRebuild.db"
+        rebuilt = []
+        now = [1000.0]
+        with mock.patch("server.helperIndex.time.monotonic", lambda: now[0]):
+            index = getHelperIndex(db, lambda: rows, LOCATION_DICT)
+            now[0] += INDEX_MAX_AGE + 1
+            thread = threading.Thread(
+                target=lambda: rebuilt.append(getHelperIndex(db, slowLoadRows, LOCATION_DICT))
+            )
+            thread.start()
+            self.assertTrue(loading.wait(5))
+            # Neither waits for the rebuild nor starts another one
+            self.assertIs(getHelperIndex(db, slowLoadRows, LOCATION_DICT), index)
+            release.set()
+            thread.join(5)
+        self.assertIsNot(rebuilt[0], index)
+        self.assertIs(existingHelperIndex(db), rebuilt[0])
+
+    def test_buildHelperIndex(self):
+        rows = [
+            ("+46700000001", "11122", "Stockholm", "+46760000001"),
+            ("+46700000002", "11123", "Stockholm", None),
+        ]
+        index = buildHelperIndex(rows, LOCATION_DICT)
+        self.assertEqual(len(index), 2)
+        self.assertEqual([phone for phone, _ in index.nearest("11122", 20)], ["+46700000002"])
+
+
+if __name__ == "__main__":
+    unittest.main()
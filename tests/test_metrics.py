@@ -0,0 +1,68 @@
+import threading
+import unittest
+
+from server.metrics import Counter
+from server.metrics import Gauge
+from server.metrics import Histogram
+from server.metrics import queryName
+from server.metrics import Registry
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_histogram(self):
+        histogram = Histogram("t_seconds", "Test", ["route"], buckets=(0.1, 1.0), registry=self.registry)
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value, "/api/call")
+        histogram.observe(0.2, 'quote"d')
+
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[:2], ["# HELP t_seconds Test", "# TYPE t_seconds histogram"])
+        self.assertIn('t_seconds_bucket{route="/api/call",le="0.1"} 2', lines)
+        self.assertIn('t_seconds_bucket{route="/api/call",le="1.0"} 3', lines)
+        self.assertIn('t_seconds_bucket{route="/api/call",le="+Inf"} 4', lines)
+        self.assertIn('t_seconds_sum{route="/api/call"} 3.65', lines)
+        self.assertIn('t_seconds_count{route="/api/call"} 4', lines)
+        self.assertIn('t_seconds_count{route="quote\\"d"} 1', lines)
+
+        with self.assertRaises(ValueError):
+            histogram.observe(1.0)
+        with self.assertRaises(ValueError):
+            Histogram("t_seconds", "Again", registry=self.registry)
+
+    def test_concurrentUpdates(self):
+        counter = Counter("t_total", "Test", ["kind"], registry=self.registry)
+        histogram = Histogram("t_seconds", "Test", registry=self.registry)
+
+        def work():
+            for _ in range(10000):
+                counter.inc("a")
+                histogram.observe(0.001)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value("a"), 80000)
+        self.assertEqual(histogram.totals()[0], 80000)
+
+    def test_collectedGauge(self):
+        counts = {("Stockholm", "available"): 3}
+        Gauge("t_helpers", "Test", ["district", "status"], collect=lambda: counts, registry=self.registry)
+        self.assertIn('t_helpers{district="Stockholm",status="available"} 3', self.registry.render())
+
+    def test_queryName(self):
+        query = """SELECT phone, zipcode FROM user_helpers WHERE district=? AND active_customers IS NULL"""
+        self.assertEqual(queryName(query), "select user_helpers where district,active_customers")
+        self.assertEqual(
+            queryName(""" UPDATE user_customers set active_helpers=? where phone=? """),
+            "update user_customers where phone",
+        )
+        self.assertEqual(queryName("COMMIT"), "commit")
+
+
+if __name__ == "__main__":
+    unittest.main()
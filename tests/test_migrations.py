@@ -0,0 +1,114 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from server.migrations import DuplicateRowsError
+from server.migrations import findDuplicates
+from server.migrations import mergeDuplicates
+from server.migrations import migrate
+from server.migrations import MIGRATIONS
+from server.migrations import SCHEMA_VERSION
+from server.migrations import schemaVersion
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "telehelp.db")
+        self.conn = sqlite3.connect(self.path)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def plan(self, query):
+        return " ".join(row[-1] for row in self.conn.execute("EXPLAIN QUERY PLAN " + query, ["x"]))
+
+    def test_newDatabase(self):
+        self.assertEqual(migrate(self.conn), SCHEMA_VERSION)
+        self.assertEqual(migrate(self.conn), SCHEMA_VERSION)
+        self.conn.execute("INSERT INTO user_helpers (phone, district) values('+46700000001', 'Stockholm')")
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.conn.execute("INSERT INTO user_helpers (phone) values('+46700000001')")
+
+        plans = {
+            "COVERING INDEX user_helpers_district": """SELECT phone, zipcode FROM user_helpers
+                                                       WHERE district=? AND active_customers IS NULL""",
+            "INDEX user_helpers_phone": """ SELECT active_customers FROM user_helpers where phone=? """,
+            "INDEX user_customers_active_helpers": """UPDATE user_customers set active_helpers=null
+                                                      where active_helpers=?""",
+            "INDEX call_variables_callid": """ SELECT hangup FROM call_variables WHERE callid=? """,
+        }
+        for index, query in plans.items():
+            self.assertIn("USING " + index, self.plan(query))
+
+    def test_existingDatabase(self):
+        # Made before versioning, with a helper that registered twice
+        self.conn.execute(
+            """ CREATE TABLE user_helpers (phone TEXT, name TEXT, zipcode TEXT, district TEXT,
+                    active_customers TEXT) """
+        )
+        helpers = [("+46700000001", "First"), ("+46700000001", "Again"), ("+46700000002", "Other")]
+        self.conn.executemany("INSERT INTO user_helpers (phone, name) values(?, ?)", helpers)
+        self.conn.commit()
+        self.assertEqual(migrate(self.conn, MIGRATIONS[:1]), 1)
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM user_helpers").fetchone()[0], 3)
+        # The analytics of a call written to two rows
+        self.conn.executemany(
+            """ INSERT INTO call_analytics_customer (telehelp_callid, call_start_time, match_found)
+                    values(?, ?, ?) """,
+            [("call", "12:00", None), ("call", None, "True"), ("call", "12:01", None)],
+        )
+        self.conn.commit()
+
+        with self.assertRaises(DuplicateRowsError) as raised:
+            migrate(self.conn)
+        self.assertIn("2 rows sharing 1 values of user_helpers.phone", str(raised.exception))
+        self.assertIn("3 rows sharing 1 values of call_analytics_customer.", str(raised.exception))
+        self.assertEqual(schemaVersion(self.conn), 1)
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM user_helpers").fetchone()[0], 3)
+        self.assertEqual(self.conn.isolation_level, "")
+        self.assertFalse(self.conn.in_transaction)
+
+        self.assertEqual(mergeDuplicates(self.conn, "user_helpers", "phone"), 1)
+        self.assertEqual(mergeDuplicates(self.conn, "call_analytics_customer", "telehelp_callid"), 2)
+        self.conn.commit()
+        self.assertEqual(findDuplicates(self.conn), [])
+        names = self.conn.execute("SELECT name FROM user_helpers ORDER BY phone").fetchall()
+        self.assertEqual(names, [("Again",), ("Other",)])
+        analytics = self.conn.execute(
+            "SELECT telehelp_callid, call_start_time, match_found FROM call_analytics_customer"
+        ).fetchall()
+        self.assertEqual(analytics, [("call", "12:01", "True")])
+
+        self.assertEqual(migrate(self.conn), SCHEMA_VERSION)
+
+    def test_failedMigration(self):
+        broken = MIGRATIONS + [("broken", ["CREATE TABLE t (a)", "SELECT * FROM missing"])]
+        with self.assertRaises(sqlite3.OperationalError):
+            migrate(self.conn, broken)
+        self.assertEqual(schemaVersion(self.conn), SCHEMA_VERSION)
+        tables = self.conn.execute("SELECT name FROM sqlite_master WHERE name='t'").fetchall()
+        self.assertEqual(tables, [])
+
+    def test_concurrentWorkers(self):
+        versions = []
+
+        def worker():
+            conn = sqlite3.connect(self.path, timeout=10)
+            versions.append(migrate(conn))
+            conn.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(versions, [SCHEMA_VERSION] * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
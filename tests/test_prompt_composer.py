@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from server.promptComposer import cityPromptSegments
+from server.promptComposer import concatenateMp3
+from server.promptComposer import frameLength
+from server.promptComposer import PromptComposer
+from server.promptComposer import returningCustomerSegments
+
+MEDIA_DIR = os.path.join("server", "media", "sv")
+
+
+def frames(data):
+    count = 0
+    while data:
+        length = frameLength(data)
+        if length is None:
+            raise ValueError(f"No frame after {count} frames")
+        data = data[length:]
+        count += 1
+    return count
+
+
+class TestPromptComposer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for segment in cityPromptSegments("Abisko"):
+            os.makedirs(os.path.join(self.dir, os.path.dirname(segment)), exist_ok=True)
+            shutil.copy(os.path.join(MEDIA_DIR, segment), os.path.join(self.dir, segment))
+        self.composer = PromptComposer("https://media.example", mediaDir=self.dir)
+
+    def tearDown(self):
+        self.composer.close()
+        shutil.rmtree(self.dir)
+
+    def read(self, segment):
+        with open(os.path.join(self.dir, segment), "rb") as file:
+            return file.read()
+
+    def test_cityPrompt(self):
+        segments = cityPromptSegments("Abisko")
+        # Built in the background, the caller plays the segments until then
+        self.assertIsNone(self.composer.url(segments))
+        path = self.composer.submit(segments).result(5)
+        url = self.composer.url(segments)
+        self.assertEqual(url, "https://media.example/composite/" + os.path.basename(path))
+
+        with open(path, "rb") as file:
+            composite = file.read()
+        parts = [self.read(segment) for segment in segments]
+        self.assertEqual(composite, b"".join(parts))
+        self.assertEqual(frames(composite), sum(frames(part) for part in parts))
+
+        self.assertIsNone(self.composer.url(cityPromptSegments("Okänd ort")))
+
+    def test_tagsAndInfoFrameAreDropped(self):
+        audio = self.read("ivr/du_befinner.mp3")
+        id3 = b"ID3\x04\x00\x00\x00\x00\x00\x05" + b"title"
+        infoFrame = audio[:4] + b"Info" + bytes(frameLength(audio) - 8)
+        tagged = id3 + infoFrame + audio + b"TAG" + bytes(125)
+        self.assertEqual(concatenateMp3([tagged, audio]), audio + audio)
+
+    def test_returningCustomerPrompt(self):
+        self.assertIn("name/Anna.mp3", returningCustomerSegments("Anna"))
+        # Before the name is synthesized only shipped prompts are played
+        for segment in returningCustomerSegments():
+            self.assertTrue(os.path.isfile(os.path.join(MEDIA_DIR, segment)), segment)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from server.queryLog import fullScans
+from server.queryLog import hotQueries
+from server.queryLog import QueryLog
+from server.queryLog import redact
+
+
+class TestQueryLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "queries.log")
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.execute("CREATE TABLE user_helpers (phone TEXT, district TEXT)")
+        self.conn.execute("CREATE UNIQUE INDEX user_helpers_phone ON user_helpers (phone)")
+        self.log = QueryLog(explain=self.explain, slowMs=50, path=self.path, statsInterval=60)
+
+    def tearDown(self):
+        self.log.close()
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def explain(self, query, params):
+        return self.conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+
+    def test_log(self):
+        byPhone = """SELECT district FROM user_helpers
+                     WHERE phone=?"""
+        byDistrict = """SELECT phone FROM user_helpers WHERE district=?"""
+        self.log.record(byPhone, ["+46701234567"], 0.001)
+        self.log.record(byPhone, ["+46701234568"], 0.2)
+        self.log.record(byDistrict, ["Stockholm"], 0.004)
+        self.log.record("COMMIT", (), 0.01)
+        self.log.close()
+
+        queries = {query["query"]: query for query in hotQueries(self.path)}
+        phone = queries["SELECT district FROM user_helpers WHERE phone=?"]
+        self.assertEqual((phone["count"], phone["slow"], phone["scans"]), (2, 1, []))
+        self.assertAlmostEqual(phone["seconds"], 0.201)
+        district = queries[byDistrict]
+        self.assertEqual((district["count"], district["slow"], district["scans"]), (1, 0, ["user_helpers"]))
+        self.assertEqual(queries["COMMIT"]["plan"], None)
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            log = file.read()
+        self.assertIn('"params": ["<phone>"]', log)
+        self.assertNotIn("4670123456", log)
+
+    def test_redact(self):
+        self.assertEqual(redact("Ring 0701234567 eller +46701234567"), "Ring <phone> eller <phone>")
+        self.assertEqual(redact("2020-04-16:10-00-00"), "2020-04-16:10-00-00")
+        self.assertEqual(redact(17070), 17070)
+
+    def test_fullScans(self):
+        plan = [(2, 0, 0, "SCAN user_helpers"), (3, 0, 0, "SEARCH user_customers USING INDEX c (phone=?)")]
+        self.assertEqual(fullScans(plan), ["user_helpers"])
+        self.assertEqual(fullScans([(1, 0, 0, "SCAN TABLE call_variables")]), ["call_variables"])
+        self.assertEqual(fullScans([(1, 0, 0, "SCAN CONSTANT ROW")]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
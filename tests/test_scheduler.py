@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+
+from server.databaseWriter import DatabaseWriter
+from server.migrations import migrate
+from server.scheduler import FAILED
+from server.scheduler import JobScheduler
+from server.scheduler import registerJob
+from server.scheduler import RetryJob
+from server.scheduler import SqliteJobStore
+
+
+class TestJobScheduler(unittest.TestCase):
+    def setUp(self):
+        handle, self.db = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        with self.connect() as conn:
+            migrate(conn)
+        self.ran = []
+        self.done = threading.Event()
+        self.schedulers = []
+        self.writers = []
+
+    def tearDown(self):
+        for scheduler in self.schedulers:
+            scheduler.close()
+        for writer in self.writers:
+            writer.close()
+        os.remove(self.db)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.db, timeout=5)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    # Every scheduler stands for a worker process, with a writer of its own
+    def startStore(self):
+        writer = DatabaseWriter(lambda: sqlite3.connect(self.db, timeout=5, check_same_thread=False))
+        self.writers.append(writer)
+        return SqliteJobStore(self.connect, writer.write)
+
+    def startScheduler(self, store=None, **kwargs):
+        scheduler = JobScheduler(store or self.startStore(), pollInterval=0.05, **kwargs)
+        self.schedulers.append(scheduler)
+        return scheduler
+
+    def jobs(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT name, status, attempts FROM scheduled_jobs").fetchall()
+
+    def test_delayedJob(self):
+        @registerJob("test_record")
+        def record(value):
+            self.ran.append((value, time.time()))
+            self.done.set()
+
+        scheduler = self.startScheduler()
+        start = time.time()
+        scheduler.schedule("test_record", "a", delay=0.2)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.ran[0][0], "a")
+        self.assertGreaterEqual(self.ran[0][1] - start, 0.2)
+        time.sleep(0.1)
+        self.assertEqual(self.jobs(), [])
+
+    def test_jobSurvivesRestart(self):
+        @registerJob("test_record")
+        def record(value):
+            self.ran.append(value)
+            self.done.set()
+
+        # Scheduled by a worker that stops before the job is due
+        first = self.startScheduler()
+        first.schedule("test_record", "b", delay=0.3)
+        first.close()
+        self.assertEqual(self.ran, [])
+
+        # Picked up by polling, two workers share the table but the job runs once
+        self.startScheduler()
+        self.startScheduler()
+        self.assertTrue(self.done.wait(5))
+        time.sleep(0.3)
+        self.assertEqual(self.ran, ["b"])
+
+    def test_retries(self):
+        attempts = []
+
+        @registerJob("test_flaky")
+        def flaky():
+            attempts.append(time.time())
+            if len(attempts) < 3:
+                raise RetryJob("not yet")
+            self.done.set()
+
+        @registerJob("test_broken")
+        def broken():
+            raise ValueError("bug")
+
+        scheduler = self.startScheduler(retryDelay=0.05)
+        scheduler.schedule("test_broken")
+        scheduler.schedule("test_flaky")
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(len(attempts), 3)
+        time.sleep(0.1)
+        # Other errors are not retried, the job may have had an effect
+        self.assertEqual(self.jobs(), [("test_broken", FAILED, 1)])
+
+    def test_claimDue(self):
+        first, second = self.startStore(), self.startStore()
+        self.assertEqual(first.claimDue(time.time(), 2), [])
+        for value in ("a", "b", "c"):
+            first.add("test_record", [value], time.time() - 1)
+        first.add("test_record", ["later"], time.time() + 60)
+        claimed = first.claimDue(time.time(), 2)
+        expected = [("test_record", ["a"], 1), ("test_record", ["b"], 1)]
+        self.assertEqual([(name, args, attempts) for _, name, args, attempts in claimed], expected)
+        # Claimed jobs are not handed out again, to this or another worker
+        self.assertEqual([args for _, _, args, _ in second.claimDue(time.time(), 5)], [["c"]])
+        self.assertEqual(first.claimDue(time.time(), 5), [])
+
+    def test_scheduleWhileClaiming(self):
+        claiming = threading.Event()
+        release = threading.Event()
+        store = self.startStore()
+        claimDue = store.claimDue
+
+        def slowClaimDue(now, limit):
+            claiming.set()
+            release.wait(5)
+            return claimDue(now, limit)
+
+        store.claimDue = slowClaimDue
+        scheduler = self.startScheduler(store)
+        self.assertTrue(claiming.wait(5))
+        # A webhook scheduling a job doesn't wait for the database work of the scheduler thread
+        thread = threading.Thread(target=scheduler.schedule, args=("test_record", "d"), kwargs={"delay": 60})
+        thread.start()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        release.set()
+
+
+if __name__ == "__main__":
+    unittest.main()
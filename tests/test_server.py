@@ -1,11 +1,19 @@
 import math
 import os
+import tempfile
 import unittest
 
 from server.zipcode_utils import getCity
 from server.zipcode_utils import getDistanceApart
+from server.zipcode_utils import getDistancesApart
 from server.zipcode_utils import getDistrict
+from server.zipcode_utils import getListOfCities
 from server.zipcode_utils import readZipCodeData
+from server.zipcodeTable import CityView
+from server.zipcodeTable import compileZipCodeData
+from server.zipcodeTable import DistrictView
+from server.zipcodeTable import LocationView
+from server.zipcodeTable import ZipCodeTable
 
 loc_d, dis_d, cit_d = readZipCodeData(os.path.join("server", "SE.txt"))
 
@@ -15,6 +23,28 @@ class TestZipcodeUtils(unittest.TestCase):
         self.assertEqual(getDistanceApart(170700, 74693, loc_d), -1)
         self.assertEqual(math.floor(getDistanceApart(17070, 74693, loc_d)), 35.0)
 
+    def test_getDistancesApart(self):
+        targets = [74693, 17070, 11120, 41101, 98138, 170700]
+        expected = [getDistanceApart(17070, zipcode, loc_d) for zipcode in targets[:-1]]
+
+        for method, tolerance in (("haversine", 0.005), ("equirectangular", 0.01)):
+            distances = getDistancesApart(17070, targets, loc_d, method=method)
+            self.assertEqual(list(distances.mask), [False] * 5 + [True])
+            for distance, geodesic in zip(distances[:-1], expected):
+                self.assertAlmostEqual(distance, geodesic, delta=tolerance * geodesic + 1e-6)
+
+        self.assertTrue(getDistancesApart(170700, targets, loc_d).mask.all())
+        self.assertEqual(len(getDistancesApart(17070, [], loc_d)), 0)
+
+    def test_invalidZipcodes(self):
+        # E.g. far too many digits typed on the keypad, which don't fit a numpy integer
+        tooLong = "9" * 25
+        distances = getDistancesApart("17070", ["74693", tooLong, "abc", "-1", ""], loc_d)
+        self.assertEqual(list(distances.mask), [False, True, True, True, True])
+        self.assertTrue(getDistancesApart(int(tooLong), [17070, -1], loc_d).mask.all())
+        self.assertTrue(getDistancesApart(tooLong, ["17070"], loc_d).mask.all())
+        self.assertEqual(getDistanceApart(tooLong, 17070, loc_d), -1)
+
     def test_getDistrict(self):
         self.assertEqual(getDistrict(17070, dis_d), "Stockholm")
         self.assertEqual(getDistrict(170700, loc_d), "n/a")
@@ -23,6 +53,40 @@ class TestZipcodeUtils(unittest.TestCase):
         self.assertEqual(getCity(17070, cit_d), "Solna")
         self.assertEqual(getCity(170700, cit_d), "Okänd ort")
 
+    def test_getListOfCities(self):
+        cities = getListOfCities(os.path.join("server", "SE.txt"))
+        self.assertEqual(cities, set(cit_d.values()))
+        self.assertIn("Upplands Väsby", cities)
+
+
+class TestZipCodeTable(unittest.TestCase):
+    def test_compiledTableMatchesText(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            table = ZipCodeTable(
+                compileZipCodeData(os.path.join("server", "SE.txt"), os.path.join(tmpdir, "SE.zipt"))
+            )
+            loc_t, dis_t, cit_t = LocationView(table), DistrictView(table), CityView(table)
+
+            self.assertEqual(sorted(loc_d), list(loc_t))
+            for zipcode in loc_d:
+                self.assertEqual(tuple(map(float, loc_d[zipcode])), loc_t[zipcode])
+                self.assertEqual(dis_d[zipcode], dis_t[zipcode])
+                self.assertEqual(cit_d[zipcode], cit_t[zipcode])
+
+            self.assertEqual(getDistrict(170700, dis_t), "n/a")
+            self.assertEqual(getDistrict("9" * 25, dis_t), "n/a")
+            self.assertEqual(getCity(9 * 10 ** 24, cit_t), "Okänd ort")
+            self.assertEqual(getDistanceApart("9" * 25, 17070, loc_t), -1)
+            self.assertTrue(getDistancesApart(17070, ["9" * 25], loc_t).mask.all())
+            self.assertEqual(getCity("17070", cit_t), "Solna")
+            self.assertAlmostEqual(
+                getDistanceApart(17070, 74693, loc_t), getDistanceApart(17070, 74693, loc_d)
+            )
+            self.assertEqual(
+                list(getDistancesApart(17070, [74693, 170700], loc_t)),
+                list(getDistancesApart(17070, [74693, 170700], loc_d)),
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,121 @@
+import contextlib
+import importlib.util
+import io
+import os
+import secrets
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+HAS_SQLCIPHER = importlib.util.find_spec("pysqlcipher3") is not None
+if HAS_SQLCIPHER:
+    from server import smsBroadcast
+    from server.databaseIntegration import closeAllPools
+    from server.databaseIntegration import getPool
+    from server.databaseIntegration import migrateDatabase
+    from server.smsBroadcast import loadLostNumbers
+    from server.smsBroadcast import popSampleSize
+    from server.smsBroadcast import previewTargets
+    from server.smsBroadcast import subgroupCondition
+
+
+def phone(i):
+    return "+4670%07d" % i
+
+
+@unittest.skipUnless(HAS_SQLCIPHER, "needs pysqlcipher3")
+class TestBroadcastTargets(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, "telehelp.db")
+        self.key = secrets.token_hex(32)
+        migrateDatabase(self.db, self.key)
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT INTO user_helpers (phone, district) values(?, ?)",
+                [(phone(i), "Stockholm" if i % 3 else "Solna") for i in range(1, 31)],
+            )
+            # Deleted helpers leave gaps in the rowids
+            conn.execute("DELETE FROM user_helpers WHERE phone IN (?, ?)", (phone(7), phone(8)))
+            conn.commit()
+
+    def tearDown(self):
+        closeAllPools()
+        shutil.rmtree(self.dir)
+
+    def connection(self):
+        return getPool(self.db, self.key).connection()
+
+    def targets(self, conn, table, condition, params, sampleSize=0, chunkSize=4):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            count, numbers = previewTargets(conn, table, condition, params, sampleSize, chunkSize)
+            numbers = list(numbers)
+        self.assertEqual(count, len(numbers))
+        return numbers, output.getvalue()
+
+    def test_chunkBoundaries(self):
+        with self.connection() as conn:
+            expected = [number for (number,) in conn.execute("SELECT phone FROM user_helpers ORDER BY rowid")]
+            self.assertEqual(len(expected), 28)
+            # Fewer, exactly as many and more rows than a chunk holds, ending on and off a chunk boundary
+            for chunkSize in (1, 3, 4, 7, 14, 27, 28, 29, 1000):
+                numbers, _ = self.targets(conn, "user_helpers", "1", (), chunkSize=chunkSize)
+                self.assertEqual(numbers, expected)
+
+    def test_subgroups(self):
+        with self.connection() as conn:
+            subgroups = []
+            for targetSubgroup in range(3):
+                condition, params = subgroupCondition("all", 3, targetSubgroup)
+                subgroups.append(self.targets(conn, "user_helpers", condition, params)[0])
+            everyone = [number for (number,) in conn.execute("SELECT phone FROM user_helpers")]
+            self.assertEqual(sorted(sum(subgroups, [])), sorted(everyone))
+            self.assertEqual([len(subgroup) for subgroup in subgroups], [10, 9, 9])
+
+            condition, params = subgroupCondition("Solna", 1, 0)
+            numbers, _ = self.targets(conn, "user_helpers", condition, params)
+            self.assertEqual(numbers, [phone(i) for i in range(3, 31, 3)])
+
+    def test_sample(self):
+        args = ["smsBroadcast", "Hej", "all", "1", "0", "--sample", "5"]
+        self.assertEqual(popSampleSize(args), 5)
+        self.assertEqual(args, ["smsBroadcast", "Hej", "all", "1", "0"])
+        self.assertEqual(popSampleSize(args), 0)
+
+        with self.connection() as conn:
+            condition, params = subgroupCondition("Solna", 1, 0)
+            numbers, output = self.targets(conn, "user_helpers", condition, params, sampleSize=5)
+        lines = output.splitlines()
+        self.assertEqual(lines[:2], ["The SMS broadcast will reach 10 users", "Random sample of 5:"])
+        sample = [line[len(" - ") :] for line in lines[2:]]
+        self.assertEqual(len(set(sample)), 5)
+        self.assertLessEqual(set(sample), set(numbers))
+
+    def test_lostNumbers(self):
+        lines = [f"{phone(1)}\n", f"{phone(7)}\n", "\n", phone(8), phone(7), f" {phone(40)} \n", phone(41)]
+        with self.connection() as conn:
+            # Two of the lost numbers have registered again, one is listed twice
+            self.assertEqual(loadLostNumbers(conn, lines), 1)
+            numbers, _ = self.targets(conn, "temp.lost_numbers", "1", (), chunkSize=2)
+            self.assertEqual(numbers, [phone(7), phone(8), phone(40), phone(41)])
+
+    def test_lostNumbersTableDropped(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.dir)
+        with open("lost_numbers.txt", "w", encoding="utf-8") as file:
+            file.write(f"{phone(1)}\n{phone(40)}\n")
+        argv = ["smsBroadcast", "Hej", "--sample", "1"]
+        with mock.patch.multiple(smsBroadcast, DATABASE=self.db, DATABASE_KEY=self.key), mock.patch(
+            "sys.argv", argv
+        ), mock.patch("builtins.input", return_value="n"), contextlib.redirect_stdout(io.StringIO()) as output:
+            smsBroadcast.sendSmsBroadcastToLostUsers()
+        self.assertIn("1 users have already signed up again", output.getvalue())
+        self.assertIn("The SMS broadcast will reach 1 users", output.getvalue())
+        with self.connection() as conn:
+            self.assertEqual(conn.execute("SELECT name FROM sqlite_temp_master").fetchall(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from server.text2speech_utils import generatePrompts
+from server.text2speech_utils import SpeechQueue
+
+
+class FakeSynthesizer:
+    voice = "fake-voice"
+    speakingRate = 1.0
+
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def synthesize(self, text):
+        self.release.wait(5)
+        self.calls.append(text)
+        return f"{self.voice}:{text}".encode("utf-8")
+
+
+class TestSpeechQueue(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.synthesizer = FakeSynthesizer()
+        self.queue = SpeechQueue(
+            self.synthesizer, cacheDir=os.path.join(self.dir, "cache"), requestsPerMinute=6000
+        )
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, "name", name + ".mp3")
+
+    def read(self, path):
+        with open(path, "rb") as file:
+            return file.read()
+
+    def test_inFlightJobsAreShared(self):
+        self.synthesizer.release.clear()
+        first = self.queue.submit("Åsa", self.path("Åsa"))
+        second = self.queue.submit("Åsa", self.path("Åsa 2"))
+        self.assertIs(first, second)
+        self.assertFalse(first.done())
+
+        self.synthesizer.release.set()
+        first.result(5)
+        self.assertEqual(self.synthesizer.calls, ["Åsa"])
+        self.assertEqual(self.read(self.path("Åsa")), b"fake-voice:\xc3\x85sa")
+        self.assertEqual(self.read(self.path("Åsa 2")), b"fake-voice:\xc3\x85sa")
+
+    def test_cache(self):
+        self.queue.submit("Johan", self.path("Johan")).result(5)
+        # Existing output, cached audio for a new output
+        self.assertTrue(self.queue.submit("Johan", self.path("Johan")).done())
+        self.queue.submit("Johan", self.path("Johan 2")).result(5)
+        self.assertEqual(self.synthesizer.calls, ["Johan"])
+
+        # Another voice is another cache entry
+        self.synthesizer.voice = "other-voice"
+        self.queue.submit("Johan").result(5)
+        self.assertEqual(self.synthesizer.calls, ["Johan", "Johan"])
+
+    def test_failure(self):
+        self.synthesizer.synthesize = lambda text: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            self.queue.submit("Danne", self.path("Danne")).result(5)
+        self.assertFalse(os.path.exists(self.path("Danne")))
+
+
+class TestGeneratePrompts(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.synthesizer = FakeSynthesizer()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def generate(self, prompts, **kwargs):
+        return generatePrompts(
+            prompts,
+            self.dir,
+            synthesizer=self.synthesizer,
+            cacheDir=os.path.join(self.dir, "cache"),
+            reportInterval=0,
+            **kwargs,
+        )
+
+    def test_onlyStalePromptsAreGenerated(self):
+        # Made before there was a manifest, kept as it is
+        with open(os.path.join(self.dir, "old.mp3"), "wb") as file:
+            file.write(b"old")
+        prompts = {"old.mp3": "Gammal", "a.mp3": "Alfa", "b.mp3": "Bravo"}
+        self.assertEqual(self.generate(prompts), (2, 0))
+        self.assertEqual(sorted(self.synthesizer.calls), ["Alfa", "Bravo"])
+
+        self.assertEqual(self.generate(prompts), (0, 0))
+        prompts["b.mp3"] = "Bravo igen"
+        self.assertEqual(self.generate(prompts), (1, 0))
+
+        # A new voice makes every prompt stale
+        self.synthesizer.voice = "other-voice"
+        self.assertEqual(self.generate(prompts), (3, 0))
+        with open(os.path.join(self.dir, "old.mp3"), "rb") as file:
+            self.assertEqual(file.read(), b"other-voice:Gammal")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import importlib.util
+import os
+import secrets
+import shutil
+import tempfile
+import unittest
+
+from server.startupTime import DEFAULT_BUDGET_MS
+from server.startupTime import measureImportTime
+from server.startupTime import ROOT_DIR
+from server.startupTime import totalImportTime
+from server.zipcodeTable import compileZipCodeData
+
+HEAVY_MODULES = ("pandas", "geopy", "requests", "google")
+# Imported by server.api, and importable without the database driver. Their imports are all within the budget
+# of the whole server.
+COVERED_MODULES = (
+    "server.text2speech_utils",
+    "server.zipcodeTable",
+    "server.helperIndex",
+    "server.callState",
+    "server.checkMedia",
+    "server.elksClient",
+    "server.promptComposer",
+    "server.scheduler",
+    "server.volunteerLocations",
+    "server.migrations",
+    "server.metrics",
+    "server.tracing",
+)
+
+
+class TestStartupTime(unittest.TestCase):
+    def test_heavyDependenciesDeferred(self):
+        for module in ("server.text2speech_utils", "server.zipcodeTable", "server.helperIndex"):
+            imported = [name for name, _, _, _ in measureImportTime(module)]
+            self.assertIn(module, imported)
+            self.assertEqual([name for name in imported if name.split(".")[0] in HEAVY_MODULES], [])
+
+    def test_startupBudget(self):
+        imports = measureImportTime("; import ".join(COVERED_MODULES))
+        imported = {name for name, _, _, _ in imports}
+        self.assertLessEqual(set(COVERED_MODULES), imported)
+        self.assertLessEqual(totalImportTime(imports), DEFAULT_BUDGET_MS)
+
+    # The whole server, as a worker starts it: next to a compiled zip code table, with a new database and the
+    # call state kept in memory instead of Redis
+    @unittest.skipUnless(importlib.util.find_spec("pysqlcipher3"), "needs pysqlcipher3")
+    def test_apiStartupBudget(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        shutil.copy(os.path.join(ROOT_DIR, "server", "SE.txt"), workdir)
+        compileZipCodeData(os.path.join(workdir, "SE.txt"))
+        env = {
+            "PYTHONPATH": os.pathsep.join(filter(None, [ROOT_DIR, os.getenv("PYTHONPATH")])),
+            "DATABASE": os.path.join(workdir, "telehelp.db"),
+            "DATABASE_KEY": secrets.token_hex(32),
+            "ELK_NUMBER": "+46700000000",
+            "CALL_STATE_BACKEND": "memory",
+        }
+        imports = measureImportTime("server.api", cwd=workdir, env=env)
+        imported = [name for name, _, _, _ in imports]
+        self.assertIn("server.api", imported)
+        self.assertEqual([name for name in imported if name.split(".")[0] in HEAVY_MODULES], [])
+        self.assertLessEqual(totalImportTime(imports), DEFAULT_BUDGET_MS)
+
+
+if __name__ == "__main__":
+    unittest.main()
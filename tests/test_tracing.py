@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from server.tracing import JsonLinesExporter
+from server.tracing import otlpPayload
+from server.tracing import readTraces
+from server.tracing import renderWaterfall
+from server.tracing import setTraceId
+from server.tracing import Tracer
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.exporter = ListExporter()
+        self.tracer = Tracer([self.exporter], flushInterval=60)
+        self.callId = str(uuid.uuid1())
+
+    def tearDown(self):
+        self.tracer.close()
+
+    def test_hopsOfACall(self):
+        span, token = self.tracer.startSpan("receiveCall")
+        setTraceId(self.callId)
+        self.tracer.recordQuery("SELECT 1", (), 0.002)
+        self.tracer.recordQuery("SELECT 2", (), 0.003)
+        self.tracer.recordElksRequest("/a1/sms", 0.1, False)
+        self.tracer.endSpan(span, token, **{"http.status_code": 200})
+
+        # Another thread only gets the span by running in a copy of the context, as ElksClient.postAsync does
+        span, token = self.tracer.startSpan("call", self.callId)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(self.tracer.recordElksRequest, "/a1/calls", 0.2, False).result()
+        self.tracer.endSpan(span, token)
+
+        # Not part of a call
+        span, token = self.tracer.startSpan("index")
+        self.tracer.recordElksRequest("/a1/sms", 0.1, False)
+        self.tracer.endSpan(span, token)
+        self.tracer.flush()
+
+        names = [span["name"] for span in self.exporter.spans]
+        self.assertEqual(names, ["46elks /a1/sms", "receiveCall", "call"])
+        elks, receiveCall, call = self.exporter.spans
+        self.assertEqual({span["trace_id"] for span in self.exporter.spans}, {uuid.UUID(self.callId).hex})
+        self.assertEqual(elks["parent_id"], receiveCall["span_id"])
+        expected = {"db.ms": 5.0, "db.queries": 2, "elks.ms": 100.0, "http.status_code": 200}
+        self.assertEqual(receiveCall["attributes"], expected)
+        self.assertEqual(call["attributes"], {})
+
+    def test_bufferIsBounded(self):
+        tracer = Tracer([self.exporter], maxBuffered=2, flushInterval=60)
+        for name in ("a", "b", "c"):
+            tracer.endSpan(tracer.startSpan(name, self.callId)[0])
+        tracer.close()
+        self.assertEqual([span["name"] for span in self.exporter.spans], ["b", "c"])
+        self.assertEqual(tracer.dropped, 1)
+
+    def test_otlpPayload(self):
+        self.tracer.endSpan(self.tracer.startSpan("receiveCall", self.callId)[0], **{"http.status_code": 200})
+        self.tracer.flush()
+        (resourceSpans,) = otlpPayload(self.exporter.spans)["resourceSpans"]
+        (span,) = resourceSpans["scopeSpans"][0]["spans"]
+        self.assertEqual(span["traceId"], uuid.UUID(self.callId).hex)
+        self.assertEqual(span["kind"], 2)
+        self.assertEqual(span["attributes"], [{"key": "http.status_code", "value": {"intValue": "200"}}])
+
+
+class TestWaterfall(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_waterfall(self):
+        path = os.path.join(self.dir, "trace.jsonl")
+        traceId = uuid.uuid1().hex
+        span = {"trace_id": traceId, "parent_id": None, "attributes": {}}
+        ms, s = 10 ** 6, 10 ** 9
+        db = {"db.ms": 4.0}
+        JsonLinesExporter(path).export(
+            [
+                dict(span, span_id="1", name="receiveCall", start_ns=0, end_ns=10 * ms, attributes=db),
+                dict(span, span_id="2", name="call", start_ns=2 * s, end_ns=2 * s + 10 * ms),
+                dict(span, span_id="3", parent_id="2", name="46elks /a1/calls", start_ns=2 * s, end_ns=3 * s),
+            ]
+        )
+        spans = readTraces(path)[traceId]
+        lines = renderWaterfall(spans, width=30)
+        self.assertEqual(len(lines), 5)
+        self.assertIn("receiveCall", lines[1])
+        self.assertIn("   1.99 call", lines[2])
+        self.assertTrue(lines[3].endswith("|" + " " * 20 + "#" * 10))
+        self.assertTrue(lines[4].startswith("3.00 s in total: 20.0 ms in the server (4.0 ms database"))
+        self.assertIn("1.99 s waiting", lines[4])
+
+
+if __name__ == "__main__":
+    unittest.main()
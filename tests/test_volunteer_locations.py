@@ -0,0 +1,102 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import contextmanager
+
+from server.migrations import migrate
+from server.migrations import MIGRATIONS
+from server.volunteerLocations import SqliteVolunteerCounts
+from server.volunteerLocations import VolunteerLocations
+
+LOCATION_DICT = {11122: (59.3326, 18.0649), 41103: (57.7072, 11.9668)}
+DISTRICT_DICT = {11122: "Stockholm", 41103: "Göteborg"}
+CITY_DICT = {11122: "Stockholm", 41103: "Göteborg"}
+
+
+class TestVolunteerLocations(unittest.TestCase):
+    def setUp(self):
+        handle, self.db = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        with self.connect() as conn:
+            # Registered before the counts were added to the schema
+            migrate(conn, MIGRATIONS[:3])
+            conn.execute("INSERT INTO user_helpers (phone, zipcode) values('+46700000001', '11122')")
+            conn.commit()
+            migrate(conn)
+        self.locations = VolunteerLocations(
+            SqliteVolunteerCounts(self.connect), LOCATION_DICT, DISTRICT_DICT, CITY_DICT, checkInterval=0
+        )
+
+    def tearDown(self):
+        os.remove(self.db)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.db)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def execute(self, query, params=()):
+        with self.connect() as conn:
+            conn.execute(query, params)
+            conn.commit()
+
+    def test_countsFollowUserHelpers(self):
+        etag, body = self.locations.current()
+        self.assertEqual(json.loads(body)["total"], 1)  # Existing helpers are counted by the migration
+
+        self.execute("INSERT INTO user_helpers (phone, zipcode) values('+46700000002', '41103')")
+        self.execute("INSERT INTO user_helpers (phone, zipcode) values('+46700000003', '41103')")
+        self.execute("UPDATE user_helpers SET zipcode='41103' WHERE phone='+46700000001'")
+        self.execute("DELETE FROM user_helpers WHERE phone='+46700000002'")
+
+        newEtag, body = self.locations.current()
+        self.assertNotEqual(newEtag, etag)
+        self.assertEqual(
+            json.loads(body),
+            {
+                "total": 2,
+                "locations": [
+                    {
+                        "district": "Göteborg",
+                        "data": [
+                            {
+                                "coordinates": [57.7072, 11.9668],
+                                "city": "Göteborg",
+                                "zipcode": "41103",
+                                "count": 2,
+                            }
+                        ],
+                    }
+                ],
+            },
+        )
+        # Unchanged data is served from the cached response
+        self.assertEqual(self.locations.current()[0], newEtag)
+
+    def test_tiles(self):
+        self.execute("INSERT INTO user_helpers (phone, zipcode) values('+46700000002', '41103')")
+        self.execute("INSERT INTO user_helpers (phone, zipcode) values('+46700000003', '41103')")
+
+        # The whole world, Stockholm and Göteborg fall into the same cluster
+        clusters = json.loads(self.locations.tile(0, 0, 0)[1])["clusters"]
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]["count"], 3)
+        self.assertAlmostEqual(clusters[0]["coordinates"][1], (18.0649 + 2 * 11.9668) / 3, places=3)
+
+        # Zoomed in over southern Sweden they are apart and named
+        tile = json.loads(self.locations.tile(5, 17, 9)[1])
+        self.assertEqual(tile["total"], 3)
+        self.assertEqual(
+            sorted((c["zipcode"], c["city"], c["count"]) for c in tile["clusters"]),
+            [("11122", "Stockholm", 1), ("41103", "Göteborg", 2)],
+        )
+        self.assertEqual(json.loads(self.locations.tile(5, 0, 0)[1])["clusters"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()